@@ -16,8 +16,12 @@ from .distribution_strategies import (
     DistributionStrategy,
     UniformDistributionStrategy,
     HashDistributionStrategy,
+    ConsistentHashDistributionStrategy,
+    RangeDistributionStrategy,
+    WeightedDistributionStrategy,
     RoundRobinDistributionStrategy
 )
+from .rebalance import PartitionRebalancer
 from .cleanup import OMOPCleanup
 
 __all__ = [
@@ -26,6 +30,10 @@ __all__ = [
     "DistributionStrategy",
     "UniformDistributionStrategy",
     "HashDistributionStrategy",
+    "ConsistentHashDistributionStrategy",
+    "RangeDistributionStrategy",
+    "WeightedDistributionStrategy",
     "RoundRobinDistributionStrategy",
+    "PartitionRebalancer",
     "OMOPCleanup",
 ]
@@ -0,0 +1,269 @@
+"""
+Vectorized partition assignment for OMOP partitioning
+
+This module computes the partition of whole batches of person keys at once with
+NumPy, by modulus, by a stable hash, by jump consistent hashing, by ranges or by
+an explicit key map, builds
+such maps by packing weighted keys or from the rows of a parent table (KeyMap),
+and splits batches by partition. Columnar batches are split with one sort and
+gathered by position, so routing them costs no Python work per row; batches of
+Python rows only need one append per row. Rows whose key has no partition get
+NO_PARTITION and are dropped.
+
+Author: Narasimha Raghavan
+"""
+
+import heapq
+from operator import itemgetter
+from typing import List, Sequence
+import numpy as np
+
+# Partition id of keys that belong to no partition (NULL keys, negative modulus, unmapped keys)
+NO_PARTITION = -1
+
+# Partition id of rows that belong to no person and are copied to every partition
+# (see the routing module); they must be written separately before a batch is split
+ALL_PARTITIONS = -2
+
+# Initial state of PostgreSQL's hash_bytes_uint32 (Bob Jenkins' lookup3 for one word)
+JENKINS_INIT = (0x9E3779B9 + 4 + 3923095) & 0xFFFFFFFF
+
+# Rotations and operand order of lookup3's final() mix: (target, source, rotation)
+_JENKINS_FINAL = (('c', 'b', 14), ('a', 'c', 11), ('b', 'a', 25), ('c', 'b', 16),
+                  ('a', 'c', 4), ('b', 'a', 14), ('c', 'b', 24))
+
+# Multiplier of the linear congruential generator of jump consistent hashing
+JUMP_MULTIPLIER = 2862933555777941757
+
+
+def stable_hash(key: int) -> int:
+    """
+    Hash of an integer key as PostgreSQL's hashint8() computes it, as an unsigned
+    32-bit value. Unlike hash(), the result is the same in every process and on
+    every host, and the server can compute it in the export queries (see
+    get_hash_partition_sql); hash_partitions computes it for arrays of keys.
+    """
+    key &= 0xFFFFFFFFFFFFFFFF
+    low, high = key & 0xFFFFFFFF, key >> 32
+    # hashint8 folds the high half in so that values fitting int4 hash like hashint4
+    low ^= high if key < 1 << 63 else ~high & 0xFFFFFFFF
+    state = {'a': (JENKINS_INIT + low) & 0xFFFFFFFF, 'b': JENKINS_INIT, 'c': JENKINS_INIT}
+    for target, source, rotation in _JENKINS_FINAL:
+        value = state[source]
+        rotated = ((value << rotation) | (value >> (32 - rotation))) & 0xFFFFFFFF
+        state[target] = ((state[target] ^ value) - rotated) & 0xFFFFFFFF
+    return state['c']
+
+
+def get_hash_partition_sql(column: str, num_partitions: int) -> str:
+    """SQL expression of the partition stable_hash assigns to the value of a column"""
+    # hashint8 returns a signed int4; masking its bigint form gives the unsigned value
+    return f"((hashint8({column})::bigint & 4294967295) % {num_partitions})"
+
+
+def get_batch_keys(batch: Sequence, key_index: int):
+    """
+    Extract the key column of a batch of rows
+    Returns an int64 array of the keys and a boolean array of the non-NULL ones
+    (None when no key is NULL)
+    """
+    try:
+        return np.fromiter(map(itemgetter(key_index), batch), dtype=np.int64, count=len(batch)), None
+    except TypeError:
+        # Some keys are NULL
+        keys = [row[key_index] for row in batch]
+        valid = np.fromiter((k is not None for k in keys), dtype=bool, count=len(keys))
+        values = np.fromiter((0 if k is None else k for k in keys), dtype=np.int64, count=len(keys))
+        return values, valid
+
+
+def modulus_partitions(keys: np.ndarray, num_partitions: int) -> np.ndarray:
+    """
+    Partition of every key as key % num_partitions with PostgreSQL's semantics:
+    the remainder keeps the sign of the key, so negative keys with a non-zero
+    remainder match no partition
+    """
+    parts = np.fmod(keys, num_partitions)
+    parts[parts < 0] = NO_PARTITION
+    return parts
+
+
+def jump_hash(key: int, num_partitions: int) -> int:
+    """
+    Partition of a key by jump consistent hashing (Lamping and Veach) of stable_hash(key):
+    going from N to N+1 partitions moves only the keys that then land in partition N,
+    about 1/(N+1) of them, and never moves keys between the other partitions
+    """
+    state = stable_hash(key)
+    partition_index, candidate = -1, 0
+    while candidate < num_partitions:
+        partition_index = candidate
+        state = (state * JUMP_MULTIPLIER + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((partition_index + 1) * (float(1 << 31) / float((state >> 33) + 1)))
+    return partition_index
+
+
+def stable_hashes(keys: np.ndarray) -> np.ndarray:
+    """stable_hash of every key in an array, as uint32"""
+    keys = keys.astype(np.int64, copy=False)
+    low = (keys & 0xFFFFFFFF).astype(np.uint32)
+    high = (keys >> 32).astype(np.uint32)
+    low ^= np.where(keys >= 0, high, ~high)
+    state = {
+        'a': low + np.uint32(JENKINS_INIT),
+        'b': np.full(len(keys), JENKINS_INIT, dtype=np.uint32),
+        'c': np.full(len(keys), JENKINS_INIT, dtype=np.uint32),
+    }
+    for target, source, rotation in _JENKINS_FINAL:
+        value = state[source]
+        rotated = (value << np.uint32(rotation)) | (value >> np.uint32(32 - rotation))
+        state[target] = (state[target] ^ value) - rotated
+    return state['c']
+
+
+def hash_partitions(keys: np.ndarray, num_partitions: int) -> np.ndarray:
+    """Partition of every key as stable_hash(key) % num_partitions"""
+    return (stable_hashes(keys) % np.uint32(num_partitions)).astype(np.int64)
+
+
+def jump_partitions(keys: np.ndarray, num_partitions: int) -> np.ndarray:
+    """Partition of every key as jump_hash(key, num_partitions)"""
+    state = stable_hashes(keys).astype(np.uint64)
+    parts = np.full(len(state), -1, dtype=np.int64)
+    candidates = np.zeros(len(state), dtype=np.int64)
+    # Keys jump a few times each (about ln N); only those still below N are advanced
+    active = np.arange(len(state))
+    while len(active):
+        parts[active] = candidates[active]
+        state[active] = state[active] * np.uint64(JUMP_MULTIPLIER) + np.uint64(1)
+        scale = float(1 << 31) / ((state[active] >> np.uint64(33)) + np.uint64(1)).astype(np.float64)
+        candidates[active] = ((parts[active] + 1) * scale).astype(np.int64)
+        active = active[candidates[active] < num_partitions]
+    return parts
+
+
+def range_partitions(keys: np.ndarray, boundaries: Sequence[int]) -> np.ndarray:
+    """
+    Partition of every key from the ascending lower bounds of partitions 1 to N-1:
+    partition 0 holds the keys below boundaries[0], partition i the keys from
+    boundaries[i-1] up to (excluding) boundaries[i]
+    """
+    return np.searchsorted(np.asarray(boundaries, dtype=np.int64), keys, side='right').astype(np.int64)
+
+
+def mapped_partitions(keys: np.ndarray, map_keys: np.ndarray, map_partitions: np.ndarray) -> np.ndarray:
+    """
+    Partition of every key looked up in an explicit key map, given as the sorted keys
+    and their partitions; keys missing from the map match no partition
+    """
+    if not len(map_keys):
+        return np.full(len(keys), NO_PARTITION, dtype=np.int64)
+    positions = np.searchsorted(map_keys, keys)
+    positions[positions == len(map_keys)] = 0
+    found = map_keys[positions] == keys
+    return np.where(found, map_partitions[positions], NO_PARTITION).astype(np.int64)
+
+
+def get_partition_dtype(num_partitions: int):
+    """Smallest signed integer type holding the partitions and NO_PARTITION"""
+    if num_partitions <= np.iinfo(np.int8).max:
+        return np.int8
+    return np.int16 if num_partitions <= np.iinfo(np.int16).max else np.int32
+
+
+class KeyMap:
+    """
+    Partition of every key of a parent table (e.g. episode_id -> partition of the
+    episode's person), for routing the rows of its child tables by their keys
+
+    Partitions are stored in the smallest integer type. Keys that fill their range
+    densely are looked up by offset in one array, in constant time; sparse keys are
+    kept as sorted arrays searched by bisection, so memory stays proportional to the
+    number of keys whatever their range. The dense form is used whenever it is the
+    smaller one.
+    """
+
+    def __init__(self, keys: np.ndarray, partitions: np.ndarray, num_partitions: int):
+        dtype = get_partition_dtype(num_partitions)
+        keys = np.asarray(keys, dtype=np.int64)
+        self.num_keys = len(keys)
+        self.low = int(keys.min()) if len(keys) else 0
+        span = int(keys.max()) - self.low + 1 if len(keys) else 0
+        if span * np.dtype(dtype).itemsize <= len(keys) * (keys.itemsize + np.dtype(dtype).itemsize):
+            self.keys = None
+            self.partitions = np.full(span, NO_PARTITION, dtype=dtype)
+            self.partitions[keys - self.low] = partitions
+        else:
+            order = np.argsort(keys, kind='stable')
+            self.keys = keys[order]
+            self.partitions = np.asarray(partitions)[order].astype(dtype)
+
+    def __len__(self) -> int:
+        return self.num_keys
+
+    @property
+    def nbytes(self) -> int:
+        return self.partitions.nbytes + (self.keys.nbytes if self.keys is not None else 0)
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """Partition of every key, NO_PARTITION for keys missing from the map"""
+        if self.keys is not None:
+            return mapped_partitions(keys, self.keys, self.partitions)
+        offsets = np.asarray(keys, dtype=np.int64) - self.low
+        found = (offsets >= 0) & (offsets < len(self.partitions))
+        parts = np.full(len(offsets), NO_PARTITION, dtype=np.int64)
+        parts[found] = self.partitions[offsets[found]]
+        return parts
+
+
+def pack_partitions(weights: np.ndarray, num_partitions: int) -> np.ndarray:
+    """
+    Partition of every weighted key by the LPT (longest processing time first)
+    heuristic: keys are taken from the heaviest down and each goes to the partition
+    with the least weight so far, which keeps the heaviest partition within 4/3 of
+    the best possible. Ties go to the lowest partition, so the result is deterministic.
+    """
+    order = np.argsort(-np.asarray(weights, dtype=np.float64), kind='stable')
+    loads = [(0.0, i) for i in range(num_partitions)]
+    assigned = []
+    for weight in np.asarray(weights, dtype=np.float64)[order].tolist():
+        load, partition_index = loads[0]
+        assigned.append(partition_index)
+        heapq.heapreplace(loads, (load + weight, partition_index))
+    parts = np.empty(len(order), dtype=np.int64)
+    parts[order] = assigned
+    return parts
+
+
+def split_by_partition(parts: np.ndarray, num_partitions: int) -> List[np.ndarray]:
+    """
+    Group row positions by partition with one stable sort, for batches that can be
+    gathered by position (arrays, Arrow record batches)
+    Returns the positions of the rows of every partition, in their original order
+    """
+    # Shift so that NO_PARTITION sorts first and falls in group 0; small integer
+    # groups are sorted with a radix sort
+    groups = (parts + 1).astype(np.uint16 if num_partitions < 0xFFFF else np.int64)
+    order = np.argsort(groups, kind='stable')
+    ends = np.cumsum(np.bincount(groups, minlength=num_partitions + 1))
+    return [order[ends[i]:ends[i + 1]] for i in range(num_partitions)]
+
+
+def split_batch(batch: Sequence, parts: np.ndarray, num_partitions: int) -> List[List]:
+    """
+    Split a batch of Python rows into one list per partition from the partition of every row
+
+    Gathering Python objects by position costs more than appending them in order,
+    so the rows are appended to their partition's list in one pass.
+    """
+    if len(batch) and (parts == parts[0]).all():
+        # Common for batches of rows sorted or clustered by person
+        buckets = [[] for _ in range(num_partitions)]
+        if parts[0] != NO_PARTITION:
+            buckets[parts[0]] = list(batch)
+        return buckets
+    # One extra list at the end collects the rows of NO_PARTITION (index -1)
+    buckets = [[] for _ in range(num_partitions + 1)]
+    for row, partition_index in zip(batch, parts.tolist()):
+        buckets[partition_index].append(row)
+    return buckets[:num_partitions]
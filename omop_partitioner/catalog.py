@@ -0,0 +1,236 @@
+"""
+Catalog snapshot for OMOP partitioning
+
+This module loads the table metadata needed by the exporter and the distribution
+strategies (columns, types, nullability, primary keys and size statistics) from
+pg_catalog in a few queries per run, instead of querying information_schema once
+per table and partition. It also records the cheap change counters used to
+fingerprint tables for incremental exports.
+
+Author: Narasimha Raghavan
+"""
+
+import logging
+from typing import Dict, List, Optional
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnInfo:
+    """Metadata of a single table column"""
+
+    def __init__(self, name: str, data_type: str, is_nullable: bool, declared_type: str = None):
+        self.name = name
+        self.data_type = data_type
+        self.is_nullable = is_nullable
+        # Type with its modifier, e.g. numeric(10,2) where data_type is numeric
+        self.declared_type = declared_type or data_type
+
+    def __repr__(self) -> str:
+        return f"ColumnInfo({self.name!r}, {self.data_type!r}, nullable={self.is_nullable})"
+
+
+class TableInfo:
+    """Metadata of a single table"""
+
+    def __init__(self, schema: str, name: str, reltuples: float = 0, relpages: int = 0,
+                 relfilenode: int = 0):
+        self.schema = schema
+        self.name = name
+        self.columns = []
+        self.primary_key = []
+        # Columns that lead an index, so MAX() over them is an index lookup
+        self.indexed_columns = []
+        # Planner statistics; reltuples is -1 for tables that were never analyzed
+        self.reltuples = reltuples
+        self.relpages = relpages
+        # Average row width from pg_stats, None if the table has no statistics
+        self.row_width = None
+        # Storage file of the table; changes on TRUNCATE, VACUUM FULL, CLUSTER, etc.
+        self.relfilenode = relfilenode
+        # Cumulative row change counters from pg_stat_user_tables
+        self.n_tup_ins = 0
+        self.n_tup_upd = 0
+        self.n_tup_del = 0
+
+    @property
+    def column_names(self) -> List[str]:
+        return [c.name for c in self.columns]
+
+    @property
+    def column_types(self) -> List[str]:
+        return [c.data_type for c in self.columns]
+
+    @property
+    def nullable_columns(self) -> List[str]:
+        return [c.name for c in self.columns if c.is_nullable]
+
+    @property
+    def has_person_id(self) -> bool:
+        return any(c.name == 'person_id' for c in self.columns)
+
+    def get_column(self, name: str) -> Optional[ColumnInfo]:
+        for column in self.columns:
+            if column.name == name:
+                return column
+        return None
+
+    def estimate_row_width(self) -> float:
+        """Average row width in bytes from pg_stats, falling back to relpages/reltuples (0 if unknown)"""
+        if self.row_width:
+            return float(self.row_width)
+        if self.reltuples > 0:
+            return self.relpages * 8192 / self.reltuples
+        return 0.0
+
+    def change_fingerprint(self) -> Dict:
+        """Columns and counters that change whenever rows of the table are written or its storage is rewritten"""
+        return {
+            'columns': self.column_names,
+            'relfilenode': self.relfilenode,
+            'n_tup_ins': self.n_tup_ins,
+            'n_tup_upd': self.n_tup_upd,
+            'n_tup_del': self.n_tup_del,
+        }
+
+
+class CatalogSnapshot:
+    """Table metadata of one schema, loaded once from pg_catalog"""
+
+    def __init__(self, schema: str, tables: Dict[str, TableInfo]):
+        self.schema = schema
+        self.tables = tables
+
+    @classmethod
+    def load(cls, engine, schema: str = 'omopcdm') -> 'CatalogSnapshot':
+        """Load the metadata of all tables in a schema"""
+        tables = {}
+
+        with engine.connect() as conn:
+            # Columns, types and nullability of every table
+            result = conn.execute(text("""
+                SELECT c.relname, c.reltuples, c.relpages, c.relfilenode,
+                       a.attname, format_type(a.atttypid, NULL), NOT a.attnotnull,
+                       format_type(a.atttypid, a.atttypmod)
+                FROM pg_catalog.pg_class c
+                JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+                JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid
+                WHERE n.nspname = :schema
+                AND c.relkind IN ('r', 'p')
+                AND a.attnum > 0
+                AND NOT a.attisdropped
+                ORDER BY c.relname, a.attnum
+            """), {"schema": schema})
+            for relname, reltuples, relpages, relfilenode, attname, data_type, is_nullable, declared_type in result:
+                info = tables.get(relname)
+                if info is None:
+                    info = tables[relname] = TableInfo(schema, relname, reltuples, relpages, relfilenode)
+                info.columns.append(ColumnInfo(attname, data_type, is_nullable, declared_type))
+
+            # Primary key columns in key order
+            result = conn.execute(text("""
+                SELECT c.relname, a.attname
+                FROM pg_catalog.pg_constraint con
+                JOIN pg_catalog.pg_class c ON c.oid = con.conrelid
+                JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+                CROSS JOIN LATERAL unnest(con.conkey) WITH ORDINALITY AS k(attnum, ord)
+                JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum
+                WHERE n.nspname = :schema
+                AND con.contype = 'p'
+                ORDER BY c.relname, k.ord
+            """), {"schema": schema})
+            for relname, attname in result:
+                if relname in tables:
+                    tables[relname].primary_key.append(attname)
+
+            # Leading column of every index
+            result = conn.execute(text("""
+                SELECT DISTINCT c.relname, a.attname
+                FROM pg_catalog.pg_index i
+                JOIN pg_catalog.pg_class c ON c.oid = i.indrelid
+                JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+                JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid AND a.attnum = i.indkey[0]
+                WHERE n.nspname = :schema
+                ORDER BY c.relname, a.attname
+            """), {"schema": schema})
+            for relname, attname in result:
+                if relname in tables:
+                    tables[relname].indexed_columns.append(attname)
+
+            # Average row widths from the planner statistics
+            result = conn.execute(text("""
+                SELECT tablename, SUM(avg_width)
+                FROM pg_catalog.pg_stats
+                WHERE schemaname = :schema
+                GROUP BY tablename
+            """), {"schema": schema})
+            for tablename, row_width in result:
+                if tablename in tables:
+                    tables[tablename].row_width = row_width
+
+            # Row change counters since the statistics were last reset
+            result = conn.execute(text("""
+                SELECT relname, n_tup_ins, n_tup_upd, n_tup_del
+                FROM pg_catalog.pg_stat_user_tables
+                WHERE schemaname = :schema
+            """), {"schema": schema})
+            for relname, n_tup_ins, n_tup_upd, n_tup_del in result:
+                if relname in tables:
+                    info = tables[relname]
+                    info.n_tup_ins, info.n_tup_upd, info.n_tup_del = n_tup_ins, n_tup_upd, n_tup_del
+
+        logger.info(f"Loaded catalog snapshot of {len(tables)} tables in schema {schema}")
+        return cls(schema, tables)
+
+    def to_dict(self) -> Dict:
+        """Plain data form of the snapshot, for storing it as JSON"""
+        return {
+            'schema': self.schema,
+            'tables': {
+                name: {
+                    'columns': [[c.name, c.data_type, c.is_nullable, c.declared_type] for c in info.columns],
+                    'primary_key': info.primary_key,
+                    'indexed_columns': info.indexed_columns,
+                    'reltuples': info.reltuples,
+                    'relpages': info.relpages,
+                    'row_width': info.row_width,
+                    'relfilenode': info.relfilenode,
+                    'n_tup_ins': info.n_tup_ins,
+                    'n_tup_upd': info.n_tup_upd,
+                    'n_tup_del': info.n_tup_del,
+                }
+                for name, info in self.tables.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'CatalogSnapshot':
+        """Recreate a snapshot stored with to_dict"""
+        schema = data['schema']
+        tables = {}
+        for name, entry in data['tables'].items():
+            info = TableInfo(schema, name, entry['reltuples'], entry['relpages'], entry['relfilenode'])
+            info.columns = [ColumnInfo(*column) for column in entry['columns']]
+            info.primary_key = list(entry['primary_key'])
+            info.indexed_columns = list(entry.get('indexed_columns', []))
+            info.row_width = entry['row_width']
+            info.n_tup_ins, info.n_tup_upd, info.n_tup_del = entry['n_tup_ins'], entry['n_tup_upd'], entry['n_tup_del']
+            tables[name] = info
+        return cls(schema, tables)
+
+    def get_table(self, table: str) -> Optional[TableInfo]:
+        """Look up a table by name, either 'table' or 'schema.table'"""
+        if '.' in table:
+            schema, table = table.split('.')
+            if schema != self.schema:
+                return None
+        return self.tables.get(table)
+
+    def has_column(self, table: str, column: str) -> bool:
+        info = self.get_table(table)
+        return info is not None and info.get_column(column) is not None
+
+    def has_person_id_column(self, table: str) -> bool:
+        info = self.get_table(table)
+        return info is not None and info.has_person_id
@@ -35,7 +35,23 @@ class OMOPCleanup:
         # These are the only files that should be cleaned up
         self.file_patterns = [
             "partition_*_complete.sql",  # Generated partition files
+            "partition_*_complete.sql.gz",   # Generated gzip-compressed partition files
+            "partition_*_complete.sql.zst",  # Generated zstd-compressed partition files
+            "partition_*_delta.sql*",    # Generated delta files (--delta)
+            "partition_*_moves.sql*",    # Generated moves files (--moves)
+            "*.pgcopy*",                 # Generated binary COPY data files (--format binary-copy)
+            "part-*.parquet",            # Generated Parquet data files (--format parquet)
+            "manifest.json",             # Generated run manifest
+            "person_map.npz",            # Generated person map of the weighted/round_robin strategies
+            "rebalance.json",            # Generated rebalance progress file (omop-rebalance)
             "schema.sql",                # Generated schema export
+            "schema.sql.gz",             # Generated gzip-compressed schema export
+            "schema.sql.zst",            # Generated zstd-compressed schema export
+            "schema_pre_data.sql*",      # Generated pre-data schema export (--split-schema)
+            "schema_post_data.sql*",     # Generated post-data schema export (--split-schema)
+            "vocabulary.sql",            # Generated shared vocabulary export
+            "vocabulary.sql.gz",         # Generated gzip-compressed shared vocabulary export
+            "vocabulary.sql.zst",        # Generated zstd-compressed shared vocabulary export
             "source_graph.dot",          # Generated source graph
             "source_graph.png",          # Generated source graph image
             "partition_*_graph.dot",     # Generated partition graphs
@@ -113,6 +129,14 @@ class OMOPCleanup:
         omop_patterns = [
             "omop_partitions_config_*.zip",    # Generated config archives
             "partition_*_complete.sql",        # Generated complete partition files
+            "partition_*_complete.sql.gz",     # Generated gzip-compressed partition files
+            "partition_*_complete.sql.zst",    # Generated zstd-compressed partition files
+            "partition_*_delta.sql*",          # Generated delta files (--delta)
+            "partition_*_moves.sql*",          # Generated moves files (--moves)
+            "*.pgcopy*",                       # Generated binary COPY data files (--format binary-copy)
+            "part-*.parquet",                  # Generated Parquet data files (--format parquet)
+            "manifest.json",                   # Generated run manifest (in output dirs)
+            "person_map.npz",                  # Generated person map (in output dirs)
             "partition_*_graph.dot",           # Generated partition graphs
             "partition_*_graph.png",           # Generated partition graph images
             "source_graph.dot",                # Generated source graph
@@ -120,6 +144,13 @@ class OMOPCleanup:
             "partitioning_report.txt",         # Generated partitioning report
             "import_partitions.sh",            # Generated import script
             "schema.sql",                      # Generated schema export (in output dirs)
+            "schema.sql.gz",                   # Generated gzip-compressed schema export
+            "schema.sql.zst",                  # Generated zstd-compressed schema export
+            "schema_pre_data.sql*",            # Generated pre-data schema export (--split-schema)
+            "schema_post_data.sql*",           # Generated post-data schema export (--split-schema)
+            "vocabulary.sql",                  # Generated shared vocabulary export
+            "vocabulary.sql.gz",               # Generated gzip-compressed shared vocabulary export
+            "vocabulary.sql.zst",              # Generated zstd-compressed shared vocabulary export
         ]
         
         for pattern in omop_patterns:
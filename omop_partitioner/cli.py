@@ -10,7 +10,9 @@ import os
 import sys
 import logging
 from dotenv import load_dotenv
-from .sql_partitioner import OMOPSQLPartitioner
+from .sql_partitioner import OMOPSQLPartitioner, get_import_command
+from .sql_export import SCAN_RANGE_PAGES
+from .distribution_strategies import DISTRIBUTION_STRATEGIES
 
 # Configure logging
 logging.basicConfig(
@@ -37,6 +39,52 @@ Examples:
 
   # Use hash distribution strategy
   omop-partitioner --strategy hash --partitions 8
+
+  # Split persons into contiguous person_id ranges (index range scans per partition)
+  omop-partitioner --strategy range --range-bounds ntile --partitions 8
+
+  # Balance partitions by data volume rather than person count
+  omop-partitioner --strategy weighted --partitions 8
+
+  # Read each source table only once for all partitions
+  omop-partitioner --fan-out --partitions 16
+
+  # Export tables on 8 worker processes
+  omop-partitioner --jobs 8 --partitions 4
+
+  # Write zstd-compressed partition files
+  omop-partitioner --compress zstd --compress-threads 8
+
+  # Export the vocabulary once instead of into every partition
+  omop-partitioner --shared-vocabulary --partitions 8
+
+  # Build indexes and constraints after the data has been loaded
+  omop-partitioner --split-schema --partitions 4
+
+  # Nightly re-export that only queries tables changed since the last run
+  omop-partitioner --incremental --partitions 4
+
+  # Export only rows changed since the last run, as upserts for running partitions
+  omop-partitioner --delta --partitions 4
+  omop-partitioner --delta previous/manifest.json --watermark '*_datetime'
+
+  # Grow consistent-hash partitions from 8 to 9, shipping only the persons that move
+  omop-partitioner --strategy consistent_hash --partitions 8
+  omop-partitioner --strategy consistent_hash --moves --partitions 9
+
+  # Continue an export that was interrupted, redoing only unfinished segments
+  omop-partitioner --resume --jobs 8 --partitions 16
+
+  # Binary COPY data files, loaded by the partition files
+  omop-partitioner --format binary-copy --partitions 4
+
+  # Parquet datasets for Spark/DuckDB (needs: pip install "omop-partitioner[parquet]")
+  omop-partitioner --format parquet --compress zstd --partitions 8
+
+  # Read the source once into a local cache, then partition it offline (needs pyarrow)
+  omop-partitioner --stage omop_cache --jobs 4
+  omop-partitioner --from-cache omop_cache --partitions 8
+  omop-partitioner --from-cache omop_cache --partitions 16 --output-dir sql_exports_16
         """
     )
     
@@ -54,9 +102,24 @@ Examples:
     
     parser.add_argument(
         "--strategy",
-        choices=["uniform", "hash", "round_robin"],
+        choices=list(DISTRIBUTION_STRATEGIES),
         default=None,
-        help="Distribution strategy (overrides DISTRIBUTION_STRATEGY from .env)"
+        help="Distribution strategy assigning persons to partitions (overrides DISTRIBUTION_STRATEGY from .env)"
+    )
+    
+    parser.add_argument(
+        "--range-bounds",
+        choices=["histogram", "ntile"],
+        default="histogram",
+        help="How the range strategy computes its person_id boundaries: from the pg_stats histogram "
+             "(no scan) or with ntile() over all persons (one scan, exact) (default: histogram)"
+    )
+    
+    parser.add_argument(
+        "--routing-rules",
+        metavar="FILE",
+        help="JSON file of links routing tables without person_id (e.g. note_nlp, cost) through their "
+             "parent rows, replacing the built-in links of the tables it names (see README)"
     )
     
     parser.add_argument(
@@ -77,6 +140,124 @@ Examples:
         help="Use COPY statements for faster data import (default: uses bulk INSERT)"
     )
     
+    parser.add_argument(
+        "--format",
+        dest="output_format",
+        choices=["sql", "binary-copy", "parquet"],
+        default="sql",
+        help="Data format: sql (data inside the partition files), binary-copy (PGCOPY binary "
+             "files per partition and table, loaded by the partition files) or parquet (one "
+             "directory of Parquet datasets per partition, needs pyarrow) (default: sql)"
+    )
+    
+    parser.add_argument(
+        "--fan-out",
+        action="store_true",
+        help="Scan each source table once and route rows to all partition files (default: one scan per partition)"
+    )
+    
+    parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=1,
+        help="Number of worker processes exporting tables in parallel from one shared snapshot (default: 1)"
+    )
+    
+    parser.add_argument(
+        "--scan-range-pages",
+        type=int,
+        default=SCAN_RANGE_PAGES,
+        metavar="PAGES",
+        help="With --jobs, scan tables larger than PAGES 8 KiB pages as up to one ctid range of blocks per job, "
+             f"concurrently (PostgreSQL 14+); 0 scans every table on one connection (default: {SCAN_RANGE_PAGES}, 1 GiB)"
+    )
+    
+    parser.add_argument(
+        "--compress",
+        choices=["gzip", "zstd"],
+        default=None,
+        help="Compress partition and schema files inline while exporting (default: no compression)"
+    )
+    
+    parser.add_argument(
+        "--compress-level",
+        type=int,
+        default=None,
+        help="Compression level (default: 6 for gzip, 3 for zstd)"
+    )
+    
+    parser.add_argument(
+        "--compress-threads",
+        type=int,
+        default=None,
+        help="Compression threads per output file, uses pigz for gzip (default: CPU count divided by --jobs)"
+    )
+    
+    parser.add_argument(
+        "--shared-vocabulary",
+        action="store_true",
+        help="Write vocabulary and lookup tables once to vocabulary.sql instead of into every partition file"
+    )
+    
+    parser.add_argument(
+        "--split-schema",
+        action="store_true",
+        help="Create tables before the data and build indexes and constraints after it (pg_dump pre-data/post-data sections)"
+    )
+    
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Keep table segments in the output directory and reuse those of tables unchanged since the last export"
+    )
+    
+    parser.add_argument(
+        "--delta",
+        nargs="?",
+        const="",
+        metavar="MANIFEST",
+        help="Export rows of person-dependent tables changed since a previous run as per-partition "
+             "upsert files (default manifest: manifest.json in the output directory)"
+    )
+    
+    parser.add_argument(
+        "--moves",
+        nargs="?",
+        const="",
+        metavar="MANIFEST",
+        help="Export only the persons whose partition changes from the partition count of a previous "
+             "run to --partitions, as per-partition delete and upsert files; the files of new "
+             "partitions also carry the vocabulary and other full-copy tables "
+             "(default manifest: manifest.json in the output directory)"
+    )
+    
+    parser.add_argument(
+        "--watermark",
+        default="xmin",
+        help="Change watermark recorded for delta exports: xmin, id (primary key), a column name, or a "
+             "column name pattern such as '*_datetime' matching indexed columns only (default: xmin)"
+    )
+    
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted export, skipping the segments its manifest records as finished"
+    )
+    
+    parser.add_argument(
+        "--stage",
+        metavar="CACHE_DIR",
+        help="Read every source table once into a local Arrow cache in CACHE_DIR instead of "
+             "exporting partitions, for later runs with --from-cache"
+    )
+    
+    parser.add_argument(
+        "--from-cache",
+        metavar="CACHE_DIR",
+        help="Produce the partitions from a cache written by --stage without connecting to "
+             "the source database"
+    )
+    
     parser.add_argument(
         "--version",
         action="version",
@@ -99,24 +280,88 @@ Examples:
         distribution_strategy = args.strategy or os.getenv('DISTRIBUTION_STRATEGY', 'uniform')
         output_dir = args.output_dir or os.getenv('OUTPUT_DIR', 'sql_exports')
         
-        if not source_db_url:
+        if not source_db_url and not args.from_cache:
             logger.error("Database URL is required. Set SOURCE_DB_URL in .env file or use --db-url")
             sys.exit(1)
+        if args.stage and args.from_cache:
+            logger.error("--stage and --from-cache cannot be combined")
+            sys.exit(1)
         
         logger.info("Starting OMOP SQL partitioning process...")
-        logger.info(f"Source database: {source_db_url}")
+        if args.from_cache:
+            logger.info(f"Staged source: {args.from_cache}")
+        else:
+            logger.info(f"Source database: {source_db_url}")
         logger.info(f"Number of partitions: {num_partitions}")
         logger.info(f"Distribution strategy: {distribution_strategy}")
         logger.info(f"Output directory: {output_dir}")
+        if args.jobs > 1:
+            logger.info(f"Parallel jobs: {args.jobs}")
         
         # Initialize and run partitioner
         partitioner = OMOPSQLPartitioner(
             source_db_url=source_db_url,
             num_partitions=num_partitions,
             output_dir=output_dir,
-            use_copy=args.use_copy
+            use_copy=args.use_copy,
+            fan_out=args.fan_out,
+            jobs=args.jobs,
+            compress=args.compress,
+            compress_level=args.compress_level,
+            compress_threads=args.compress_threads,
+            shared_vocabulary=args.shared_vocabulary,
+            split_schema=args.split_schema,
+            incremental=args.incremental,
+            watermark=args.watermark,
+            resume=args.resume,
+            output_format=args.output_format,
+            cache_dir=args.from_cache,
+            strategy=distribution_strategy,
+            range_bounds=args.range_bounds,
+            routing_rules=args.routing_rules,
+            scan_range_pages=args.scan_range_pages
         )
         
+        if args.stage:
+            staged = partitioner.stage_source(args.stage)
+            print("\n" + "=" * 60)
+            print("STAGING COMPLETED SUCCESSFULLY!")
+            print("=" * 60)
+            print(f"Staged {len(staged.row_counts)} tables ({sum(staged.row_counts.values()):,} rows) in: {args.stage}")
+            print("\nPartition the staged source with:")
+            print(f"  omop-partitioner --from-cache {args.stage} --partitions <N>")
+            print("=" * 60)
+            return
+        
+        if args.delta is not None:
+            delta_files = partitioner.partition_delta(args.delta or None)
+            print("\n" + "=" * 60)
+            print("DELTA EXPORT COMPLETED SUCCESSFULLY!")
+            print("=" * 60)
+            print(f"Generated {len(delta_files)} delta files:")
+            for i, file_path in enumerate(delta_files):
+                print(f"  Partition {i}: {os.path.basename(file_path)}")
+            print(f"\nFiles saved in: {output_dir}")
+            print("\nApply each delta file to its running partition container:")
+            print(f"  {get_import_command(args.compress)}")
+            print("=" * 60)
+            return
+        
+        if args.moves is not None:
+            move_files = partitioner.partition_moves(args.moves or None)
+            print("\n" + "=" * 60)
+            print("MOVES EXPORT COMPLETED SUCCESSFULLY!")
+            print("=" * 60)
+            print(f"Generated {len(move_files)} moves files:")
+            for i, file_path in enumerate(move_files):
+                print(f"  Partition {i}: {os.path.basename(file_path)}")
+            print(f"\nFiles saved in: {output_dir}")
+            print("\nApply each moves file to its running partition container (create new partitions")
+            print("from the schema first; their moves files load the full-copy tables):")
+            print(f"  {get_import_command(args.compress)}")
+            print("=" * 60)
+            return
+        
         partition_files = partitioner.partition_database()
         
         # Print summary
@@ -126,10 +371,12 @@ Examples:
         print(f"Generated {len(partition_files)} partition files:")
         for i, file_path in enumerate(partition_files):
             print(f"  Partition {i}: {os.path.basename(file_path)}")
+        if partitioner.sql_exporter.vocabulary_file:
+            print(f"  Shared vocabulary (load first): {os.path.basename(partitioner.sql_exporter.vocabulary_file)}")
         print(f"\nFiles saved in: {output_dir}")
         print(f"Summary report: {os.path.join(output_dir, 'partitioning_report.txt')}")
         print("\nTo import into PostgreSQL containers:")
-        print("  psql -U postgres -d <database_name> -f partition_X_complete.sql")
+        print(f"  {get_import_command(args.compress, args.output_format)}")
         print("=" * 60)
         
     except KeyboardInterrupt:
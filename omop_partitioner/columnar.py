@@ -0,0 +1,199 @@
+"""
+Columnar (Arrow/Parquet) output for OMOP partitions
+
+This module converts the rows streamed from the source into Arrow record
+batches and writes them as Parquet files, so partitions can be read by Spark,
+DuckDB and similar engines without restoring them into PostgreSQL, or as
+Arrow IPC files for the local staging cache of the source.
+pyarrow is an optional dependency (pip install omop-partitioner[parquet]).
+
+Author: Narasimha Raghavan
+"""
+
+import re
+import logging
+from decimal import Decimal
+from typing import Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Rows buffered per writer before they are written as one Parquet row group
+PARQUET_ROW_GROUP_ROWS = 65536
+
+# Parquet codec used for each --compress method; Parquet compresses pages itself
+PARQUET_COMPRESSION = {
+    None: 'snappy',
+    'gzip': 'gzip',
+    'zstd': 'zstd',
+}
+
+# numeric with a type modifier, as named by format_type(), e.g. numeric(10,2)
+NUMERIC_TYPE = re.compile(r'^numeric\((\d+),(\d+)\)$')
+# Largest precision of a decimal128 value
+DECIMAL128_MAX_PRECISION = 38
+
+
+def import_pyarrow():
+    """Import pyarrow and pyarrow.parquet, with a hint on how to install them"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet and Arrow files require the 'pyarrow' package "
+                          "(pip install omop-partitioner[parquet])")
+    return pyarrow, pyarrow.parquet
+
+
+def get_arrow_type(pa, data_type: Optional[str]):
+    """
+    Arrow type of a column from its format_type() name
+
+    numeric(p,s) is written as decimal128(p, s); numeric without a type modifier
+    (or beyond the precision of decimal128) has no fixed precision and is written
+    as its exact text, like the staging cache stores it. Types without a mapping
+    are written as their text form.
+    """
+    match = NUMERIC_TYPE.match(data_type or '')
+    if match is not None and int(match.group(1)) <= DECIMAL128_MAX_PRECISION:
+        return pa.decimal128(int(match.group(1)), int(match.group(2)))
+    if data_type == 'smallint':
+        return pa.int16()
+    if data_type == 'integer':
+        return pa.int32()
+    if data_type == 'bigint':
+        return pa.int64()
+    if data_type == 'real':
+        return pa.float32()
+    if data_type == 'double precision':
+        return pa.float64()
+    if data_type == 'boolean':
+        return pa.bool_()
+    if data_type == 'date':
+        return pa.date32()
+    if data_type == 'timestamp without time zone':
+        return pa.timestamp('us')
+    if data_type == 'timestamp with time zone':
+        return pa.timestamp('us', tz='UTC')
+    return pa.string()
+
+
+def get_arrow_schema(pa, columns: List[str], data_types: List[str]):
+    """Arrow schema of a table from its column names and types"""
+    return pa.schema([pa.field(c, get_arrow_type(pa, t)) for c, t in zip(columns, data_types)])
+
+
+class ParquetTableWriter:
+    """
+    Writes the rows of one table for one partition to a Parquet file
+
+    Has the write_rows/close interface of the SQL table writers, so rows can be
+    routed to it in the same way. A file is written even if no rows arrive, so
+    every partition holds every table.
+    """
+
+    def __init__(self, path: str, columns: List[str], data_types: List[str],
+                 compress: Optional[str] = None, level: Optional[int] = None):
+        self.pa, self.pq = import_pyarrow()
+        self.path = path
+        self.schema = get_arrow_schema(self.pa, columns, data_types)
+        self.compression = PARQUET_COMPRESSION[compress]
+        self.level = level
+        # Columns whose values are converted before they are handed to Arrow
+        # (numeric values read back from the staging cache arrive as text)
+        self.decimal_columns = [i for i, f in enumerate(self.schema) if self.pa.types.is_decimal(f.type)]
+        self.text_columns = [i for i, f in enumerate(self.schema) if f.type == self.pa.string()
+                             and data_types[i] not in ('text', 'character varying', 'character')]
+        self.writer = None
+        self.pending = []
+        self.rows_written = 0
+
+    def write_rows(self, rows: Sequence) -> None:
+        """Buffer a batch of rows, writing a row group once enough have arrived"""
+        if not rows:
+            return
+        self.pending.extend(rows)
+        self.rows_written += len(rows)
+        if len(self.pending) >= PARQUET_ROW_GROUP_ROWS:
+            self._flush()
+
+    def close(self) -> int:
+        """Write the remaining rows, finish the file and return the number of rows written"""
+        self._flush()
+        if self.writer is None:
+            self.pq.write_table(self.schema.empty_table(), self.path, compression=self.compression)
+        else:
+            self.writer.close()
+        return self.rows_written
+
+    def _flush(self) -> None:
+        if not self.pending:
+            return
+        if self.writer is None:
+            self.writer = self._open_writer()
+        self.writer.write_batch(self.to_record_batch(self.pending))
+        self.pending = []
+
+    def _open_writer(self):
+        return self.pq.ParquetWriter(self.path, self.schema, compression=self.compression,
+                                     compression_level=self.level)
+
+    def to_record_batch(self, rows: Sequence):
+        """Convert rows to a record batch of the table schema"""
+        columns = [list(values) for values in zip(*rows)]
+        for i in self.decimal_columns:
+            columns[i] = [None if v is None else Decimal(v) for v in columns[i]]
+        for i in self.text_columns:
+            columns[i] = [None if v is None else str(v) for v in columns[i]]
+        arrays = [self.pa.array(values, type=field.type) for values, field in zip(columns, self.schema)]
+        return self.pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+
+class ArrowTableWriter(ParquetTableWriter):
+    """
+    Writes the rows of one table to an Arrow IPC file
+
+    The file is left uncompressed so that readers can memory-map it and get
+    record batches without copying or decoding them.
+    """
+
+    def __init__(self, path: str, columns: List[str], data_types: List[str]):
+        super().__init__(path, columns, data_types)
+
+    def close(self) -> int:
+        """Write the remaining rows, finish the file and return the number of rows written"""
+        self._flush()
+        if self.writer is None:
+            # A file with the schema and no batches
+            self.writer = self._open_writer()
+        self.writer.close()
+        return self.rows_written
+
+    def _open_writer(self):
+        return self.pa.ipc.new_file(self.path, self.schema)
+
+
+def read_arrow_batches(path: str) -> Iterator:
+    """Read the record batches of an Arrow IPC file through a memory map"""
+    pa, _ = import_pyarrow()
+    with pa.memory_map(path, 'r') as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+def record_batch_rows(batch) -> List[Tuple]:
+    """Convert a record batch to rows of Python values"""
+    return list(zip(*(column.to_pylist() for column in batch.columns)))
+
+
+def get_column_keys(column) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Integer keys of an Arrow column as an int64 array, without converting them to Python
+    Returns the keys (0 for NULL) and a boolean array of the non-NULL ones (None when no key is NULL)
+    """
+    valid = None
+    if column.null_count:
+        valid = column.is_valid().to_numpy(zero_copy_only=False)
+        column = column.fill_null(0)
+    return column.to_numpy(zero_copy_only=False).astype(np.int64, copy=False), valid
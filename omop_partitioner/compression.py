@@ -0,0 +1,202 @@
+"""
+Compressed output streams for OMOP SQL exports
+
+This module wraps the files written by the exporter in gzip or zstd compressors,
+so partition and schema files are compressed inline while they are generated.
+Multi-threaded compression uses pigz for gzip and the zstandard package (or the
+zstd command line tool) for zstd.
+
+Author: Narasimha Raghavan
+"""
+
+import io
+import os
+import gzip
+import shutil
+import logging
+import subprocess
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# File name suffix appended to .sql files for each compression method
+COMPRESSION_EXTENSIONS = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# Shell commands that decompress a file of each method to stdout
+DECOMPRESS_COMMANDS = {
+    'gzip': 'gzip -dc',
+    'zstd': 'zstd -dcq',
+}
+
+DEFAULT_COMPRESSION_LEVELS = {
+    'gzip': 6,
+    'zstd': 3,
+}
+
+# Buffer between the text layer and the compressor
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def get_compressed_path(path: str, compress: Optional[str]) -> str:
+    """Return the path with the suffix of the compression method appended"""
+    if compress not in COMPRESSION_EXTENSIONS:
+        raise ValueError(f"Unsupported compression method: {compress}")
+    return path + COMPRESSION_EXTENSIONS[compress]
+
+
+def get_compression_from_path(path: str) -> Optional[str]:
+    """Detect the compression method of a file from its name"""
+    for compress, extension in COMPRESSION_EXTENSIONS.items():
+        if compress and path.endswith(extension):
+            return compress
+    return None
+
+
+class _FileWriter(io.RawIOBase):
+    """Writes to a file object without closing it"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.fileobj.write(data)
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class _ProcessWriter(io.RawIOBase):
+    """Pipes written data through a compressor process whose output goes to a file object"""
+
+    def __init__(self, cmd, fileobj):
+        fileobj.flush()
+        self.cmd = cmd
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=fileobj)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.process.stdin.write(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.process.stdin.close()
+            if self.process.wait() != 0:
+                raise RuntimeError(f"{self.cmd[0]} exited with status {self.process.returncode}")
+        super().close()
+
+
+def open_binary_writer(fileobj, compress: Optional[str] = None, level: Optional[int] = None,
+                       threads: int = 1):
+    """
+    Open a binary stream that compresses into an open file object
+
+    Each stream produces one complete gzip member or zstd frame, so streams opened
+    one after the other on the same file concatenate into a valid compressed file.
+    Closing the stream finishes the member but leaves fileobj open.
+
+    Args:
+        fileobj: Binary file object the compressed data is written to
+        compress: Compression method ('gzip', 'zstd') or None for plain output
+        level: Compression level (default depends on the method)
+        threads: Number of compression threads
+    """
+    if compress is None:
+        return io.BufferedWriter(_FileWriter(fileobj), WRITE_BUFFER_SIZE)
+
+    if level is None:
+        level = DEFAULT_COMPRESSION_LEVELS[compress]
+
+    if compress == 'gzip':
+        if threads > 1 and shutil.which('pigz'):
+            raw = _ProcessWriter(['pigz', '-c', f'-{level}', '-p', str(threads)], fileobj)
+            return io.BufferedWriter(raw, WRITE_BUFFER_SIZE)
+        if threads > 1:
+            logger.warning("pigz not found on PATH, falling back to single-threaded gzip")
+        return io.BufferedWriter(gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=level),
+                                 WRITE_BUFFER_SIZE)
+
+    if compress == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            if not shutil.which('zstd'):
+                raise ImportError("zstd compression requires the 'zstandard' package "
+                                  "(pip install omop-partitioner[zstd]) or the zstd command line tool")
+            raw = _ProcessWriter(['zstd', '-q', '-c', f'-{level}', f'-T{threads}'], fileobj)
+            return io.BufferedWriter(raw, WRITE_BUFFER_SIZE)
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads if threads > 1 else 0)
+        return io.BufferedWriter(compressor.stream_writer(fileobj, closefd=False), WRITE_BUFFER_SIZE)
+
+    raise ValueError(f"Unsupported compression method: {compress}")
+
+
+def open_text_writer(fileobj, compress: Optional[str] = None, level: Optional[int] = None,
+                     threads: int = 1) -> io.TextIOWrapper:
+    """Open a text stream on top of open_binary_writer"""
+    return io.TextIOWrapper(open_binary_writer(fileobj, compress, level, threads), encoding='utf-8')
+
+
+class CompressedTextFile(io.TextIOWrapper):
+    """Text file written through a compressor; closing it closes the underlying file"""
+
+    def __init__(self, path: str, compress: Optional[str] = None, level: Optional[int] = None,
+                 threads: int = 1):
+        self.raw_file = open(path, 'wb')
+        super().__init__(open_binary_writer(self.raw_file, compress, level, threads), encoding='utf-8')
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.raw_file.close()
+
+
+class CompressedBinaryFile(io.BufferedWriter):
+    """Binary file written through a compressor; closing it closes the underlying file"""
+
+    def __init__(self, path: str, compress: Optional[str] = None, level: Optional[int] = None,
+                 threads: int = 1):
+        self.raw_file = open(path, 'wb')
+        writer = open_binary_writer(self.raw_file, compress, level, threads)
+        super().__init__(writer.detach(), WRITE_BUFFER_SIZE)
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.raw_file.close()
+
+
+def open_text_reader(path: str):
+    """Open a possibly compressed text file for reading, detecting the method from its name"""
+    compress = get_compression_from_path(path)
+    if compress is None:
+        return open(path, 'r', encoding='utf-8')
+    if compress == 'gzip':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    try:
+        import zstandard
+    except ImportError:
+        if not shutil.which('zstd'):
+            raise ImportError("Reading zstd files requires the 'zstandard' package or the zstd command line tool")
+        data = subprocess.run(['zstd', '-q', '-d', '-c', path], check=True, capture_output=True).stdout
+        return io.StringIO(data.decode('utf-8'))
+    # Exported files are concatenations of several frames
+    reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+    return io.TextIOWrapper(reader, encoding='utf-8')
+
+
+def get_default_threads() -> int:
+    """Number of compression threads used when none is configured"""
+    return os.cpu_count() or 1
@@ -2,37 +2,149 @@
 Distribution strategies for OMOP database partitioning
 
 This module provides various strategies for distributing data across partitions
-including uniform, hash-based, and round-robin distribution.
+including uniform, hash-based, and round-robin distribution. Besides copying data
+between databases, every strategy tells the SQL file exporter which partition a
+person belongs to: as a SQL predicate the source can evaluate during a filtered
+scan, and as a vectorized assignment for rows routed in the client.
 
 Author: Narasimha Raghavan
 """
 
 from abc import ABC, abstractmethod
-from typing import List, Dict, Set, Tuple
+import hashlib
+from typing import List, Dict, Optional, Set, Tuple
 import networkx as nx
-from sqlalchemy import create_engine, text, inspect
+from sqlalchemy import create_engine, text
 import logging
 import tempfile
 import os
+import numpy as np
+from .catalog import CatalogSnapshot
+from .assignment import (
+    NO_PARTITION, get_hash_partition_sql, hash_partitions, jump_partitions, mapped_partitions,
+    modulus_partitions, pack_partitions, range_partitions
+)
 
 logger = logging.getLogger(__name__)
 
+
+def get_person_map_digest(person_keys: np.ndarray, person_partitions: np.ndarray) -> str:
+    """SHA-256 of a person map (see DistributionStrategy.get_person_map), to check a restored one"""
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(person_keys, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(person_partitions, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
 class DistributionStrategy(ABC):
     """Base class for distribution strategies"""
     
-    def __init__(self, source_engine, partition_engines: List[tuple]):
+    # Name of the strategy on the command line (--strategy)
+    name = None
+    # Whether the assignment depends on the person IDs of the source, see prepare
+    uses_person_keys = False
+    # Whether get_partition_predicate gives a SQL condition (else rows are routed in the client)
+    has_partition_predicate = True
+    # Whether prepare builds an explicit person map, see get_person_map
+    has_person_map = False
+    
+    def __init__(self, source_engine, partition_engines: List[tuple], catalog: CatalogSnapshot = None):
         self.source_engine = source_engine
         self.partition_engines = partition_engines
         self.person_table = 'omopcdm.person'
         self.schema = 'omopcdm'
         # Will be set by concrete distribute_data to know FK graph
         self.dependency_graph = None
+        # Table metadata of the source schema, loaded on first use (see get_catalog)
+        self.catalog = catalog
     
     @abstractmethod
     def distribute_data(self, graph: nx.DiGraph) -> bool:
         """Distribute data across partitions"""
         pass
     
+    def get_partition_predicate(self, column: str, partition_index: int, num_partitions: int) -> Optional[str]:
+        """
+        SQL condition selecting the rows whose person, held in column, belongs to a partition
+        Returns None if the strategy can only assign rows in the client (see assign_partitions)
+        """
+        return f"({column} % {num_partitions}) = {partition_index}"
+    
+    def assign_partitions(self, keys: np.ndarray, num_partitions: int) -> np.ndarray:
+        """
+        Partition of every person key in an array, the same as get_partition_predicate
+        selects; keys of no partition get NO_PARTITION
+        """
+        return modulus_partitions(keys, num_partitions)
+    
+    def prepare(self, num_partitions: int, conn=None, staged_source=None):
+        """
+        Compute what the assignment depends on before any rows are exported, by
+        querying the source connection, or from the staged cache when the source is
+        one; only called for strategies that use the person IDs
+        """
+        pass
+    
+    @property
+    def is_prepared(self) -> bool:
+        """Whether the assignment can be made, from prepare or restored parameters"""
+        return True
+    
+    def _read_person_keys(self, conn=None, staged_source=None) -> np.ndarray:
+        """Read the person IDs of the source, or of the staged cache, as an int64 array"""
+        if staged_source is not None:
+            keys, _ = staged_source.read_keys(self.person_table, 'person_id')
+            return keys
+        result = conn.execute(text(f"SELECT person_id FROM {self.person_table}"))
+        return np.fromiter((row[0] for row in result), dtype=np.int64)
+    
+    def get_parameters(self) -> Dict:
+        """Parameters computed by prepare that fix the assignment, as recorded in the run manifest"""
+        return {}
+    
+    def set_parameters(self, parameters: Dict):
+        """Restore the parameters of a previous run instead of computing them again"""
+        pass
+    
+    def get_person_map(self) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Sorted person IDs and the partition of each, for strategies whose assignment is a
+        map built by prepare (None before it). The map depends on the data, so runs that
+        reuse the segments of another run must restore it instead of building it again.
+        """
+        return None
+    
+    def set_person_map(self, person_keys: np.ndarray, person_partitions: np.ndarray):
+        """Restore the person map of a previous run (see get_person_map)"""
+        raise ValueError(f"The {self.name} strategy has no person map")
+    
+    def _get_partition_select_query(self, table: str, partition_index: int, num_partitions: int) -> str:
+        """Query selecting the rows of a table whose person belongs to a partition"""
+        schema, table_name = table.split('.')
+        if table_name == 'episode_event':
+            return f"""
+                SELECT ee.*
+                FROM {schema}.{table_name} ee
+                JOIN {schema}.episode e ON ee.episode_id = e.episode_id
+                WHERE {self.get_partition_predicate('e.person_id', partition_index, num_partitions)}
+            """
+        if self._has_person_id_column(table):
+            return (f"SELECT * FROM {schema}.{table_name} "
+                    f"WHERE {self.get_partition_predicate('person_id', partition_index, num_partitions)}")
+        # Related through a foreign key but without a person of its own: copy in full
+        return f"SELECT * FROM {schema}.{table_name}"
+    
+    def _distribute_by_predicate(self, graph: nx.DiGraph):
+        """Copy the related tables to every partition, filtered on the source by the partition predicate"""
+        related_tables = self.get_related_tables(graph)
+        num_partitions = len(self.partition_engines)
+        for partition_index, engine in enumerate(self.partition_engines):
+            for table in related_tables:
+                select_query = self._get_partition_select_query(table, partition_index, num_partitions)
+                self._bulk_copy(table, select_query, engine)
+            
+            logger.info(f"Distributed data for partition {partition_index}")
+    
     def get_related_tables(self, graph: nx.DiGraph) -> List[str]:
         """
         Get all tables related to the person table through foreign key relationships
@@ -55,30 +167,28 @@ class DistributionStrategy(ABC):
             # If there's a cycle, fall back to simple list
             return list(related_nodes)
 
+    def get_catalog(self) -> CatalogSnapshot:
+        """Return the catalog snapshot of the source schema, loading it on first use"""
+        if self.catalog is None:
+            self.catalog = CatalogSnapshot.load(self.source_engine, self.schema)
+        return self.catalog
+
     def _has_person_id_column(self, table: str) -> bool:
         """Check if a table has a person_id column"""
-        schema, table_name = table.split('.')
-        with self.source_engine.connect() as conn:
-            result = conn.execute(text(f"""
-                SELECT EXISTS (
-                    SELECT 1 
-                    FROM information_schema.columns 
-                    WHERE table_schema = '{schema}'
-                    AND table_name = '{table_name}'
-                    AND column_name = 'person_id'
-                );
-            """))
-            return result.scalar()
+        return self.get_catalog().has_person_id_column(table)
 
-    def _bulk_copy(self, table: str, select_query: str, dest_engine):
-        """Perform COPY (select_query) TO / FROM between source and dest using temp file."""
+    def _bulk_copy(self, table: str, select_query: str, dest_engine, source_engine=None):
+        """
+        Perform COPY (select_query) TO / FROM between source and dest using temp file.
+        source_engine is the database the rows are read from (default: the source database).
+        """
         schema, table_name = table.split('.')
         tmp_file = tempfile.NamedTemporaryFile(delete=False)
         tmp_path = tmp_file.name
         tmp_file.close()
         
         # COPY out from source
-        src_conn = self.source_engine.raw_connection()
+        src_conn = (source_engine or self.source_engine).raw_connection()
         try:
             with open(tmp_path, 'wb') as out_f:
                 cur = src_conn.cursor()
@@ -172,16 +282,13 @@ class DistributionStrategy(ABC):
     # ---------------- helper for large lookup tables -----------------
     def _get_hash_column(self, table: str) -> str | None:
         """Return a column that can be used for hash-partitioning (concept_id or similar)."""
-        try:
-            schema, table_name = table.split('.')
-            insp = inspect(self.source_engine)
-            cols = insp.get_columns(table_name, schema=schema)
-            for col in cols:
-                if 'concept_id' in col['name']:
-                    return col['name']
-            return None
-        except Exception:
+        info = self.get_catalog().get_table(table)
+        if info is None:
             return None
+        for col in info.column_names:
+            if 'concept_id' in col:
+                return col
+        return None
 
     def _is_person_dependent(self, table: str) -> bool:
         """Check if a table is person-dependent."""
@@ -198,25 +305,14 @@ class DistributionStrategy(ABC):
             return False
             
         # Check if table has person_id column
-        with self.source_engine.connect() as conn:
-            has_person_id = conn.execute(text(f"""
-                SELECT EXISTS (
-                    SELECT 1 
-                    FROM information_schema.columns 
-                    WHERE table_schema = '{schema}'
-                    AND table_name = '{table_name}'
-                    AND column_name = 'person_id'
-                );
-            """)).scalar()
+        if self._has_person_id_column(table):
+            return True
             
-            if has_person_id:
-                return True
-                
-            # Check for indirect person dependency through episode
-            if table_name == 'episode_event':
-                return True
-                
-            return False
+        # Check for indirect person dependency through episode
+        if table_name == 'episode_event':
+            return True
+            
+        return False
 
     def distribute_table(self, table: str, total_rows: int):
         """Distribute a table's data across partitions."""
@@ -272,8 +368,10 @@ class DistributionStrategy(ABC):
 class UniformDistributionStrategy(DistributionStrategy):
     """Distributes data uniformly across partitions based on person_id ranges"""
     
-    def __init__(self, source_engine, partition_engines: List[tuple]):
-        super().__init__(source_engine, partition_engines)
+    name = 'uniform'
+    
+    def __init__(self, source_engine, partition_engines: List[tuple], catalog: CatalogSnapshot = None):
+        super().__init__(source_engine, partition_engines, catalog)
         self.num_partitions = len(partition_engines)
     
     def distribute_data(self, graph: nx.DiGraph) -> bool:
@@ -309,69 +407,380 @@ class UniformDistributionStrategy(DistributionStrategy):
 class HashDistributionStrategy(DistributionStrategy):
     """Distributes data using hash-based partitioning"""
     
+    name = 'hash'
+    
+    def get_partition_predicate(self, column: str, partition_index: int, num_partitions: int) -> Optional[str]:
+        return f"{get_hash_partition_sql(column, num_partitions)} = {partition_index}"
+    
+    def assign_partitions(self, keys: np.ndarray, num_partitions: int) -> np.ndarray:
+        return hash_partitions(keys, num_partitions)
+    
     def distribute_data(self, graph: nx.DiGraph) -> bool:
         """Distribute data using hash-based partitioning"""
         try:
-            related_tables = self.get_related_tables(graph)
-            num_partitions = len(self.partition_engines)
-            
-            # Get all person IDs
-            with self.source_engine.connect() as conn:
-                result = conn.execute(text(f"SELECT person_id FROM {self.person_table}"))
-                all_person_ids = [row[0] for row in result]
-            
-            # Distribute person IDs using hash
-            partition_person_ids = [[] for _ in range(num_partitions)]
-            for person_id in all_person_ids:
-                partition_index = hash(str(person_id)) % num_partitions
-                partition_person_ids[partition_index].append(person_id)
-            
-            # Copy data for each partition
-            for partition_index, person_ids in enumerate(partition_person_ids):
-                for table in related_tables:
-                    self._copy_table_data(table, person_ids, partition_index)
-                
-                logger.info(f"Distributed data for partition {partition_index}")
-            
+            # Persons are assigned by a stable hash that the source evaluates during
+            # each scan, so no person IDs are read into memory and every run (and the
+            # client-side hash_partitions) assigns them alike
+            self._distribute_by_predicate(graph)
             return True
             
         except Exception as e:
             logger.error(f"Error in hash distribution: {str(e)}")
             return False
+    
 
-class RoundRobinDistributionStrategy(DistributionStrategy):
-    """Distributes data using round-robin partitioning"""
+class ConsistentHashDistributionStrategy(DistributionStrategy):
+    """
+    Distributes data by jump consistent hashing of the stable hash of person_id
+    
+    Changing the partition count from N to N+1 moves only about 1/(N+1) of the
+    persons, all into the new partition, so existing partitions can be grown by
+    shipping the moved persons only (see SQLExporter.export_move_files).
+    """
+    
+    name = 'consistent_hash'
+    has_partition_predicate = False
+    
+    def get_partition_predicate(self, column: str, partition_index: int, num_partitions: int) -> Optional[str]:
+        # The jumps are a loop over 64-bit unsigned arithmetic with no SQL equivalent;
+        # rows are routed in the client instead
+        return None
+    
+    def assign_partitions(self, keys: np.ndarray, num_partitions: int) -> np.ndarray:
+        return jump_partitions(keys, num_partitions)
+    
+    def get_parameters(self) -> Dict:
+        # Recorded so that a later run only moves persons when it can reproduce the assignment
+        return {'algorithm': 'jump', 'key_hash': 'hashint8'}
     
     def distribute_data(self, graph: nx.DiGraph) -> bool:
-        """Distribute data using round-robin partitioning"""
+        """Consistent hash partitions route rows in the client, which only the SQL file export does"""
+        logger.error("The consistent_hash strategy is only supported by the SQL file export")
+        return False
+
+class RangeDistributionStrategy(DistributionStrategy):
+    """
+    Distributes data in contiguous person_id ranges of about the same number of persons
+    
+    The range predicates can use the person_id indexes of the clinical tables, and
+    every partition holds a contiguous block of their person_id order.
+    """
+    
+    name = 'range'
+    uses_person_keys = True
+    
+    # Ways of computing the boundaries: the planner's histogram of person.person_id
+    # (no scan, approximate), or ntile() over all persons (one scan, exact)
+    BOUNDARY_METHODS = ('histogram', 'ntile')
+    
+    def __init__(self, source_engine, partition_engines: List[tuple], catalog: CatalogSnapshot = None,
+                 boundary_method: str = 'histogram'):
+        super().__init__(source_engine, partition_engines, catalog)
+        if boundary_method not in self.BOUNDARY_METHODS:
+            raise ValueError(f"Unknown range boundary method: {boundary_method}")
+        self.boundary_method = boundary_method
+        # Lowest person_id of partitions 1 to N-1, ascending (see prepare)
+        self.boundaries = None
+    
+    def get_partition_predicate(self, column: str, partition_index: int, num_partitions: int) -> Optional[str]:
+        boundaries = self._get_boundaries(num_partitions)
+        if num_partitions == 1:
+            return f"{column} IS NOT NULL"
+        if partition_index == 0:
+            return f"{column} < {boundaries[0]}"
+        if partition_index == num_partitions - 1:
+            return f"{column} >= {boundaries[-1]}"
+        return f"{column} BETWEEN {boundaries[partition_index - 1]} AND {boundaries[partition_index] - 1}"
+    
+    def assign_partitions(self, keys: np.ndarray, num_partitions: int) -> np.ndarray:
+        return range_partitions(keys, self._get_boundaries(num_partitions))
+    
+    def _get_boundaries(self, num_partitions: int) -> List[int]:
+        if self.boundaries is None:
+            raise ValueError("Range assignment needs the person_id boundaries of the partitions (prepare)")
+        if len(self.boundaries) != num_partitions - 1:
+            raise ValueError(f"Range boundaries were computed for {len(self.boundaries) + 1} partitions, "
+                             f"not {num_partitions}")
+        return self.boundaries
+    
+    def prepare(self, num_partitions: int, conn=None, staged_source=None):
+        """Compute the boundaries that split the persons into num_partitions ranges"""
+        if staged_source is not None:
+            person_keys = np.unique(self._read_person_keys(staged_source=staged_source))
+            self.boundaries = self._get_key_boundaries(person_keys, num_partitions)
+        else:
+            self.boundaries = None
+            if self.boundary_method == 'histogram':
+                self.boundaries = self._get_histogram_boundaries(conn, num_partitions)
+            if self.boundaries is None:
+                self.boundaries = self._get_ntile_boundaries(conn, num_partitions)
+        logger.info(f"person_id boundaries of the {num_partitions} range partitions: {self.boundaries}")
+    
+    @property
+    def is_prepared(self) -> bool:
+        return self.boundaries is not None
+    
+    def get_parameters(self) -> Dict:
+        return {'boundaries': self.boundaries}
+    
+    def set_parameters(self, parameters: Dict):
+        self.boundaries = parameters.get('boundaries')
+    
+    def _get_key_boundaries(self, person_keys: np.ndarray, num_partitions: int) -> List[int]:
+        """Boundaries of sorted, distinct person IDs split as ntile() splits them"""
+        count = len(person_keys)
+        # ntile() gives the first count % N groups one extra row
+        starts = [k * (count // num_partitions) + min(k, count % num_partitions) for k in range(1, num_partitions)]
+        boundaries = [int(person_keys[start]) for start in starts if start < count]
+        end = int(person_keys[-1]) + 1 if count else 0
+        return self._pad_boundaries(boundaries, num_partitions, end)
+    
+    def _get_histogram_boundaries(self, conn, num_partitions: int) -> Optional[List[int]]:
+        """
+        Boundaries from the equal-frequency histogram ANALYZE keeps of person.person_id,
+        or None if there is none or it has fewer buckets than partitions
+        """
+        schema, table_name = self.person_table.split('.')
+        bounds = conn.execute(text("""
+            SELECT histogram_bounds::text::bigint[]
+            FROM pg_stats
+            WHERE schemaname = :schema AND tablename = :table_name AND attname = 'person_id'
+        """), {'schema': schema, 'table_name': table_name}).scalar()
+        if not bounds or len(bounds) <= num_partitions:
+            logger.info(f"No usable histogram of {self.person_table}.person_id in pg_stats, using ntile")
+            return None
+        # The histogram's bounds split the persons into len(bounds) - 1 buckets of equal size
+        buckets = len(bounds) - 1
+        return [int(bounds[round(k * buckets / num_partitions)]) for k in range(1, num_partitions)]
+    
+    def _get_ntile_boundaries(self, conn, num_partitions: int) -> List[int]:
+        """Boundaries of num_partitions groups of persons of (nearly) equal size, in one scan of person"""
+        result = conn.execute(text(f"""
+            SELECT MIN(person_id), MAX(person_id)
+            FROM (
+                SELECT person_id, ntile({num_partitions}) OVER (ORDER BY person_id) AS part
+                FROM {self.person_table}
+            ) p
+            GROUP BY part
+            ORDER BY part
+        """)).fetchall()
+        boundaries = [int(row[0]) for row in result[1:]]
+        end = int(result[-1][1]) + 1 if result else 0
+        return self._pad_boundaries(boundaries, num_partitions, end)
+    
+    def _pad_boundaries(self, boundaries: List[int], num_partitions: int, end: int) -> List[int]:
+        """
+        Complete boundaries with empty ranges above all persons when there are fewer
+        groups than partitions (equal boundaries leave the partitions between them empty)
+        """
+        return boundaries + [end] * (num_partitions - 1 - len(boundaries))
+    
+    def distribute_data(self, graph: nx.DiGraph) -> bool:
+        """Distribute data in person_id ranges"""
         try:
-            related_tables = self.get_related_tables(graph)
-            num_partitions = len(self.partition_engines)
-            
-            # Get all person IDs
             with self.source_engine.connect() as conn:
-                result = conn.execute(text(f"SELECT person_id FROM {self.person_table}"))
-                all_person_ids = [row[0] for row in result]
-            
-            # Distribute person IDs using round-robin
-            partition_person_ids = [[] for _ in range(num_partitions)]
-            for i, person_id in enumerate(all_person_ids):
-                partition_index = i % num_partitions
-                partition_person_ids[partition_index].append(person_id)
-            
-            # Copy data for each partition
-            for partition_index, person_ids in enumerate(partition_person_ids):
-                for table in related_tables:
-                    self._copy_table_data(table, person_ids, partition_index)
-                
-                logger.info(f"Distributed data for partition {partition_index}")
-            
+                self.prepare(len(self.partition_engines), conn)
+            self._distribute_by_predicate(graph)
             return True
-            
         except Exception as e:
-            logger.error(f"Error in round-robin distribution: {str(e)}")
+            logger.error(f"Error in range distribution: {str(e)}")
             return False
 
+class WeightedDistributionStrategy(DistributionStrategy):
+    """
+    Distributes persons so that every partition holds about the same volume of data
+    
+    The estimated bytes of every person across the person-dependent tables are
+    computed in one aggregated query, and the persons are packed into the partitions
+    heaviest first (see pack_partitions), so a few persons with very many events do
+    not make one partition much larger than the others.
+    """
+    
+    name = 'weighted'
+    uses_person_keys = True
+    has_partition_predicate = False
+    has_person_map = True
+    
+    def __init__(self, source_engine, partition_engines: List[tuple], catalog: CatalogSnapshot = None):
+        super().__init__(source_engine, partition_engines, catalog)
+        # Sorted person IDs and the partition each was packed into (see prepare)
+        self.person_keys = None
+        self.person_partitions = None
+        # Estimated rows and bytes packed into every partition
+        self.partition_rows = None
+        self.partition_bytes = None
+    
+    def get_partition_predicate(self, column: str, partition_index: int, num_partitions: int) -> Optional[str]:
+        # An arbitrary person map cannot be answered by an index; rows are routed in the client
+        return None
+    
+    def assign_partitions(self, keys: np.ndarray, num_partitions: int) -> np.ndarray:
+        """Partition of every key from the person map; persons added since it was built fall back to modulus"""
+        if self.person_keys is None:
+            raise ValueError("Weighted assignment needs the person map of the source (prepare)")
+        parts = mapped_partitions(keys, self.person_keys, self.person_partitions)
+        unmapped = parts == NO_PARTITION
+        if unmapped.any():
+            parts[unmapped] = modulus_partitions(keys[unmapped], num_partitions)
+        return parts
+    
+    @property
+    def is_prepared(self) -> bool:
+        return self.person_keys is not None
+    
+    def prepare(self, num_partitions: int, conn=None, staged_source=None):
+        """Weigh every person by its estimated bytes and pack the persons into the partitions"""
+        widths = self._get_person_table_widths()
+        if staged_source is not None:
+            person_keys, rows, weights = self._get_staged_weights(staged_source, widths)
+        else:
+            person_keys, rows, weights = self._get_source_weights(conn, widths)
+        
+        parts = pack_partitions(weights, num_partitions)
+        self.person_keys = person_keys
+        self.person_partitions = parts
+        self.partition_rows = np.bincount(parts, weights=rows, minlength=num_partitions).astype(np.int64).tolist()
+        self.partition_bytes = np.bincount(parts, weights=weights, minlength=num_partitions).astype(np.int64).tolist()
+        logger.info(f"Packed {len(person_keys)} persons into {num_partitions} partitions: "
+                    f"{min(self.partition_rows, default=0)}-{max(self.partition_rows, default=0)} rows, "
+                    f"{min(self.partition_bytes, default=0)}-{max(self.partition_bytes, default=0)} "
+                    f"estimated bytes per partition")
+    
+    def get_parameters(self) -> Dict:
+        # The person map itself is too large for the manifest; only its digest is recorded
+        person_map = None
+        if self.person_keys is not None:
+            person_map = get_person_map_digest(self.person_keys, self.person_partitions)
+        return {'partition_rows': self.partition_rows, 'partition_bytes': self.partition_bytes,
+                'person_map': person_map}
+    
+    def set_parameters(self, parameters: Dict):
+        self.partition_rows = parameters.get('partition_rows')
+        self.partition_bytes = parameters.get('partition_bytes')
+    
+    def get_person_map(self) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        if self.person_keys is None:
+            return None
+        return self.person_keys, self.person_partitions
+    
+    def set_person_map(self, person_keys: np.ndarray, person_partitions: np.ndarray):
+        self.person_keys = person_keys
+        self.person_partitions = person_partitions
+    
+    def _get_person_table_widths(self) -> Dict[str, float]:
+        """Estimated row width of every table with a person_id column (at least 1 byte)"""
+        catalog = self.get_catalog()
+        return {
+            f"{catalog.schema}.{name}": max(info.estimate_row_width(), 1.0)
+            for name, info in sorted(catalog.tables.items()) if info.has_person_id
+        }
+    
+    def _get_source_weights(self, conn, widths: Dict[str, float]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Rows and estimated bytes of every person, aggregated over all person tables in one query"""
+        counts = " UNION ALL ".join(
+            f"SELECT person_id, COUNT(*) AS n, COUNT(*) * {width} AS b FROM {table} GROUP BY person_id"
+            for table, width in widths.items()
+        )
+        result = conn.execute(text(f"""
+            SELECT person_id, SUM(n), SUM(b)
+            FROM ({counts}) w
+            WHERE person_id IS NOT NULL
+            GROUP BY person_id
+            ORDER BY person_id
+        """))
+        person_keys, rows, weights = [], [], []
+        for person_id, n, b in result:
+            person_keys.append(person_id)
+            rows.append(n)
+            weights.append(b)
+        return (np.array(person_keys, dtype=np.int64), np.array(rows, dtype=np.float64),
+                np.array(weights, dtype=np.float64))
+    
+    def _get_staged_weights(self, staged_source, widths: Dict[str, float]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Rows and estimated bytes of every person, counted from the person_id columns of the cache
+        one table at a time, so memory grows with the number of persons, not of rows
+        """
+        person_keys = np.empty(0, dtype=np.int64)
+        rows = np.empty(0, dtype=np.float64)
+        weights = np.empty(0, dtype=np.float64)
+        for table, width in widths.items():
+            table_keys, valid = staged_source.read_keys(table, 'person_id')
+            if valid is not None:
+                table_keys = table_keys[valid]
+            table_persons, counts = np.unique(table_keys, return_counts=True)
+            # Add the table's counts to those of the persons seen so far
+            merged = np.union1d(person_keys, table_persons)
+            previous, current = np.searchsorted(merged, person_keys), np.searchsorted(merged, table_persons)
+            merged_rows = np.zeros(len(merged), dtype=np.float64)
+            merged_weights = np.zeros(len(merged), dtype=np.float64)
+            merged_rows[previous] = rows
+            merged_weights[previous] = weights
+            merged_rows[current] += counts
+            merged_weights[current] += counts * width
+            person_keys, rows, weights = merged, merged_rows, merged_weights
+        return person_keys, rows, weights
+    
+    def distribute_data(self, graph: nx.DiGraph) -> bool:
+        """Weighted partitions route rows in the client, which only the SQL file export does"""
+        logger.error("The weighted strategy is only supported by the SQL file export")
+        return False
+
+class RoundRobinDistributionStrategy(DistributionStrategy):
+    """Distributes data using round-robin partitioning"""
+    
+    name = 'round_robin'
+    uses_person_keys = True
+    has_partition_predicate = False
+    has_person_map = True
+    
+    def __init__(self, source_engine, partition_engines: List[tuple], catalog: CatalogSnapshot = None):
+        super().__init__(source_engine, partition_engines, catalog)
+        # Sorted person IDs and the partition of each, by rank (see prepare)
+        self.person_keys = None
+        self.person_partitions = None
+    
+    def get_partition_predicate(self, column: str, partition_index: int, num_partitions: int) -> Optional[str]:
+        # The partition of a person depends on its rank among all persons, which no
+        # index can answer; rows are routed in the client instead
+        return None
+    
+    def assign_partitions(self, keys: np.ndarray, num_partitions: int) -> np.ndarray:
+        """
+        Partition of every key from the person map; keys it does not hold (persons added
+        since it was built, or rows whose person is missing from person) fall back to modulus
+        """
+        if self.person_keys is None:
+            raise ValueError("Round-robin assignment needs the person IDs of the source (prepare)")
+        parts = mapped_partitions(keys, self.person_keys, self.person_partitions)
+        unmapped = parts == NO_PARTITION
+        if unmapped.any():
+            parts[unmapped] = modulus_partitions(keys[unmapped], num_partitions)
+        return parts
+    
+    def prepare(self, num_partitions: int, conn=None, staged_source=None):
+        """Deal the persons out to the partitions in person_id order"""
+        self.person_keys = np.unique(self._read_person_keys(conn, staged_source))
+        self.person_partitions = np.arange(len(self.person_keys), dtype=np.int64) % num_partitions
+    
+    @property
+    def is_prepared(self) -> bool:
+        return self.person_keys is not None
+    
+    def get_parameters(self) -> Dict:
+        if self.person_keys is None:
+            return {'person_map': None}
+        return {'person_map': get_person_map_digest(self.person_keys, self.person_partitions)}
+    
+    def get_person_map(self) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        if self.person_keys is None:
+            return None
+        return self.person_keys, self.person_partitions
+    
+    def set_person_map(self, person_keys: np.ndarray, person_partitions: np.ndarray):
+        self.person_keys = person_keys
+        self.person_partitions = person_partitions
+    
     def distribute_data(self, graph: nx.DiGraph) -> bool:
         """Distribute data across partitions based on the strategy."""
         try:
@@ -407,4 +816,22 @@ class RoundRobinDistributionStrategy(DistributionStrategy):
             return True
         except Exception as e:
             logging.error(f"Error in {self.__class__.__name__} distribution: {str(e)}")
-            return False 
\ No newline at end of file
+            return False
+
+# Strategies by name, as selected with --strategy
+DISTRIBUTION_STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (UniformDistributionStrategy, HashDistributionStrategy, ConsistentHashDistributionStrategy,
+                     RangeDistributionStrategy, WeightedDistributionStrategy, RoundRobinDistributionStrategy)
+}
+
+
+def create_distribution_strategy(name: str, source_engine=None, partition_engines: List[tuple] = None,
+                                 catalog: CatalogSnapshot = None, **options) -> DistributionStrategy:
+    """
+    Create a strategy by name, with the options of its constructor (e.g. boundary_method
+    of the range strategy); the engines are only needed to distribute between databases
+    """
+    if name not in DISTRIBUTION_STRATEGIES:
+        raise ValueError(f"Unknown distribution strategy: {name}")
+    return DISTRIBUTION_STRATEGIES[name](source_engine, partition_engines or [], catalog, **options)
@@ -0,0 +1,128 @@
+"""
+Run manifest for OMOP SQL exports
+
+This module records what an export run produced in a JSON file next to the
+partition files: the source database, the partition count, the parameters the
+distribution strategy assigned persons with (e.g. range boundaries) and the
+change watermarks captured when the run started, from which the next run can
+export only the rows that changed since. While the run is in progress it also serves
+as a checkpoint: every finished segment is recorded with its row count, size
+and checksum, so an interrupted run can be resumed.
+
+Author: Narasimha Raghavan
+"""
+
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Person map of strategies that build one (weighted, round_robin), saved next to the
+# manifest, which records its digest
+PERSON_MAP_FILE_NAME = "person_map.npz"
+
+# Watermark column meaning the system column xmin of each row
+XMIN_WATERMARK = 'xmin'
+
+
+def file_checksum(path: str) -> str:
+    """SHA-256 of a file's contents as a hex string"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RunManifest:
+    """Metadata and watermarks of one export run"""
+
+    def __init__(self, path: str, source_database: str = None, num_partitions: int = None,
+                 mode: str = 'full'):
+        self.path = path
+        self.source_database = source_database
+        self.num_partitions = num_partitions
+        # 'full', 'delta' or 'moves'
+        self.mode = mode
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.completed_at = None
+        # Oldest transaction still running when the run started (64-bit txid)
+        self.xmin = None
+        # Per table: {'column': watermark column or 'xmin', 'value': highest value seen}
+        self.watermarks = {}
+        # Exporter settings that determine the contents of the segments
+        self.settings = {}
+        # Parameters the distribution strategy assigned persons with, e.g. range boundaries
+        self.distribution = {}
+        # Per segment path: table, partition, rows, bytes and sha256 of a finished segment
+        self.segments = {}
+
+    @classmethod
+    def load(cls, path: str) -> 'RunManifest':
+        """Load a manifest written by a previous run"""
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if data.get('version') != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported manifest version in {path}: {data.get('version')}")
+
+        manifest = cls(path, data.get('source_database'), data.get('num_partitions'), data.get('mode', 'full'))
+        manifest.started_at = data.get('started_at')
+        manifest.completed_at = data.get('completed_at')
+        manifest.xmin = data.get('xmin')
+        manifest.watermarks = data.get('watermarks', {})
+        manifest.settings = data.get('settings', {})
+        manifest.distribution = data.get('distribution', {})
+        manifest.segments = data.get('segments', {})
+        return manifest
+
+    def to_dict(self) -> Dict:
+        return {
+            'version': MANIFEST_VERSION,
+            'source_database': self.source_database,
+            'num_partitions': self.num_partitions,
+            'mode': self.mode,
+            'started_at': self.started_at,
+            'completed_at': self.completed_at,
+            'xmin': self.xmin,
+            'watermarks': self.watermarks,
+            'settings': self.settings,
+            'distribution': self.distribution,
+            'segments': self.segments,
+        }
+
+    def save(self):
+        """Write the manifest atomically, so an interrupted run never leaves a partial file"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def mark_completed(self):
+        self.completed_at = datetime.now(timezone.utc).isoformat()
+
+    @property
+    def is_completed(self) -> bool:
+        return self.completed_at is not None
+
+    def get_watermark(self, table: str) -> Optional[Dict]:
+        return self.watermarks.get(table)
+
+    def record_segment(self, segment: str, table: str, partition: int, rows: int, size: int, sha256: str):
+        """Record a finished segment; call save() to checkpoint it"""
+        self.segments[segment] = {
+            'table': table,
+            'partition': partition,
+            'rows': rows,
+            'bytes': size,
+            'sha256': sha256,
+        }
+
+    def get_segment(self, segment: str) -> Optional[Dict]:
+        return self.segments.get(segment)
@@ -0,0 +1,271 @@
+"""
+Routing of OMOP tables without a person_id column
+
+Rows of tables such as episode_event, note_nlp, cost, cohort and fact_relationship
+belong to a person through the key of another row: the episode an episode_event
+row is part of, the note a note_nlp row annotates, the drug exposure or visit a
+cost row is for, the person a cohort row is about. This
+module describes these links, derives them from the foreign keys of the source
+and from rules for keys that no constraint declares (such as the polymorphic
+event ids of cost and fact_relationship), and computes the partition of the rows,
+as a SQL condition or from key→partition maps of the parent tables, so that these
+tables are split with their persons instead of being copied to every partition.
+The maps are sorted key arrays searched by bisection, built once per run, so a
+child table is routed in one scan whatever the number of partitions.
+
+A row belongs to the parent of the first of its table's links that applies to it:
+links without a domain column always apply, the others only to rows whose domain
+names a table with persons. Rows of no person (no link applies, or the key is
+NULL) are copied to every partition; rows whose parent does not exist are
+dropped, like the rows of a join.
+
+Author: Narasimha Raghavan
+"""
+
+import json
+import logging
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from .assignment import ALL_PARTITIONS
+from .catalog import CatalogSnapshot
+
+logger = logging.getLogger(__name__)
+
+# Table holding the rows of each OMOP domain, for keys whose table is named by a domain column
+DOMAIN_TABLES = {
+    'Condition': 'condition_occurrence',
+    'Device': 'device_exposure',
+    'Drug': 'drug_exposure',
+    'Episode': 'episode',
+    'Measurement': 'measurement',
+    'Note': 'note',
+    'Observation': 'observation',
+    'Person': 'person',
+    'Procedure': 'procedure_occurrence',
+    'Specimen': 'specimen',
+    'Visit': 'visit_occurrence',
+}
+
+# Links of the standard CDM tables whose keys are not declared as foreign keys, in
+# the format of a --routing-rules file: table -> links, tried in order
+DEFAULT_LINK_RULES = {
+    'episode_event': [{'column': 'episode_id', 'parent': 'episode'}],
+    'note_nlp': [{'column': 'note_id', 'parent': 'note'}],
+    'cohort': [{'column': 'subject_id', 'parent': 'person'}],
+    'cost': [{'column': 'cost_event_id', 'domain_column': 'cost_domain_id'}],
+    'fact_relationship': [
+        {'column': 'fact_id_1', 'domain_column': 'domain_concept_id_1', 'domain_concepts': True},
+        {'column': 'fact_id_2', 'domain_column': 'domain_concept_id_2', 'domain_concepts': True},
+    ],
+}
+
+
+class TableLink:
+    """
+    A column of a table holding the key of the row its rows belong to: a row of a
+    fixed parent table, or, with a domain column, of the table of the row's domain
+    """
+
+    def __init__(self, column: str, parent: str = None, domain_column: str = None,
+                 domains: Dict[str, str] = None, domain_concepts: bool = False):
+        self.column = column
+        # Parent table; 'person' when the column holds the person_id itself
+        self.parent = parent
+        # Column naming the domain of the key, by domain_id or, with domain_concepts,
+        # by domain_concept_id; domains maps domain_id to the table of the domain
+        self.domain_column = domain_column
+        self.domains = dict(DOMAIN_TABLES if domains is None else domains) if domain_column else {}
+        self.domain_concepts = domain_concepts
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'TableLink':
+        if 'column' not in data or ('parent' in data) == ('domain_column' in data):
+            raise ValueError(f"A routing rule needs a column and either a parent or a domain_column: {data}")
+        return cls(data['column'], data.get('parent'), data.get('domain_column'), data.get('domains'),
+                   data.get('domain_concepts', False))
+
+    def to_dict(self) -> Dict:
+        if self.domain_column is None:
+            return {'column': self.column, 'parent': self.parent}
+        return {'column': self.column, 'domain_column': self.domain_column, 'domains': self.domains,
+                'domain_concepts': self.domain_concepts}
+
+    def __repr__(self) -> str:
+        return f"TableLink({self.to_dict()!r})"
+
+
+def load_link_rules(path: str = None) -> Dict[str, List[TableLink]]:
+    """
+    Links of the tables with routing rules: the defaults, with the tables of a JSON
+    rules file ({table: [link, ...]}) replacing theirs; an empty list copies a table
+    in full to every partition
+    """
+    rules = dict(DEFAULT_LINK_RULES)
+    if path:
+        with open(path, 'r') as f:
+            rules.update(json.load(f))
+        logger.info(f"Loaded routing rules from {path}")
+    return {table: [TableLink.from_dict(link) for link in links] for table, links in rules.items()}
+
+
+def get_parent_key(catalog: CatalogSnapshot, table: str, column: str = None) -> Optional[str]:
+    """
+    Key column of a table rows can be linked to, if it has persons: its single-column
+    primary key or, without one, the column of the same name as the linking column
+    """
+    info = catalog.get_table(table)
+    if info is None or not info.has_person_id:
+        return None
+    if len(info.primary_key) == 1:
+        return info.primary_key[0]
+    return column if column is not None and column in info.column_names else None
+
+
+def derive_table_links(graph, catalog: CatalogSnapshot, tables: Sequence[str],
+                       rules: Dict[str, List[TableLink]]) -> Dict[str, List[TableLink]]:
+    """
+    Links of the tables that have rows of persons without a person_id column: from
+    the routing rules, or else from a foreign key of the table to the primary key of
+    a table with persons (see analyze_schema for the columns of the graph's edges)
+    Returns the links of every table that has some, by table
+    """
+    table_links = {}
+    for table in tables:
+        table_name = table.split('.')[1]
+        if table_name in rules:
+            links = [link for link in rules[table_name] if catalog.has_column(table, link.column)]
+        else:
+            links = []
+            for parent in sorted(graph.predecessors(table)) if table in graph else ():
+                parent_key = get_parent_key(catalog, parent)
+                for column, parent_column in graph[parent][table].get('columns', ()):
+                    if parent_column == parent_key:
+                        links.append(TableLink(column, parent.split('.')[1]))
+                        break
+                if links:
+                    break
+        if links:
+            table_links[table] = links
+    return table_links
+
+
+def get_sql_literal(value) -> str:
+    """SQL literal of a domain value"""
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+class LinkRouter:
+    """
+    Computes which partition the rows of one linked table belong to: as SQL
+    conditions for the queries of a partition or of given persons, or from
+    key→partition maps of the parent tables for rows routed in the client
+    """
+
+    def __init__(self, table: str, links: List[TableLink], catalog: CatalogSnapshot,
+                 domain_concepts: Dict[str, int] = None):
+        schema = table.split('.')[0]
+        self.table = table
+        self.person_table = f"{schema}.person"
+        # Per link: (key column, domain column or None, [(domain value or None, parent table)])
+        self.routes = []
+        # Key column of every parent table
+        self.parent_keys = {}
+        for link in links:
+            # A fixed parent may be linked by a key of the same name when it declares none
+            key_column = None
+            if link.domain_column is None:
+                candidates = [(None, link.parent)]
+                key_column = link.column
+            elif link.domain_concepts:
+                candidates = [(domain_concepts[d], t) for d, t in sorted(link.domains.items())
+                              if d in (domain_concepts or {})]
+            else:
+                candidates = sorted(link.domains.items())
+            parents = []
+            for value, parent in candidates:
+                parent_key = get_parent_key(catalog, f"{schema}.{parent}", key_column)
+                if parent_key is not None:
+                    parents.append((value, f"{schema}.{parent}"))
+                    self.parent_keys[f"{schema}.{parent}"] = parent_key
+            if parents:
+                self.routes.append((link.column, link.domain_column, parents))
+        self.links = links
+
+    @property
+    def parents(self) -> List[str]:
+        """Tables the rows are routed through"""
+        return sorted(self.parent_keys)
+
+    def get_owner_condition(self, get_person_condition: Callable[[str], str]) -> str:
+        """
+        SQL condition selecting the rows of the persons that get_person_condition(column)
+        selects from a person_id column
+        """
+        terms, applied = [], []
+        for column, domain_column, parents in self.routes:
+            for value, parent in parents:
+                term = self._get_parent_condition(column, parent, get_person_condition)
+                if domain_column is not None:
+                    term = f"{domain_column} = {get_sql_literal(value)} AND {term}"
+                if applied:
+                    term = f"NOT ({' OR '.join(applied)}) AND {term}"
+                terms.append(f"({term})")
+            applied.append(self._get_applies_condition(domain_column, parents))
+        return ' OR '.join(terms) or 'FALSE'
+
+    def get_shared_condition(self) -> str:
+        """SQL condition selecting the rows of no person, which every partition gets"""
+        terms, applied = [], []
+        for column, domain_column, parents in self.routes:
+            conditions = [f"NOT ({' OR '.join(applied)})"] if applied else []
+            conditions += [self._get_applies_condition(domain_column, parents), f"{column} IS NULL"]
+            terms.append(f"({' AND '.join(conditions)})")
+            applied.append(self._get_applies_condition(domain_column, parents))
+        terms.append(f"NOT ({' OR '.join(applied)})" if applied else 'TRUE')
+        return ' OR '.join(terms)
+
+    def _get_parent_condition(self, column: str, parent: str, get_person_condition: Callable[[str], str]) -> str:
+        if parent == self.person_table:
+            return get_person_condition(column)
+        return (f"{column} IN (SELECT {self.parent_keys[parent]} FROM {parent} "
+                f"WHERE {get_person_condition('person_id')})")
+
+    def _get_applies_condition(self, domain_column: Optional[str], parents: List[Tuple]) -> str:
+        if domain_column is None:
+            return 'TRUE'
+        values = ', '.join(get_sql_literal(value) for value, _ in parents)
+        return f"COALESCE({domain_column} IN ({values}), FALSE)"
+
+    def assign_partitions(self, num_rows: int, get_keys: Callable, get_values: Callable,
+                          get_parent_partitions: Callable[[str, np.ndarray], np.ndarray]) -> np.ndarray:
+        """
+        Partition of every row of a batch, ALL_PARTITIONS for the rows of no person
+
+        Args:
+            num_rows: Number of rows in the batch
+            get_keys: Returns the integer keys of a column of the batch and a boolean
+                array of the non-NULL ones (None when no key is NULL), see get_batch_keys
+            get_values: Returns the values of a domain column of the batch as an array
+            get_parent_partitions: Returns the partitions of keys of a parent table,
+                NO_PARTITION for keys it does not have
+        """
+        parts = np.full(num_rows, ALL_PARTITIONS, dtype=np.int64)
+        undecided = np.ones(num_rows, dtype=bool)
+        for column, domain_column, parents in self.routes:
+            keys, valid = get_keys(column)
+            values = get_values(domain_column) if domain_column is not None else None
+            for value, parent in parents:
+                applies = undecided if values is None else undecided & (values == value)
+                owned = applies if valid is None else applies & valid
+                if owned.any():
+                    parts[owned] = get_parent_partitions(parent, keys[owned])
+                undecided = undecided & ~applies
+            if not undecided.any():
+                break
+        return parts
+
+    def to_dict(self) -> Dict:
+        """Links the rows are routed by, for fingerprints of the exported data"""
+        return {'links': [link.to_dict() for link in self.links], 'parents': self.parents}
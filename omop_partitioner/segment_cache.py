@@ -0,0 +1,88 @@
+"""
+Segment cache for incremental OMOP SQL exports
+
+This module remembers which segment files were written for each table together
+with a change fingerprint of the table, so that a later export can reuse the
+segments of tables that have not changed instead of querying them again. The
+manifest entries of the segments (rows, bytes, checksum) are kept alongside, so
+the manifest of a run that reuses them still describes every segment.
+
+Author: Narasimha Raghavan
+"""
+
+import os
+import json
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE_NAME = "cache.json"
+CACHE_VERSION = 2
+
+
+class SegmentCache:
+    """Per-table fingerprints and segment files of previous exports, stored as JSON"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+
+    @classmethod
+    def load(cls, path: str) -> 'SegmentCache':
+        """Load the cache from path, starting empty if it does not exist or cannot be read"""
+        cache = cls(path)
+        if not os.path.exists(path):
+            return cache
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable segment cache {path}: {e}")
+            return cache
+        if data.get('version') != CACHE_VERSION:
+            logger.info(f"Ignoring segment cache {path} from another version")
+            return cache
+        cache.entries = data.get('tables', {})
+        logger.info(f"Loaded segment cache with {len(cache.entries)} tables")
+        return cache
+
+    def save(self):
+        """Write the cache atomically, so an interrupted run never leaves a partial file"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'tables': self.entries}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get_segments(self, table: str, fingerprint: Dict, segment_files: List[str]) -> Optional[List[str]]:
+        """
+        Return the cached segment files of a table if its fingerprint is unchanged and
+        the cached files are the ones expected and still exist, otherwise None
+        """
+        entry = self.entries.get(table)
+        if entry is None or entry['fingerprint'] != fingerprint or entry['files'] != segment_files:
+            return None
+        if not all(os.path.exists(segment_file) for segment_file in segment_files):
+            return None
+        return entry['files']
+
+    def get_stats(self, table: str) -> Dict[str, Dict]:
+        """Manifest entries of the cached segments of a table, by manifest key"""
+        return self.entries[table]['segments']
+
+    def invalidate(self, table: str):
+        """Forget a table, before its segments are overwritten"""
+        self.entries.pop(table, None)
+
+    def update(self, table: str, fingerprint: Dict, segment_files: List[str], stats: Dict[str, Dict]):
+        """Record the segments freshly exported for a table with their manifest entries"""
+        self.entries[table] = {'fingerprint': fingerprint, 'files': list(segment_files), 'segments': stats}
+
+    def prune(self, tables) -> List[str]:
+        """Drop the tables that are no longer exported and delete their segment files"""
+        removed = [table for table in self.entries if table not in tables]
+        for table in removed:
+            for segment_file in self.entries.pop(table)['files']:
+                if os.path.exists(segment_file):
+                    os.remove(segment_file)
+        return removed
@@ -1,6 +1,6 @@
 
 #!/usr/bin/env python3
-# Spin up one Postgres container per provided dump (.sql or .sql.gz),
+# Spin up one Postgres container per provided dump (.sql, .sql.gz or .sql.zst),
 # auto-run the dump via /docker-entrypoint-initdb.d or stream it in,
 # tune Postgres for faster imports, and verify basic schema/data.
 # AUTO-RETRY on host port conflicts.
@@ -8,19 +8,30 @@
 # Usage:
 #   python spin_and_import.py /abs/path/part1.sql.gz /abs/path/part2.sql.gz ...
 #
+# With a shared vocabulary export, the vocabulary is loaded once into a template
+# volume that is cloned for every partition container:
+#   python spin_and_import.py --vocabulary /abs/path/vocabulary.sql.gz /abs/path/part1.sql.gz ...
+#
+# Partition files exported with --format binary-copy load their data files with
+# psql \copy; the data files are copied (decompressed) next to the init script and
+# the \copy paths rewritten to them, so keep the segment directories next to the
+# partition files.
+#
 # Env overrides (optional):
 #   PG_IMAGE=postgres:17 DB_NAME=omop PG_USER=postgres START_PORT=5433 PASS_PREFIX=secret RECREATE=true
 
 # Author: Narasimha Raghavan 
 import argparse
+import gzip
 import os
+import re
 import shlex
 import subprocess
 import sys
 import time
 import socket
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 import shutil
 
 DEFAULTS = {
@@ -58,6 +69,8 @@ def sanitize_name(path: Path) -> str:
     base = path.name.lower()
     if base.endswith(".sql.gz"):
         base = base[:-7]
+    elif base.endswith(".sql.zst"):
+        base = base[:-8]
     elif base.endswith(".sql"):
         base = base[:-4]
     safe = []
@@ -97,15 +110,169 @@ def wait_ready(container: str, user: str, db: str, timeout: int) -> None:
             time.sleep(2)
     sys.exit(f"ERROR: Timeout waiting for {container} to become ready")
 
-def import_stream(container: str, file_in_container: str, is_gzip: bool, user: str, db: str):
-    """Stream a dump into psql (gunzip if needed)."""
-    if is_gzip:
+def dump_compression(path: Path) -> str:
+    """Return the compression of a dump from its name: 'gzip', 'zstd' or '' for plain SQL."""
+    name = path.name.lower()
+    if name.endswith(".sql.gz"):
+        return "gzip"
+    if name.endswith(".sql.zst"):
+        return "zstd"
+    return ""
+
+DUMP_SUFFIXES = {"gzip": ".sql.gz", "zstd": ".sql.zst", "": ".sql"}
+DECOMPRESS_COMMANDS = {"gzip": "gunzip -c", "zstd": "zstd -dc"}
+
+# psql \copy command of a binary-copy export: the data file is relative to the
+# output directory and compressed ones are read through a decompressing program
+COPY_COMMAND = re.compile(r"^(\\copy .+ FROM )(?:PROGRAM '(?:gzip|zstd) -dcq? ([^']+)'|'([^']+)')( WITH .*)$")
+# Lines that start the data of plain SQL dumps, which have no \copy commands
+SQL_DATA_PREFIXES = ("INSERT INTO ", "COPY ")
+# Where the init directory (and the data files copied into it) is mounted
+INIT_DIR_IN_CONTAINER = "/docker-entrypoint-initdb.d"
+
+def open_dump_lines(path: Path, compression: str):
+    """Open a dump for reading text lines, decompressing if needed."""
+    if compression == "gzip":
+        return gzip.open(path, "rt", encoding="utf-8")
+    if compression == "zstd":
+        require("zstd")
+        proc = subprocess.Popen(["zstd", "-dcq", str(path)], stdout=subprocess.PIPE, text=True, encoding="utf-8")
+        return proc.stdout
+    return open(path, "r", encoding="utf-8")
+
+def copy_data_file(src: Path, dst: Path) -> None:
+    """Copy a binary COPY data file, decompressing it by its suffix."""
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if src.name.endswith(".gz"):
+        with gzip.open(src, "rb") as f_in, open(dst, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    elif src.name.endswith(".zst"):
+        require("zstd")
+        run(["zstd", "-dqf", str(src), "-o", str(dst)])
+    else:
+        shutil.copyfile(src, dst)
+
+def stage_binary_copy_dump(dump_path: Path, init_dir: Path, name: str) -> Optional[Path]:
+    """
+    Copy the data files a binary-copy dump loads with \\copy into init_dir/data and write
+    the dump as init_dir/<name>.sql with the \\copy paths pointing at them in the container.
+    Returns the rewritten dump, or None for a plain SQL dump (left untouched).
+    """
+    target = init_dir / f"{name}.sql"
+    tmp_target = init_dir / f"{name}.sql.tmp"
+    found = False
+    with open_dump_lines(dump_path, dump_compression(dump_path)) as f_in, open(tmp_target, "w", encoding="utf-8") as f_out:
+        for line in f_in:
+            match = COPY_COMMAND.match(line.rstrip("\n"))
+            if match is None:
+                if not found and line.startswith(SQL_DATA_PREFIXES):
+                    break
+                f_out.write(line)
+                continue
+            found = True
+            prefix, program_path, path, options = match.groups()
+            rel_path = program_path or path
+            data_path = Path("data") / re.sub(r"\.(gz|zst)$", "", rel_path)
+            copy_data_file(dump_path.parent / rel_path, init_dir / data_path)
+            f_out.write(f"{prefix}'{INIT_DIR_IN_CONTAINER}/{data_path.as_posix()}'{options}\n")
+    if not found:
+        tmp_target.unlink()
+        return None
+    os.replace(tmp_target, target)
+    log(f"Copied the binary COPY data files of {dump_path} into {init_dir / 'data'}")
+    return target
+
+def stage_dump(dump_path: Path, init_dir: Path, name: str):
+    """
+    Put a dump into an init directory as <name>.sql[.gz|.zst] (the postgres entrypoint
+    runs .sql, .sql.gz and .sql.zst files); returns its path and compression.
+    """
+    staged = stage_binary_copy_dump(dump_path, init_dir, name)
+    if staged is not None:
+        return staged, ""
+    compression = dump_compression(dump_path)
+    target = init_dir / f"{name}{DUMP_SUFFIXES[compression]}"
+    shutil.copyfile(dump_path, target)
+    return target, compression
+
+def import_stream(container: str, file_in_container: str, compression: str, user: str, db: str):
+    """Stream a dump into psql (decompress if needed)."""
+    if compression:
+        decompress = DECOMPRESS_COMMANDS[compression]
         run(["docker", "exec", "-i", container, "bash", "-lc",
-             f"gunzip -c {shlex.quote(file_in_container)} | psql -v ON_ERROR_STOP=1 -1 -U {shlex.quote(user)} -d {shlex.quote(db)}"])
+             f"{decompress} {shlex.quote(file_in_container)} | psql -v ON_ERROR_STOP=1 -1 -U {shlex.quote(user)} -d {shlex.quote(db)}"])
     else:
         run(["docker", "exec", "-i", container, "bash", "-lc",
              f"psql -v ON_ERROR_STOP=1 -1 -U {shlex.quote(user)} -d {shlex.quote(db)} -f {shlex.quote(file_in_container)}"])
 
+def tuning_args() -> List[str]:
+    """Postgres server flags for fast bulk imports."""
+    return [
+        "-c", f"max_wal_size={DEFAULTS['MAX_WAL_SIZE']}",
+        "-c", f"checkpoint_timeout={DEFAULTS['CHECKPOINT_TIMEOUT']}",
+        "-c", f"checkpoint_completion_target={DEFAULTS['CHECKPOINT_COMPLETION_TARGET']}",
+        "-c", f"wal_compression={DEFAULTS['WAL_COMPRESSION']}",
+        "-c", f"synchronous_commit={DEFAULTS['SYNCHRONOUS_COMMIT']}",
+        "-c", f"autovacuum={DEFAULTS['AUTOVACUUM']}",
+        "-c", f"maintenance_work_mem={DEFAULTS['MAINTENANCE_WORK_MEM']}",
+    ]
+
+def volume_exists(volume: str) -> bool:
+    return run(["docker", "volume", "inspect", volume], check=False, capture_output=True).returncode == 0
+
+def wait_init_complete(container: str, timeout: int) -> None:
+    """Wait until the entrypoint has run every init script (pg_isready already succeeds during init)."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        out = run(["docker", "logs", container], check=False, capture_output=True)
+        if "PostgreSQL init process complete" in (out.stdout or "") + (out.stderr or ""):
+            return
+        state = run(["docker", "inspect", "-f", "{{.State.Running}}", container], check=False, capture_output=True)
+        if state.stdout.strip() == "false":
+            docker_logs_head(container, 200)
+            sys.exit(f"ERROR: {container} stopped while running init scripts")
+        time.sleep(5)
+    sys.exit(f"ERROR: Timeout waiting for init scripts of {container}")
+
+def build_vocabulary_template(vocab_path: Path, recreate: bool) -> str:
+    """Load the shared vocabulary dump once into a template volume; returns the volume name."""
+    suffix = sanitize_name(vocab_path)
+    c_name = f"pg_{suffix}_template"
+    v_name = f"pgdata_{suffix}_template"
+    if not recreate and volume_exists(v_name):
+        log(f"Reusing vocabulary template volume {v_name}")
+        return v_name
+
+    init_dir = Path.home() / "pg" / f"{c_name}_init"
+    init_dir.mkdir(parents=True, exist_ok=True)
+    stage_dump(vocab_path, init_dir, "vocabulary")
+
+    log(f"=== {vocab_path} -> template volume={v_name}")
+    run(["docker", "rm", "-f", c_name], check=False)
+    run(["docker", "volume", "rm", v_name], check=False)
+    run([
+        "docker", "run", "-d", "--name", c_name,
+        "-e", f"POSTGRES_USER={DEFAULTS['PG_USER']}",
+        "-e", f"POSTGRES_PASSWORD={DEFAULTS['PASS_PREFIX']}",
+        "-e", f"POSTGRES_DB={DEFAULTS['DB_NAME']}",
+        "-v", f"{v_name}:/var/lib/postgresql/data",
+        "-v", f"{str(init_dir)}:/docker-entrypoint-initdb.d:ro",
+        DEFAULTS["PG_IMAGE"],
+        *tuning_args(),
+    ])
+    # Loading a full vocabulary takes far longer than a server start
+    wait_init_complete(c_name, max(DEFAULTS["WAIT_TIMEOUT"], 6 * 3600))
+    # Stop cleanly so the data directory can be copied
+    run(["docker", "stop", c_name])
+    run(["docker", "rm", c_name])
+    return v_name
+
+def clone_volume(src: str, dst: str) -> None:
+    """Copy the data directory of one volume into a new volume."""
+    run(["docker", "volume", "create", dst])
+    run(["docker", "run", "--rm", "-v", f"{src}:/from:ro", "-v", f"{dst}:/to",
+         DEFAULTS["PG_IMAGE"], "bash", "-c", "cp -a /from/. /to/"])
+
 def next_free_port(start: int, limit: int = 200) -> int:
     """Find a free TCP port >= start on localhost."""
     for p in range(start, start + limit):
@@ -120,10 +287,13 @@ def next_free_port(start: int, limit: int = 200) -> int:
 
 def main():
     parser = argparse.ArgumentParser(description="Spin up tuned Postgres containers and import big SQL dumps (auto-retry ports).")
-    parser.add_argument("dumps", nargs="+", help="Absolute paths to .sql.gz or .sql files (one container per file)")
+    parser.add_argument("dumps", nargs="+", help="Absolute paths to .sql.gz, .sql.zst or .sql files (one container per file)")
     parser.add_argument("--no-recreate", action="store_true", help="Do not delete existing containers/volumes")
     parser.add_argument("--stream", action="store_true",
                         help="Stream into psql instead of auto-init (works even if volume is not fresh)")
+    parser.add_argument("--vocabulary",
+                        help="Absolute path to a shared vocabulary dump; it is loaded once into a template "
+                             "volume that is cloned for every container before its partition is streamed in")
     args = parser.parse_args()
 
     # Ensure prerequisites
@@ -132,6 +302,10 @@ def main():
 
     recreate = DEFAULTS["RECREATE"] and not args.no_recreate
 
+    template_volume = None
+    if args.vocabulary:
+        template_volume = build_vocabulary_template(ensure_abs_existing_file(args.vocabulary), recreate)
+
     for idx, dump in enumerate(args.dumps):
         dump_path = ensure_abs_existing_file(dump)
         suffix = sanitize_name(dump_path)
@@ -143,10 +317,8 @@ def main():
         init_dir = Path.home() / "pg" / f"{c_name}_init"
         init_dir.mkdir(parents=True, exist_ok=True)
 
-        # Determine target filename inside init dir
-        is_gzip = dump_path.name.endswith(".sql.gz")
-        target = init_dir / ("partition.sql.gz" if is_gzip else "partition.sql")
-        shutil.copyfile(dump_path, target)
+        # Determine target filename inside init dir; binary-copy dumps get their data files
+        target, compression = stage_dump(dump_path, init_dir, "partition")
 
         log(f"=== {dump_path} -> container={c_name} volume={v_name} port={host_port}")
         if recreate:
@@ -154,6 +326,14 @@ def main():
             run(["docker", "rm", "-f", c_name], check=False)
             run(["docker", "volume", "rm", v_name], check=False)
 
+        # Start from a copy of the vocabulary template; the entrypoint then skips its init
+        # scripts because the data directory is not empty, so the partition is streamed in
+        cloned = False
+        if template_volume and not volume_exists(v_name):
+            log(f"Cloning vocabulary template {template_volume} -> {v_name} ...")
+            clone_volume(template_volume, v_name)
+            cloned = True
+
         # Try to run container on chosen port; if race occurs, retry once with next free port
         def try_run(port: int):
             return run([
@@ -165,13 +345,7 @@ def main():
                 "-v", f"{v_name}:/var/lib/postgresql/data",
                 "-v", f"{str(init_dir)}:/docker-entrypoint-initdb.d:ro",
                 DEFAULTS["PG_IMAGE"],
-                "-c", f"max_wal_size={DEFAULTS['MAX_WAL_SIZE']}",
-                "-c", f"checkpoint_timeout={DEFAULTS['CHECKPOINT_TIMEOUT']}",
-                "-c", f"checkpoint_completion_target={DEFAULTS['CHECKPOINT_COMPLETION_TARGET']}",
-                "-c", f"wal_compression={DEFAULTS['WAL_COMPRESSION']}",
-                "-c", f"synchronous_commit={DEFAULTS['SYNCHRONOUS_COMMIT']}",
-                "-c", f"autovacuum={DEFAULTS['AUTOVACUUM']}",
-                "-c", f"maintenance_work_mem={DEFAULTS['MAINTENANCE_WORK_MEM']}",
+                *tuning_args(),
             ], check=True, capture_output=False)
 
         try:
@@ -191,11 +365,16 @@ def main():
         # Wait ready
         wait_ready(c_name, DEFAULTS["PG_USER"], DEFAULTS["DB_NAME"], DEFAULTS["WAIT_TIMEOUT"])
 
+        if cloned:
+            # The cloned data directory keeps the template's password
+            docker_exec_psql(c_name, DEFAULTS["PG_USER"], DEFAULTS["DB_NAME"],
+                             f"ALTER USER {DEFAULTS['PG_USER']} PASSWORD '{password}';")
+
         # If streaming requested (volume not fresh), copy into /tmp and import manually
-        if args.stream:
+        if args.stream or cloned:
             in_container = f"/tmp/{target.name}"
             run(["docker", "cp", str(target), f"{c_name}:{in_container}"])
-            import_stream(c_name, in_container, is_gzip, DEFAULTS["PG_USER"], DEFAULTS["DB_NAME"])
+            import_stream(c_name, in_container, compression, DEFAULTS["PG_USER"], DEFAULTS["DB_NAME"])
 
         # Basic verification
         log("Verification: user table count ...")
@@ -8,21 +8,106 @@ Author: Narasimha Raghavan
 """
 
 import os
+import re
+import fnmatch
+import shutil
 import logging
 import subprocess
 import tempfile
-from typing import List, Dict, Set, Tuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Set, Tuple
 import networkx as nx
+import numpy as np
 from sqlalchemy import create_engine, text, MetaData, inspect
 from urllib.parse import urlparse
-from .distribution_strategies import DistributionStrategy
+from .distribution_strategies import DistributionStrategy, create_distribution_strategy, get_person_map_digest
+from .catalog import CatalogSnapshot
+from .assignment import (
+    ALL_PARTITIONS, NO_PARTITION, KeyMap, get_batch_keys, split_batch, split_by_partition
+)
+from .routing import LinkRouter, derive_table_links, load_link_rules
+from .columnar import ArrowTableWriter, ParquetTableWriter, get_column_keys, record_batch_rows
+from .staging import StagedSource, get_stage_data_types
+from .segment_cache import CACHE_FILE_NAME, SegmentCache
+from .manifest import MANIFEST_FILE_NAME, PERSON_MAP_FILE_NAME, XMIN_WATERMARK, RunManifest, file_checksum
+from .writers import InsertTableWriter, CopyTableWriter, UpsertTableWriter
+from .compression import (
+    DECOMPRESS_COMMANDS, CompressedBinaryFile, CompressedTextFile, get_compressed_path, get_default_threads, open_text_reader, open_text_writer
+)
 
 logger = logging.getLogger(__name__)
 
+# Target amount of row data fetched per server-side cursor round trip
+STREAM_BATCH_BYTES = 16 * 1024 * 1024
+STREAM_MIN_FETCH_ROWS = 100
+STREAM_MAX_FETCH_ROWS = 50000
+
+# Size in 8 KiB pages (1 GiB) from which a table is scanned as several ranges of
+# blocks on parallel jobs, see _get_scan_ranges
+SCAN_RANGE_PAGES = 131072
+# server_version_num from which ctid ranges are read with TID range scans; older
+# servers would scan the whole table for every range
+TID_RANGE_SCAN_VERSION = 140000
+
+# Persons whose rows are selected or deleted per statement of a moves file
+MOVE_BATCH_PERSONS = 10000
+
+# Parallel workers used for index builds in the post-data section
+POST_DATA_MAINTENANCE_WORKERS = 4
+
+# Foreign key definitions in pg_dump's post-data section
+FOREIGN_KEY_PATTERN = re.compile(r'(FOREIGN KEY \([^)]*\) REFERENCES [^;]+);')
+
+# Output formats of the table data: SQL text (INSERT or CSV COPY blocks stitched into
+# the partition files), PGCOPY binary files loaded by the partition files, or
+# Parquet files in one directory per partition
+OUTPUT_FORMATS = ('sql', 'binary-copy', 'parquet')
+
+# Partition index of segments written once to the shared vocabulary file
+SHARED_PARTITION = -1
+
+# Exporter used by the current pool worker process, see _init_segment_worker
+_worker_exporter = None
+
+def _init_segment_worker(exporter_config: dict, snapshot_id: str, catalog: CatalogSnapshot,
+                         distribution: DistributionStrategy = None, link_routers: Dict = None,
+                         key_maps: Dict = None):
+    """
+    Create the exporter of a pool worker and attach it to the shared snapshot and catalog,
+    and to the distribution strategy, table links and key→partition maps prepared by the coordinator
+    """
+    global _worker_exporter
+    _worker_exporter = SQLExporter(**exporter_config)
+    _worker_exporter.snapshot_id = snapshot_id
+    _worker_exporter.catalog = catalog
+    if distribution is not None:
+        _worker_exporter.distribution = distribution
+        _worker_exporter._distribution_prepared = True
+    if link_routers is not None:
+        _worker_exporter.link_routers = link_routers
+    if key_maps is not None:
+        _worker_exporter.key_maps = key_maps
+
+def _run_segment_unit(table: str, partition_index, segment_files: List[str], scan_range: Tuple = None):
+    """Export one (partition, table, range of blocks) unit in a pool worker"""
+    stats = _worker_exporter._export_segment(table, partition_index, segment_files, scan_range)
+    return table, partition_index, stats
+
+def _run_stage_unit(table: str, path: str):
+    """Stage one table in a pool worker"""
+    return table, _worker_exporter._stage_table(table, path)
+
 class SQLExporter:
     """Handles SQL export functionality for OMOP partitions"""
     
-    def __init__(self, source_db_url: str, num_partitions: int, output_dir: str = "sql_exports", use_copy: bool = False):
+    def __init__(self, source_db_url: str, num_partitions: int, output_dir: str = "sql_exports", use_copy: bool = False,
+                 fan_out: bool = False, jobs: int = 1, compress: str = None, compress_level: int = None,
+                 compress_threads: int = None, shared_vocabulary: bool = False, split_schema: bool = False,
+                 incremental: bool = False, watermark: str = XMIN_WATERMARK, resume: bool = False,
+                 output_format: str = 'sql', cache_dir: str = None, strategy: str = 'uniform',
+                 range_bounds: str = 'histogram', routing_rules: str = None,
+                 scan_range_pages: int = SCAN_RANGE_PAGES):
         """
         Initialize the SQL exporter
         
@@ -31,19 +116,117 @@ class SQLExporter:
             num_partitions: Number of partitions to create
             output_dir: Directory to save SQL files
             use_copy: Use COPY statements for faster import (default: False, uses INSERT)
+            fan_out: Scan each source table once and route rows to all partition files
+                (default: False, one filtered scan per partition)
+            jobs: Number of worker processes exporting tables in parallel (default: 1)
+            compress: Compress output files inline with 'gzip' or 'zstd' (default: None)
+            compress_level: Compression level (default: 6 for gzip, 3 for zstd)
+            compress_threads: Compression threads per file (default: CPU count divided by jobs)
+            shared_vocabulary: Write vocabulary and lookup tables once to vocabulary.sql instead
+                of into every partition file (default: False)
+            split_schema: Create tables before the data but indexes and constraints after it,
+                using pg_dump's pre-data and post-data sections (default: False)
+            incremental: Keep the table segments in the output directory and reuse those of
+                tables that have not changed since the previous export (default: False)
+            watermark: Change watermark recorded for delta exports of person-dependent tables:
+                'xmin', 'id' (single-column primary key) or a column name pattern such as
+                '*_datetime'; tables without a matching column use xmin (default: 'xmin')
+            resume: Continue an interrupted export, keeping the segments its run manifest
+                records as finished (default: False)
+            output_format: 'sql' for text data inside the partition files, 'binary-copy'
+                for one PGCOPY binary file per partition and table, which the partition
+                files load with \\copy, or 'parquet' for one Parquet dataset per partition
+                and table (default: 'sql')
+            cache_dir: Produce the partitions from a source staged with stage_source instead
+                of querying the source database, which is then not needed (default: None)
+            strategy: Distribution strategy assigning persons to partitions: 'uniform'
+                (person_id modulo the partition count), 'hash', 'consistent_hash' (few persons
+                move when the partition count changes), 'range', 'weighted' (persons packed
+                by data volume) or 'round_robin';
+                strategies without a SQL predicate route rows in the client (default: 'uniform')
+            range_bounds: How the range strategy computes its person_id boundaries:
+                'histogram' (pg_stats of person.person_id) or 'ntile' (one scan of person);
+                the boundaries are recorded in the run manifest (default: 'histogram')
+            routing_rules: JSON file of links routing tables without person_id to the
+                partitions of their parent rows, replacing the default links of the tables
+                it names (see the routing module); other tables are linked by their foreign
+                keys (default: None)
+            scan_range_pages: With jobs > 1, scan tables of more pages than this as up to
+                jobs ranges of blocks (ctid ranges) on parallel connections attached to
+                the run's snapshot, each written to its own segment; 0 scans every table
+                on one connection (default: SCAN_RANGE_PAGES, 1 GiB)
         """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format: {output_format}")
+        self.strategy = strategy
+        self.range_bounds = range_bounds
+        self.routing_rules = routing_rules
+        # Assigns persons to partitions, by a predicate of the filtered scans or in the client
+        options = {'boundary_method': range_bounds} if strategy == 'range' else {}
+        self.distribution = create_distribution_strategy(strategy, **options)
+        self.has_partition_predicate = self.distribution.has_partition_predicate
+        if output_format == 'binary-copy' and not self.has_partition_predicate:
+            raise ValueError(f"The {strategy} strategy routes rows in the client, which binary COPY output does not support")
+        if cache_dir and output_format == 'binary-copy':
+            raise ValueError("Binary COPY output is produced by the source database and cannot be made from a staged cache")
         self.source_db_url = source_db_url
         self.num_partitions = num_partitions
         self.use_copy = use_copy
+        self.fan_out = fan_out
+        self.jobs = max(1, jobs)
+        self.scan_range_pages = scan_range_pages
+        self.compress = compress
+        self.compress_level = compress_level
+        self.compress_threads = compress_threads or max(1, get_default_threads() // self.jobs)
+        self.shared_vocabulary = shared_vocabulary
+        self.split_schema = split_schema
+        self.incremental = incremental
+        self.watermark = watermark
+        self.resume = resume
+        self.output_format = output_format
+        if output_format == 'binary-copy' and fan_out:
+            # Binary rows cannot be routed without decoding them
+            logger.warning("Fan-out is not supported with binary COPY output, using one scan per partition")
+            self.fan_out = False
+        if output_format == 'parquet':
+            # Record batches are always routed to the partitions from one scan per table
+            self.fan_out = True
+        self.cache_dir = cache_dir
+        # Source staged in a local cache, read instead of the source database when set
+        self.staged_source = StagedSource.load(cache_dir) if cache_dir else None
+        if self.staged_source is not None:
+            # Staged rows are routed in Python from one read of each cached table
+            self.fan_out = True
+        if not self.has_partition_predicate and not self.fan_out:
+            logger.info(f"The {strategy} strategy has no SQL predicate, routing rows from one scan per table")
+            self.fan_out = True
+        # Path of the shared vocabulary file once it has been written
+        self.vocabulary_file = None
         self.output_dir = output_dir
-        self.source_engine = create_engine(source_db_url)
+        self.segments_dir = os.path.join(output_dir, "segments")
+        self.source_engine = create_engine(source_db_url) if source_db_url else None
         self.person_table = 'omopcdm.person'
+        # Snapshot exported by the coordinating connection of a parallel run;
+        # every source query of the run is attached to it when set
+        self.snapshot_id = None
+        # Table metadata of the source schema, loaded once per run (see get_catalog)
+        self.catalog = None
+        # Whether the distribution strategy has been prepared (see _get_distribution)
+        self._distribution_prepared = False
+        # Routers of the tables whose rows belong to persons through other rows, by
+        # table (see _get_link_routers), and key→partition maps of their parent tables
+        self.link_routers = None
+        self.key_maps = {}
+        # server_version_num of the source, read on first use (see _get_server_version)
+        self.server_version = None
         
         # Parse source database URL to get connection details
-        parsed_url = urlparse(source_db_url)
+        parsed_url = urlparse(source_db_url or '')
         self.db_host = parsed_url.hostname or 'localhost'
         self.db_port = parsed_url.port or 5432
         self.db_name = parsed_url.path.lstrip('/')
+        if self.staged_source is not None:
+            self.db_name = self.staged_source.source_database
         self.db_user = parsed_url.username
         self.db_password = parsed_url.password
         
@@ -64,12 +247,86 @@ class SQLExporter:
             'concept_ancestor', 'concept_relationship', 'concept_synonym'
         }
     
+    def _get_exporter_config(self) -> dict:
+        """Return the constructor arguments used to recreate this exporter in a worker process"""
+        return {
+            'source_db_url': self.source_db_url,
+            'num_partitions': self.num_partitions,
+            'output_dir': self.output_dir,
+            'use_copy': self.use_copy,
+            'fan_out': self.fan_out,
+            'compress': self.compress,
+            'compress_level': self.compress_level,
+            'compress_threads': self.compress_threads,
+            'shared_vocabulary': self.shared_vocabulary,
+            'split_schema': self.split_schema,
+            'incremental': self.incremental,
+            'watermark': self.watermark,
+            'resume': self.resume,
+            'output_format': self.output_format,
+            'cache_dir': self.cache_dir,
+            'strategy': self.strategy,
+            'range_bounds': self.range_bounds,
+            'routing_rules': self.routing_rules,
+            'scan_range_pages': self.scan_range_pages,
+        }
+    
+    def _get_output_file(self, file_name: str) -> str:
+        """Path of an output file, with the extension of the configured compression"""
+        return get_compressed_path(os.path.join(self.output_dir, file_name), self.compress)
+    
+    def _open_output(self, path: str) -> CompressedTextFile:
+        """Open an output file for writing through the configured compression"""
+        return CompressedTextFile(path, self.compress, self.compress_level, self.compress_threads)
+    
+    def _open_output_member(self, raw_f):
+        """
+        Open a text stream appending one compressed member to an open binary file
+        Closing the stream leaves raw_f open for further members or raw segment bytes
+        """
+        return open_text_writer(raw_f, self.compress, self.compress_level, self.compress_threads)
+    
+    @contextmanager
+    def _connect(self):
+        """
+        Open a source connection for reading table data
+        
+        When a snapshot has been exported for the run, the connection's transaction
+        is attached to it so that all workers see the same consistent database state.
+        """
+        with self.source_engine.connect() as conn:
+            if self.snapshot_id:
+                conn = conn.execution_options(isolation_level="REPEATABLE READ")
+                conn.execute(text(f"SET TRANSACTION SNAPSHOT '{self.snapshot_id}'"))
+            yield conn
+    
+    @contextmanager
+    def _export_snapshot(self):
+        """
+        Export a snapshot of the source database and keep it alive for the duration of the block
+        Yields the snapshot id to pass to SET TRANSACTION SNAPSHOT, or None when reading
+        a staged cache, which already holds one consistent state of the source
+        """
+        if self.staged_source is not None:
+            yield None
+            return
+        with self.source_engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="REPEATABLE READ")
+            snapshot_id = conn.execute(text("SELECT pg_export_snapshot()")).scalar()
+            logger.info(f"Exported source snapshot {snapshot_id}")
+            # The snapshot stays importable only while this transaction is open
+            yield snapshot_id
+            conn.rollback()
+    
     def analyze_schema(self) -> nx.DiGraph:
         """
         Analyze the database schema to build a dependency graph
         Returns a directed graph representing table relationships
         """
         graph = nx.DiGraph()
+        if self.staged_source is not None:
+            graph.add_edges_from(self.staged_source.foreign_keys)
+            return graph
         
         # Query to get foreign key relationships, including schema
         query = """
@@ -95,6 +352,9 @@ class SQLExporter:
                 from_table = f"{row[3]}.{row[4]}"
                 to_table = f"{row[0]}.{row[1]}"
                 graph.add_edge(from_table, to_table)
+                # (column, referenced column) pairs, from which the rows of tables
+                # without person_id are linked to their persons
+                graph[from_table][to_table].setdefault('columns', []).append((row[2], row[5]))
         
         return graph
     
@@ -178,20 +438,17 @@ class SQLExporter:
         related_tables.add(self.person_table)
         return related_tables
     
+    def get_catalog(self) -> CatalogSnapshot:
+        """Return the catalog snapshot of the source schema, loading it on first use"""
+        if self.catalog is None and self.staged_source is not None:
+            self.catalog = self.staged_source.catalog
+        elif self.catalog is None:
+            self.catalog = CatalogSnapshot.load(self.source_engine)
+        return self.catalog
+    
     def _has_person_id_column(self, table: str) -> bool:
         """Check if a table has a person_id column"""
-        schema, table_name = table.split('.')
-        with self.source_engine.connect() as conn:
-            result = conn.execute(text(f"""
-                SELECT EXISTS (
-                    SELECT 1 
-                    FROM information_schema.columns 
-                    WHERE table_schema = '{schema}'
-                    AND table_name = '{table_name}'
-                    AND column_name = 'person_id'
-                );
-            """))
-            return result.scalar()
+        return self.get_catalog().has_person_id_column(table)
     
     def export_schema_sql(self) -> str:
         """
@@ -199,8 +456,76 @@ class SQLExporter:
         Includes: tables, constraints, indexes, sequences, functions, triggers, etc.
         Returns the path to the schema SQL file
         """
-        schema_file = os.path.join(self.output_dir, "schema.sql")
+        schema_file = self._get_output_file("schema.sql")
+        
+        logger.info(f"Exporting complete schema to {schema_file}")
+        logger.info("Including: tables, constraints, indexes, sequences, functions, triggers")
+        self._dump_schema(schema_file)
+        
+        # Verify the schema file contains expected components
+        self._verify_schema_components(schema_file)
+        
+        return schema_file
+    
+    def export_schema_sections(self) -> Tuple[str, str]:
+        """
+        Export the schema split into pg_dump's pre-data section (schema, tables, sequences,
+        functions) and post-data section (primary keys, foreign keys, indexes, triggers)
+        
+        The post-data file starts with settings for parallel index builds so that it can
+        also be run on its own after the data has been loaded. Foreign keys are added as
+        NOT VALID: like the single schema file, where data is loaded with triggers disabled,
+        they are enforced for new rows without re-checking the imported ones.
+        Returns the paths to the pre-data and post-data SQL files
+        """
+        pre_data_file = self._get_output_file("schema_pre_data.sql")
+        post_data_file = self._get_output_file("schema_post_data.sql")
+        
+        logger.info(f"Exporting pre-data schema to {pre_data_file}")
+        self._dump_schema(pre_data_file, section='pre-data')
+        
+        logger.info(f"Exporting post-data schema to {post_data_file}")
+        self._dump_schema(post_data_file, section='post-data')
+        
+        self._verify_schema_components(pre_data_file, post_data_file)
+        return pre_data_file, post_data_file
+    
+    def _export_schema_files(self) -> Tuple[str, str]:
+        """
+        Export the schema for partition files
+        Returns the schema file to load before the data and the one to load after it
+        (None unless split_schema is enabled)
+        """
+        if self.split_schema:
+            return self.export_schema_sections()
+        return self.export_schema_sql(), None
+    
+    def _dump_schema(self, schema_file: str, section: str = None):
+        """Dump the omopcdm schema, optionally limited to one section, into schema_file"""
+        if self.staged_source is not None:
+            content = self.staged_source.read_schema(section)
+        else:
+            content = self._run_pg_dump(section)
         
+        if section == 'post-data':
+            content = FOREIGN_KEY_PATTERN.sub(r'\1 NOT VALID;', content)
+            content = (
+                "-- Build indexes and constraints after the data has been loaded\n"
+                f"SET max_parallel_maintenance_workers = {POST_DATA_MAINTENANCE_WORKERS};\n\n"
+                + content
+            )
+        
+        # Write the dump from stdout so that it goes through the configured compression
+        with self._open_output(schema_file) as schema_f:
+            schema_f.write(content)
+        logger.info("Schema export completed successfully")
+    
+    def _run_pg_dump(self, section: str = None) -> str:
+        """
+        Run pg_dump for the omopcdm schema, optionally limited to one section, in the
+        exported snapshot of the run if there is one
+        Returns the dump as text
+        """
         # Use pg_dump to export complete schema with all components
         cmd = [
             'pg_dump',
@@ -213,224 +538,638 @@ class SQLExporter:
             '--no-privileges',        # Don't include privilege commands
             '--schema=omopcdm',       # Only export omopcdm schema
             '--verbose',              # Verbose output for debugging
-            '--file', schema_file
         ]
+        if section:
+            cmd.append(f'--section={section}')
+        if self.snapshot_id:
+            cmd.append(f'--snapshot={self.snapshot_id}')
         
         # Set password via environment variable
         env = os.environ.copy()
         env['PGPASSWORD'] = self.db_password
         
         try:
-            logger.info(f"Exporting complete schema to {schema_file}")
-            logger.info("Including: tables, constraints, indexes, sequences, functions, triggers")
             result = subprocess.run(cmd, env=env, capture_output=True, text=True, check=True)
-            logger.info("Schema export completed successfully")
-            
-            # Verify the schema file contains expected components
-            self._verify_schema_components(schema_file)
-            
-            return schema_file
         except subprocess.CalledProcessError as e:
             logger.error(f"Schema export failed: {e.stderr}")
             raise
+        return result.stdout
     
     def export_partition_data(self, partition_index: int, graph: nx.DiGraph) -> str:
         """
         Export data for a specific partition
         Returns the path to the partition SQL file
         """
-        partition_file = os.path.join(self.output_dir, f"partition_{partition_index}.sql")
+        partition_file = self._get_output_file(f"partition_{partition_index}.sql")
         
         logger.info(f"Exporting data for partition {partition_index}")
         
-        with open(partition_file, 'w') as f:
-            # Write header
-            f.write(f"-- OMOP Partition {partition_index} Data Export\n")
-            f.write(f"-- Generated from source database: {self.db_name}\n")
-            f.write(f"-- Partition: {partition_index} of {self.num_partitions}\n\n")
-            
-            # Get all tables from the source database
-            with self.source_engine.connect() as conn:
-                result = conn.execute(text("""
-                    SELECT table_name 
-                    FROM information_schema.tables 
-                    WHERE table_schema = 'omopcdm'
-                    ORDER BY table_name
-                """))
-                tables = [f"omopcdm.{row[0]}" for row in result]
+        with self._open_output(partition_file) as f:
+            self._write_partition_data_header(f, partition_index)
             
             # Export data for each table
-            for table in tables:
+            for table in self._get_source_tables():
                 self._export_table_data(f, table, partition_index)
         
         logger.info(f"Partition {partition_index} data exported to {partition_file}")
         return partition_file
     
-    def _export_table_data(self, file_handle, table: str, partition_index: int):
+    def _write_partition_data_header(self, f, partition_index: int):
+        """Write the header of a data-only partition file"""
+        f.write(f"-- OMOP Partition {partition_index} Data Export\n")
+        f.write(f"-- Generated from source database: {self.db_name}\n")
+        f.write(f"-- Partition: {partition_index} of {self.num_partitions}\n\n")
+    
+    def _get_source_tables(self) -> List[str]:
+        """Get all tables from the source database"""
+        catalog = self.get_catalog()
+        return [f"{catalog.schema}.{table_name}" for table_name in sorted(catalog.tables)]
+    
+    def _get_table_kind(self, table: str) -> str:
         """
-        Export data for a specific table to a partition
+        Classify how a table is split across partitions:
+        'person' (routed on person_id), 'linked' (routed through the rows its keys
+        refer to, e.g. episode_event through episode, see _get_link_routers)
+        or 'full' (copied in full to every partition)
         """
-        schema, table_name = table.split('.')
+        table_name = table.split('.')[1]
         
-        with self.source_engine.connect() as conn:
-            # Get total count of rows
-            result = conn.execute(text(f"SELECT COUNT(*) FROM {schema}.{table_name}"))
-            total_rows = result.scalar()
-            
-            if total_rows == 0:
-                logger.info(f"Table {table_name} is empty, skipping")
-                return
-            
-            # Special handling for episode_event
-            if table_name == 'episode_event':
-                self._export_episode_event_data(file_handle, table, partition_index)
-                return
-            
-            # For vocabulary tables, always copy full table to every partition
-            if table_name in self.vocabulary_tables:
-                self._export_full_table_data(file_handle, table)
-                return
-            
-            # For lookup tables, copy full table to every partition
-            if table_name in self.lookup_tables:
-                self._export_full_table_data(file_handle, table)
-                return
-            
-            # For person-dependent tables, use modulus on person_id
-            if self._has_person_id_column(table):
-                self._export_person_dependent_data(file_handle, table, partition_index)
-                return
-            
-            # For any other tables, copy full table to every partition
-            self._export_full_table_data(file_handle, table)
+        # Vocabulary and lookup tables are always copied in full to every partition
+        if table_name in self.vocabulary_tables or table_name in self.lookup_tables:
+            return 'full'
+        
+        # Person-dependent tables are split on person_id by the distribution strategy
+        if self._has_person_id_column(table):
+            return 'person'
+        
+        # Tables whose rows belong to persons through a key of another table
+        if table in self._get_link_routers():
+            return 'linked'
+        
+        # Any other tables are copied in full to every partition
+        return 'full'
+    
+    def _get_link_routers(self) -> Dict[str, LinkRouter]:
+        """
+        Return the routers of the tables without person_id whose rows belong to persons
+        through the rows their keys refer to, derived on first use from the foreign keys
+        and the routing rules
+        """
+        if self.link_routers is None:
+            tables = [
+                t for t in self._get_source_tables()
+                if not self._is_vocabulary_table(t) and not self._has_person_id_column(t)
+            ]
+            table_links = derive_table_links(self.analyze_schema(), self.get_catalog(), tables,
+                                             load_link_rules(self.routing_rules))
+            domain_concepts = None
+            if any(link.domain_concepts for links in table_links.values() for link in links):
+                domain_concepts = self._get_domain_concepts()
+            self.link_routers = {}
+            for table, links in table_links.items():
+                router = LinkRouter(table, links, self.get_catalog(), domain_concepts)
+                if router.routes:
+                    self.link_routers[table] = router
+                    logger.info(f"Routing {table} through {', '.join(router.parents)}")
+        return self.link_routers
+    
+    def _get_domain_concepts(self) -> Dict[str, int]:
+        """Concept ID of every domain, from the domain table"""
+        domain_table = f"{self.get_catalog().schema}.domain"
+        if self.get_catalog().get_table(domain_table) is None:
+            return {}
+        if self.staged_source is not None:
+            domain_ids, concept_ids = self.staged_source.read_columns(domain_table, ['domain_id', 'domain_concept_id'])
+            return dict(zip(domain_ids, concept_ids))
+        with self._connect() as conn:
+            result = conn.execute(text(f"SELECT domain_id, domain_concept_id FROM {domain_table}"))
+            return {domain_id: concept_id for domain_id, concept_id in result}
+    
+    def _get_key_map(self, table: str) -> KeyMap:
+        """
+        Return the key→partition map of a parent table, built on first use from its keys
+        and the partition of the person of each; in a pool the coordinator builds the maps
+        once for all workers, see _build_key_maps
+        """
+        if table not in self.key_maps:
+            key_column = self._get_parent_key(table)
+            if self.staged_source is not None:
+                keys, _ = self.staged_source.read_keys(table, key_column)
+                parts = self._assign_partitions_with_nulls(*self.staged_source.read_keys(table, 'person_id'))
+            else:
+                schema, table_name = table.split('.')
+                key_batches, part_batches = [], []
+                with self._connect() as conn:
+                    query = f"SELECT {key_column}, person_id FROM {schema}.{table_name}"
+                    result = conn.execution_options(yield_per=STREAM_MAX_FETCH_ROWS).execute(text(query))
+                    for batch in result.partitions():
+                        key_batches.append(get_batch_keys(batch, 0)[0])
+                        part_batches.append(self._assign_partitions_with_nulls(*get_batch_keys(batch, 1)))
+                keys = np.concatenate(key_batches) if key_batches else np.empty(0, dtype=np.int64)
+                parts = np.concatenate(part_batches) if part_batches else np.empty(0, dtype=np.int64)
+            key_map = KeyMap(keys, parts, self.num_partitions)
+            self.key_maps[table] = key_map
+            logger.info(f"Built the key→partition map of {table} ({len(key_map)} keys, "
+                        f"{key_map.nbytes / 1024 / 1024:.1f} MiB)")
+        return self.key_maps[table]
+    
+    def _get_parent_key(self, table: str) -> str:
+        """Key column the linked tables refer to the rows of a parent table by"""
+        for router in self._get_link_routers().values():
+            if table in router.parent_keys:
+                return router.parent_keys[table]
+        return self.get_catalog().get_table(table).primary_key[0]
+    
+    def _build_key_maps(self, units: List[Tuple]) -> Dict[str, KeyMap]:
+        """
+        Build the key→partition maps of the parent tables of every unit that routes rows by
+        them once in the coordinator, so the workers receive them with their initializer
+        instead of each reading the parents again. Only the parents that rows of a table
+        can be routed through are built: none for an empty table, and only those whose
+        domain value occurs for tables routed by a domain column (e.g. cost_domain_id).
+        """
+        tables = dict.fromkeys(
+            table for table, partition_index, *_ in units
+            if partition_index != SHARED_PARTITION and self._is_routed_by_key_map(table)
+        )
+        for table in tables:
+            if self._is_table_empty(table):
+                continue
+            for parent in self._get_routed_parents(table):
+                if parent != self.person_table:
+                    self._get_key_map(parent)
+        return self.key_maps
+    
+    def _get_routed_parents(self, table: str) -> List[str]:
+        """Parent tables rows of a linked table are routed through, by the domain values it holds"""
+        parents = []
+        for _, domain_column, route_parents in self._get_link_routers()[table].routes:
+            if domain_column is None:
+                parents.extend(parent for _, parent in route_parents)
+                continue
+            values = set(self._get_distinct_values(table, domain_column))
+            parents.extend(parent for value, parent in route_parents if value in values)
+        return sorted(set(parents))
+    
+    def _get_distinct_values(self, table: str, column: str) -> List:
+        """Distinct values of a column of a source table"""
+        if self.staged_source is not None:
+            return self.staged_source.read_distinct(table, column)
+        schema, table_name = table.split('.')
+        with self._connect() as conn:
+            result = conn.execute(text(f"SELECT DISTINCT {column} FROM {schema}.{table_name}"))
+            return [row[0] for row in result]
+    
+    def _get_parent_partitions(self, table: str, keys: np.ndarray) -> np.ndarray:
+        """Partition of every key of a parent table, NO_PARTITION for keys it does not have"""
+        if table == self.person_table:
+            return self._assign_partitions(keys)
+        return self._get_key_map(table).lookup(keys)
     
-    def _export_episode_event_data(self, file_handle, table: str, partition_index: int):
-        """Export episode_event data based on episode's person_id"""
+    def _is_vocabulary_table(self, table: str) -> bool:
+        """Check if a table is a vocabulary or lookup table that is identical in every partition"""
+        table_name = table.split('.')[1]
+        return table_name in self.vocabulary_tables or table_name in self.lookup_tables
+    
+    def _split_shared_tables(self, tables: List[str]) -> Tuple[List[str], List[str]]:
+        """
+        Split tables into those exported per partition and those written once to the
+        shared vocabulary file (empty unless shared_vocabulary is enabled)
+        """
+        if not self.shared_vocabulary:
+            return tables, []
+        shared_tables = [t for t in tables if self._is_vocabulary_table(t)]
+        partition_tables = [t for t in tables if not self._is_vocabulary_table(t)]
+        return partition_tables, shared_tables
+    
+    def _is_table_empty(self, table: str) -> bool:
+        """Check whether a source table has no rows"""
+        if self.staged_source is not None:
+            return self.staged_source.count_rows(table) == 0
         schema, table_name = table.split('.')
+        with self._connect() as conn:
+            # Probe for a single row rather than counting the whole table
+            result = conn.execute(text(f"SELECT EXISTS (SELECT 1 FROM {schema}.{table_name})"))
+            return not result.scalar()
+    
+    def _export_table_data(self, file_handle, table: str, partition_index: int, condition: str = None) -> int:
+        """
+        Export data for a specific table to a partition, optionally only the rows
+        matching a condition (e.g. a range of blocks, see _get_scan_condition)
+        Returns the number of rows written
+        """
+        table_name = table.split('.')[1]
+        
+        if self._is_table_empty(table):
+            logger.info(f"Table {table_name} is empty, skipping")
+            return 0
+        
+        kind = self._get_table_kind(table)
+        if kind == 'person':
+            return self._export_person_dependent_data(file_handle, table, partition_index, condition)
+        elif kind == 'linked':
+            return self._export_linked_data(file_handle, table, partition_index, condition)
+        else:
+            return self._export_full_table_data(file_handle, table, condition)
+    
+    def _export_table_data_fan_out(self, file_handles: List, table: str, condition: str = None) -> List[int]:
+        """
+        Export data for a specific table to all partitions with a single source scan,
+        optionally of the rows matching a condition only
         
-        query = f"""
-            SELECT ee.* 
-            FROM {schema}.{table_name} ee
-            JOIN {schema}.episode e ON ee.episode_id = e.episode_id
-            WHERE (e.person_id % {self.num_partitions}) = {partition_index}
+        Person-dependent rows are routed to the file of their partition, rows of
+        replicated tables are written to every file.
+        Returns the number of rows written per partition
         """
+        table_name = table.split('.')[1]
         
-        self._export_query_data(file_handle, table, query)
-        logger.info(f"Exported episode_event data for partition {partition_index} based on episode.person_id")
+        if self._is_table_empty(table):
+            logger.info(f"Table {table_name} is empty, skipping")
+            return [0] * len(file_handles)
+        
+        kind = self._get_table_kind(table)
+        if self.staged_source is not None:
+            rows = self._export_staged_data_fan_out(file_handles, table, kind)
+        elif kind == 'person':
+            query = self._get_table_query(table, condition)
+            rows = self._export_query_data_fan_out(file_handles, table, query, route_column='person_id')
+            logger.info(f"Exported {table_name} data for all partitions using the {self.strategy} strategy on person_id")
+        elif kind == 'linked':
+            router = self._get_link_routers()[table]
+            query = self._get_table_query(table, condition)
+            rows = self._export_query_data_fan_out(file_handles, table, query, router=router)
+            logger.info(f"Exported {table_name} data for all partitions through {', '.join(router.parents)}")
+        else:
+            query = self._get_table_query(table, condition)
+            rows = self._export_query_data_fan_out(file_handles, table, query)
+            logger.info(f"Exported full {table_name} data to all partitions")
+        return rows
+    
+    def _export_person_dependent_data(self, file_handle, table: str, partition_index: int,
+                                      condition: str = None) -> int:
+        """Export person-dependent table data using the partition predicate of the strategy on person_id"""
+        table_name = table.split('.')[1]
+        
+        query = self._get_partition_query(table, partition_index, condition)
+        
+        rows = self._export_query_data(file_handle, table, query)
+        logger.info(f"Exported {table_name} data for partition {partition_index} using the {self.strategy} strategy on person_id")
+        return rows
+    
+    def _export_linked_data(self, file_handle, table: str, partition_index: int, condition: str = None) -> int:
+        """Export the rows of a linked table whose parent rows belong to the partition, and those of no person"""
+        table_name = table.split('.')[1]
+        
+        query = self._get_partition_query(table, partition_index, condition)
+        
+        rows = self._export_query_data(file_handle, table, query)
+        logger.info(f"Exported {table_name} data for partition {partition_index} through "
+                    f"{', '.join(self._get_link_routers()[table].parents)}")
+        return rows
     
-    def _export_person_dependent_data(self, file_handle, table: str, partition_index: int):
-        """Export person-dependent table data using modulus on person_id"""
+    def _get_partition_query(self, table: str, partition_index: int, condition: str = None) -> str:
+        """
+        Query selecting the rows of a person-dependent table that belong to a partition,
+        optionally narrowed by a condition on the table's rows
+        The partition is selected by the predicate of the distribution strategy; linked
+        tables select it through their parent rows and also give every partition their
+        rows of no person.
+        """
         schema, table_name = table.split('.')
+        kind = self._get_table_kind(table)
         
-        query = f"SELECT * FROM {schema}.{table_name} WHERE (person_id % {self.num_partitions}) = {partition_index}"
+        if kind == 'linked':
+            router = self._get_link_routers()[table]
+            owner = router.get_owner_condition(
+                lambda column: self._get_distribution().get_partition_predicate(column, partition_index,
+                                                                                self.num_partitions))
+            query = f"SELECT * FROM {schema}.{table_name} WHERE (({owner}) OR ({router.get_shared_condition()}))"
+        else:
+            predicate = self._get_distribution().get_partition_predicate('person_id', partition_index,
+                                                                         self.num_partitions)
+            query = f"SELECT * FROM {schema}.{table_name} WHERE {predicate}"
         
-        self._export_query_data(file_handle, table, query)
-        logger.info(f"Exported {table_name} data for partition {partition_index} using modulus on person_id")
+        if condition:
+            query += f" AND {condition}"
+        return query
     
-    def _export_full_table_data(self, file_handle, table: str):
+    def _export_full_table_data(self, file_handle, table: str, condition: str = None) -> int:
         """Export full table data (for lookup tables)"""
-        schema, table_name = table.split('.')
+        table_name = table.split('.')[1]
         
-        query = f"SELECT * FROM {schema}.{table_name}"
+        query = self._get_table_query(table, condition)
         
-        self._export_query_data(file_handle, table, query)
+        rows = self._export_query_data(file_handle, table, query)
         logger.info(f"Exported full {table_name} data")
+        return rows
+    
+    def _get_table_query(self, table: str, condition: str = None) -> str:
+        """Query selecting all rows of a table, or those matching a condition"""
+        schema, table_name = table.split('.')
+        query = f"SELECT * FROM {schema}.{table_name}"
+        if condition:
+            query += f" WHERE {condition}"
+        return query
     
-    def _export_query_data(self, file_handle, table: str, query: str):
+    def _export_query_data(self, file_handle, table: str, query: str, upsert: bool = False) -> int:
         """
         Export data using a custom query and write in pgdump INSERT format
+
+        Rows are streamed through a server-side cursor and written batch by
+        batch, so memory use is bounded by the fetch size rather than the
+        size of the table. With upsert, rows are written as INSERT ... ON CONFLICT
+        statements keyed on the primary key, whatever the output format.
+        Returns the number of rows written.
         """
         schema, table_name = table.split('.')
         
-        with self.source_engine.connect() as conn:
-            # Get column information
-            result = conn.execute(text(f"""
-                SELECT column_name, data_type, is_nullable, column_default
-                FROM information_schema.columns 
-                WHERE table_schema = '{schema}' 
-                AND table_name = '{table_name}'
-                ORDER BY ordinal_position
-            """))
-            cols_meta = [(row[0], row[1], row[2] == 'YES', row[3]) for row in result]
-            columns = [c for c, _, _, _ in cols_meta]
-            nullable_cols = [c for c, _, is_null, _ in cols_meta if is_null]
-            
+        with self._connect() as conn:
+            columns, nullable_cols = self._get_table_columns(table)
             if not columns:
                 logger.warning(f"No columns found for table {table}")
-                return
+                return 0
             
-            # Execute the query
-            result = conn.execute(text(query))
-            rows = result.fetchall()
+            fetch_size = self._get_fetch_size(table)
+            if upsert:
+                info = self.get_catalog().get_table(table)
+                writer = UpsertTableWriter(file_handle, schema, table_name, columns, nullable_cols,
+                                           data_types=info.column_types, conflict_columns=info.primary_key)
+            elif self.use_copy:
+                return self._copy_query_data(conn, file_handle, schema, table_name, columns, query)
+            else:
+                writer = self._create_table_writer(file_handle, schema, table_name, columns, nullable_cols)
             
-            if not rows:
+            # Execute the query on a server-side (named) cursor
+            result = conn.execution_options(yield_per=fetch_size).execute(text(query))
+            for batch in result.partitions():
+                writer.write_rows(batch)
+            
+            rows_written = writer.close()
+            if not rows_written:
                 logger.info(f"No data found for table {table_name} with given query")
-                return
+            return rows_written
+    
+    def _copy_query_data(self, conn, file_handle, schema: str, table_name: str, columns: List[str], query: str) -> int:
+        """
+        Write a COPY block whose data is produced by the server with COPY (query) TO STDOUT
+        
+        The CSV bytes are piped unchanged from the source connection into the file,
+        so values are encoded exactly as PostgreSQL's own text output and can be
+        read back by COPY FROM without any conversion in Python.
+        Returns the number of rows copied, or 0 if the server did not report it.
+        """
+        file_handle.write(f"\n-- Data for table {schema}.{table_name}\n")
+        file_handle.write(f"SET search_path TO {schema}, public;\n\n")
+        file_handle.write(f"COPY {schema}.{table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv);\n")
+        file_handle.flush()
+        
+        # Use the DBAPI connection of conn so that the COPY runs in the same
+        # transaction (and snapshot) as the rest of the export
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, ENCODING 'UTF8')", file_handle.buffer)
+            rows_copied = max(cursor.rowcount, 0)
+        finally:
+            cursor.close()
+        
+        file_handle.write("\\.\n\n")
+        file_handle.write(f"-- {rows_copied} rows exported for table {schema}.{table_name}\n\n")
+        return rows_copied
+    
+    def _export_query_data_fan_out(self, file_handles: List, table: str, query: str,
+                                   route_column: str = None, router: LinkRouter = None) -> List[int]:
+        """
+        Export data using a custom query, routing each row to one partition file
+        
+        Args:
+            file_handles: Open partition files, indexed by partition
+            table: Fully qualified table name
+            query: Query producing the rows of the table
+            route_column: Person column whose value selects the partition, as assigned by
+                the distribution strategy; None writes every row to all partitions
+            router: Routes the rows of a linked table through their parent rows instead
+        Returns the number of rows written per partition.
+        """
+        schema, table_name = table.split('.')
+        
+        with self._connect() as conn:
+            columns, nullable_cols = self._get_table_columns(table)
+            if not columns:
+                logger.warning(f"No columns found for table {table}")
+                return [0] * len(file_handles)
             
-            # Write table header
-            file_handle.write(f"\n-- Data for table {schema}.{table_name} ({len(rows)} rows)\n")
-            file_handle.write(f"SET search_path TO {schema}, public;\n\n")
+            route_index = columns.index(route_column) if route_column is not None else None
             
-            if self.use_copy:
-                # Use COPY statements for maximum performance
-                self._write_copy_data(file_handle, schema, table_name, columns, rows, nullable_cols)
+            fetch_size = self._get_fetch_size(table)
+            writers = [
+                self._create_table_writer(f, schema, table_name, columns, nullable_cols)
+                for f in file_handles
+            ]
+            
+            # One server-side scan for all partitions
+            result = conn.execution_options(yield_per=fetch_size).execute(text(query))
+            if router is not None:
+                self._route_linked_batches(writers, result.partitions(), router, columns)
             else:
-                # Write data in bulk INSERT format for better performance
-                column_list = ', '.join(columns)
-                batch_size = 1000  # Insert 1000 rows per statement
-                
-                for batch_start in range(0, len(rows), batch_size):
-                    batch_end = min(batch_start + batch_size, len(rows))
-                    batch_rows = rows[batch_start:batch_end]
-                    
-                    # Build VALUES clause for this batch
-                    value_clauses = []
-                    for row in batch_rows:
-                        values = []
-                        for i, value in enumerate(row):
-                            if value is None:
-                                values.append('NULL')
-                            elif isinstance(value, str):
-                                # Escape single quotes
-                                escaped_value = value.replace("'", "''")
-                                values.append(f"'{escaped_value}'")
-                            elif isinstance(value, (int, float)):
-                                values.append(str(value))
-                            else:
-                                # Convert to string and escape
-                                escaped_value = str(value).replace("'", "''")
-                                values.append(f"'{escaped_value}'")
-                        
-                        value_clauses.append(f"({', '.join(values)})")
-                    
-                    # Write bulk INSERT statement
-                    values_sql = ',\n    '.join(value_clauses)
-                    file_handle.write(f"INSERT INTO {schema}.{table_name} ({column_list}) VALUES\n    {values_sql};\n\n")
+                self._route_batches(writers, result.partitions(), route_index)
+            
+            return [writer.close() for writer in writers]
+    
+    def _route_batches(self, writers: List, batches, route_index: int = None):
+        """
+        Write batches of rows to the partition writers, routing each row on the value
+        at route_index (every row to all writers if None)
+        
+        The partitions of a whole batch are computed at once from its key column and
+        the batch is split with one sort, see the assignment module.
+        """
+        for batch in batches:
+            if route_index is None:
+                for writer in writers:
+                    writer.write_rows(batch)
+                continue
             
-            file_handle.write("\n")
+            parts = self._assign_partitions_with_nulls(*get_batch_keys(batch, route_index))
+            for writer, rows in zip(writers, split_batch(batch, parts, self.num_partitions)):
+                writer.write_rows(rows)
+    
+    def _route_linked_batches(self, writers: List, batches, router: LinkRouter, columns: List[str]):
+        """
+        Write batches of rows of a linked table to the partition writers, routing each
+        row to the partition of its parent row; rows of no person go to every writer
+        """
+        column_index = {column: i for i, column in enumerate(columns)}
+        for batch in batches:
+            parts = router.assign_partitions(
+                len(batch),
+                lambda column: get_batch_keys(batch, column_index[column]),
+                lambda column: np.array([row[column_index[column]] for row in batch], dtype=object),
+                self._get_parent_partitions)
+            shared = parts == ALL_PARTITIONS
+            if shared.any():
+                shared_rows = [row for row, is_shared in zip(batch, shared.tolist()) if is_shared]
+                for writer in writers:
+                    writer.write_rows(shared_rows)
+                parts[shared] = NO_PARTITION
+            for writer, rows in zip(writers, split_batch(batch, parts, self.num_partitions)):
+                writer.write_rows(rows)
+    
+    def _assign_partitions(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Partition of every person key in an array, as the distribution strategy assigns
+        them (and its predicate selects them in the filtered export)
+        """
+        return self._get_distribution().assign_partitions(keys, self.num_partitions)
+    
+    def _get_distribution(self) -> DistributionStrategy:
+        """Return the distribution strategy, prepared on first use"""
+        if not self._distribution_prepared:
+            self._prepare_distribution()
+        return self.distribution
+    
+    def _prepare_distribution(self, parameters: Dict = None) -> Dict:
+        """
+        Prepare the distribution strategy before any rows are assigned: restore the
+        parameters of a previous run (and its person map, see _load_person_map), or
+        compute what the strategy needs from the source or the staged cache
+        Returns the parameters, to be recorded in the run manifest
+        """
+        if parameters:
+            self.distribution.set_parameters(parameters)
+            if self.distribution.has_person_map:
+                self._load_person_map(parameters.get('person_map'))
+        if self.distribution.uses_person_keys and not self.distribution.is_prepared:
+            self.distribution.catalog = self.get_catalog()
+            if self.staged_source is not None:
+                self.distribution.prepare(self.num_partitions, staged_source=self.staged_source)
+            else:
+                with self._connect() as conn:
+                    self.distribution.prepare(self.num_partitions, conn=conn)
+        self._distribution_prepared = True
+        return self.distribution.get_parameters()
+    
+    def get_person_map_path(self) -> str:
+        return os.path.join(self.output_dir, PERSON_MAP_FILE_NAME)
+    
+    def _save_person_map(self):
+        """
+        Save the person map of the strategy next to the run manifest, which records its
+        digest, so that runs reusing this run's segments assign persons the same way
+        """
+        person_keys, person_partitions = self.distribution.get_person_map()
+        path = self.get_person_map_path()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, person_keys=person_keys, person_partitions=person_partitions)
+        os.replace(tmp_path, path)
+    
+    def _load_person_map(self, digest: str):
+        """Restore the person map a previous run saved, checking it against the digest its manifest recorded"""
+        path = self.get_person_map_path()
+        if not digest or not os.path.exists(path):
+            raise ValueError(f"The person map of the previous {self.strategy} run was not recorded in {path}, "
+                             f"so its segments cannot be reused; start a new export")
+        with np.load(path) as data:
+            person_keys, person_partitions = data['person_keys'], data['person_partitions']
+        if get_person_map_digest(person_keys, person_partitions) != digest:
+            raise ValueError(f"The person map in {path} does not match the run manifest; start a new export")
+        self.distribution.set_person_map(person_keys, person_partitions)
+    
+    def _assign_partitions_with_nulls(self, keys: np.ndarray, valid: np.ndarray = None) -> np.ndarray:
+        """Partition of every person key, with no partition for the NULL keys marked in valid"""
+        parts = self._assign_partitions(keys)
+        if valid is not None:
+            parts[~valid] = NO_PARTITION
+        return parts
     
-    def _write_copy_data(self, file_handle, schema: str, table_name: str, columns: List[str], rows: List, nullable_cols: List[str] = None):
+    def _export_staged_data_fan_out(self, file_handles: List, table: str, kind: str) -> List[int]:
         """
-        Write data using COPY statements for maximum performance
+        Export a table from the staged cache to all partitions, routing rows by the
+        same rules as the fan-out export of the source
+        Returns the number of rows written per partition
         """
-        import csv
+        schema, table_name = table.split('.')
+        columns, nullable_cols = self._get_table_columns(table)
+        writers = [
+            self._create_table_writer(f, schema, table_name, columns, nullable_cols)
+            for f in file_handles
+        ]
         
-        # Build FORCE_NULL clause for nullable columns
-        force_null_clause = f", FORCE_NULL ({', '.join(nullable_cols)})" if nullable_cols else ""
+        key_index = columns.index('person_id') if kind == 'person' else None
+        router = self._get_link_routers()[table] if kind == 'linked' else None
         
-        # Write COPY statement with proper NULL handling
-        file_handle.write(
-            f"COPY {schema}.{table_name} ({', '.join(columns)}) "
-            f"FROM STDIN WITH (FORMAT CSV, DELIMITER ',', QUOTE '\"', ESCAPE '\"', HEADER FALSE, NULL ''{force_null_clause});\n"
-        )
+        # Rows are split at the Arrow level and only converted to Python per partition
+        for batch in self.staged_source.read_batches(table):
+            if key_index is None and router is None:
+                rows = record_batch_rows(batch)
+                for writer in writers:
+                    writer.write_rows(rows)
+                continue
+            
+            if router is not None:
+                parts = router.assign_partitions(
+                    batch.num_rows,
+                    lambda column: get_column_keys(batch.column(column)),
+                    lambda column: batch.column(column).to_numpy(zero_copy_only=False),
+                    self._get_parent_partitions)
+                shared = parts == ALL_PARTITIONS
+                if shared.any():
+                    # Rows of no person go to every partition
+                    rows = record_batch_rows(batch.take(np.flatnonzero(shared)))
+                    for writer in writers:
+                        writer.write_rows(rows)
+                    parts[shared] = NO_PARTITION
+            else:
+                parts = self._assign_partitions_with_nulls(*get_column_keys(batch.column(key_index)))
+            for writer, positions in zip(writers, split_by_partition(parts, self.num_partitions)):
+                if len(positions):
+                    writer.write_rows(record_batch_rows(batch.take(positions)))
         
-        # Write CSV data directly to file handle
-        writer = csv.writer(file_handle, quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
-        for row in rows:
-            # Convert None to empty string - PostgreSQL will treat empty strings as NULL for nullable columns
-            writer.writerow(['' if v is None else v for v in row])
+        logger.info(f"Exported {table_name} data to all partitions from the staged cache")
+        return [writer.close() for writer in writers]
+    
+    def _get_table_columns(self, table: str) -> Tuple[List[str], List[str]]:
+        """Return the column names of a table in ordinal order and the nullable ones"""
+        info = self.get_catalog().get_table(table)
+        if info is None:
+            return [], []
+        return info.column_names, info.nullable_columns
+    
+    def _create_table_writer(self, file_handle, schema: str, table_name: str, columns: List[str],
+                             nullable_cols: List[str]):
+        """
+        Create the table writer for the configured output format
+        Used where rows pass through Python, e.g. when they are routed in fan-out mode;
+        for Parquet output file_handle is the path of the file to write
+        """
+        info = self.get_catalog().get_table(f"{schema}.{table_name}")
+        data_types = info.column_types if info is not None else None
+        if self.output_format == 'parquet':
+            # Parquet keeps the precision and scale of numeric columns, e.g. numeric(10,2)
+            arrow_types = ([c.declared_type if c.data_type == 'numeric' else c.data_type for c in info.columns]
+                           if info is not None else [None] * len(columns))
+            return ParquetTableWriter(file_handle, columns, arrow_types, self.compress, self.compress_level)
+        if self.use_copy:
+            # Use COPY statements for maximum performance
+            return CopyTableWriter(file_handle, schema, table_name, columns, nullable_cols)
+        # Write data in bulk INSERT format for better performance, with value
+        # encoders compiled for the column types
+        return InsertTableWriter(file_handle, schema, table_name, columns, nullable_cols, data_types)
+    
+    def _get_fetch_size(self, table: str) -> int:
+        """
+        Pick the server-side cursor fetch size for a table from its average row width,
+        so that each fetched batch holds roughly STREAM_BATCH_BYTES of data
+        """
+        info = self.get_catalog().get_table(table)
+        row_width = info.estimate_row_width() if info is not None else 0
         
-        file_handle.write("\\.\n\n")
+        if row_width <= 0:
+            return STREAM_MIN_FETCH_ROWS
+        fetch_size = int(STREAM_BATCH_BYTES // row_width)
+        fetch_size = max(STREAM_MIN_FETCH_ROWS, min(STREAM_MAX_FETCH_ROWS, fetch_size))
+        logger.debug(f"Streaming {table} with fetch size {fetch_size} (~{row_width:.0f} bytes/row)")
+        return fetch_size
     
     def export_all_partitions(self, graph: nx.DiGraph) -> List[str]:
         """
@@ -440,14 +1179,28 @@ class SQLExporter:
         exported_files = []
         
         # First export the schema
-        schema_file = self.export_schema_sql()
+        schema_file, post_data_file = self._export_schema_files()
         exported_files.append(schema_file)
+        if post_data_file:
+            exported_files.append(post_data_file)
         
         # Then export data for each partition
+        tables, shared_tables = self._split_shared_tables(self._get_source_tables())
+        manifest = self._open_run_manifest(tables + shared_tables)
+        segments, shared_segments = self._export_segments(tables, shared_tables, manifest)
+        if shared_tables:
+            exported_files.append(self._write_vocabulary_file(None, shared_segments, shared_tables))
         for i in range(self.num_partitions):
-            partition_file = self.export_partition_data(i, graph)
+            partition_file = self._get_output_file(f"partition_{i}.sql")
+            with open(partition_file, 'wb') as raw_f:
+                with self._open_output_member(raw_f) as out_f:
+                    self._write_partition_data_header(out_f, i)
+                self._append_segments(raw_f, segments[i], tables)
             exported_files.append(partition_file)
+            logger.info(f"Partition {i} data exported to {partition_file}")
         
+        self._remove_segments()
+        self._complete_run_manifest(manifest)
         logger.info(f"Exported {len(exported_files)} SQL files to {self.output_dir}")
         return exported_files
     
@@ -458,87 +1211,990 @@ class SQLExporter:
         """
         combined_files = []
         
-        # First export the schema
-        schema_file = self.export_schema_sql()
+        # First export the schema (tables before the data, indexes and constraints
+        # after it when the schema is split)
+        schema_file, post_data_file = self._export_schema_files()
+        
+        # Get tables in dependency order, handling cycles
+        # Use a custom ordering that prioritizes vocabulary tables
+        tables = self._get_ordered_tables(graph)
+        
+        # Export data for each table into per-partition segments
+        tables, shared_tables = self._split_shared_tables(tables)
+        manifest = self._open_run_manifest(tables + shared_tables)
+        segments, shared_segments = self._export_segments(tables, shared_tables, manifest)
+        
+        # With a shared vocabulary the schema goes to vocabulary.sql, which is loaded
+        # before any partition file
+        if shared_tables:
+            self._write_vocabulary_file(schema_file, shared_segments, shared_tables)
+            schema_file = None
         
         # Create combined files for each partition
         for i in range(self.num_partitions):
-            combined_file = os.path.join(self.output_dir, f"partition_{i}_complete.sql")
+            combined_file = self._get_output_file(f"partition_{i}_complete.sql")
             
             logger.info(f"Creating combined file for partition {i}")
             
-            with open(combined_file, 'w') as out_f:
-                # Write header
-                out_f.write(f"-- OMOP Partition {i} Complete Export\n")
+            # Header, segments and footer are written as separate compressed members,
+            # which concatenate into one valid gzip/zstd stream
+            with open(combined_file, 'wb') as raw_f:
+                with self._open_output_member(raw_f) as out_f:
+                    self._write_partition_prologue(out_f, i, schema_file)
+                self._append_segments(raw_f, segments[i], tables)
+                with self._open_output_member(raw_f) as out_f:
+                    self._write_partition_epilogue(out_f, post_data_file)
+            
+            combined_files.append(combined_file)
+            logger.info(f"Created combined file: {combined_file}")
+        
+        self._remove_segments()
+        self._complete_run_manifest(manifest)
+        return combined_files
+    
+    def _get_segment_dir(self, partition_index: int) -> str:
+        """
+        Directory of the segments of one partition; binary COPY and Parquet segments
+        are part of the output and live next to the partition files
+        """
+        directory = "vocabulary" if partition_index == SHARED_PARTITION else f"partition_{partition_index}"
+        if self.output_format != 'sql':
+            return os.path.join(self.output_dir, directory)
+        return os.path.join(self.segments_dir, directory)
+    
+    def _get_segment_file(self, partition_index: int, table: str, scan_range: Tuple = None) -> str:
+        """
+        Path of the segment holding one table's data for one partition, or the rows of one
+        range of its blocks; the name records the blocks, so a resumed run only reuses
+        segments of the same ranges
+        """
+        table_name = table.split('.')[1]
+        blocks = "" if scan_range is None else f"blocks-{scan_range[0]}-{scan_range[1] or 'end'}"
+        if self.output_format == 'parquet':
+            # One dataset directory per table, readable as a whole by Spark or DuckDB
+            return os.path.join(self._get_segment_dir(partition_index), table_name,
+                                f"part-{blocks or 0}.parquet")
+        extension = ".pgcopy" if self.output_format == 'binary-copy' else ".sql"
+        segment_file = os.path.join(self._get_segment_dir(partition_index),
+                                    table_name + (f".{blocks}" if blocks else "") + extension)
+        return get_compressed_path(segment_file, self.compress)
+    
+    def _get_scan_ranges(self, table: str) -> List[Optional[Tuple]]:
+        """
+        Ranges of blocks (first block, end block or None for the rest of the table) that
+        a table is scanned in, on parallel jobs: up to one per job for tables of more than
+        scan_range_pages pages, so that one huge table does not leave the other jobs idle;
+        [None] for tables scanned whole
+        """
+        info = self.get_catalog().get_table(table)
+        if (self.jobs == 1 or not self.scan_range_pages or self.staged_source is not None
+                or info is None or info.relpages <= self.scan_range_pages):
+            return [None]
+        if self._get_server_version() < TID_RANGE_SCAN_VERSION:
+            logger.info(f"Scanning {table} whole: ranges of blocks need TID range scans (PostgreSQL 14+)")
+            return [None]
+        count = min(self.jobs, -(-info.relpages // self.scan_range_pages))
+        bounds = [info.relpages * k // count for k in range(count)]
+        # The last range is open, so pages added since the statistics were taken are not missed
+        return list(zip(bounds, bounds[1:] + [None]))
+    
+    def _get_server_version(self) -> int:
+        """server_version_num of the source database, e.g. 140005 for PostgreSQL 14.5"""
+        if self.server_version is None:
+            with self.source_engine.connect() as conn:
+                self.server_version = int(conn.execute(text("SHOW server_version_num")).scalar())
+        return self.server_version
+    
+    def _get_scan_condition(self, scan_range: Optional[Tuple]) -> Optional[str]:
+        """
+        Condition selecting the rows stored in a range of blocks, by their ctid; PostgreSQL 14
+        and later read only those blocks (TID range scan)
+        """
+        if scan_range is None:
+            return None
+        start, end = scan_range
+        condition = f"ctid >= '({start},0)'::tid"
+        if end is not None:
+            condition += f" AND ctid < '({end},0)'::tid"
+        return condition
+    
+    def _export_segments(self, tables: List[str], shared_tables: List[str] = (),
+                         manifest: RunManifest = None) -> Tuple[List[List[List[str]]], List[List[str]]]:
+        """
+        Export the data of every table into segment files per (partition, table)
+        
+        Units of work are (partition, table) pairs, or whole tables in fan-out mode.
+        Shared tables are exported once into segments of the vocabulary file.
+        With jobs > 1 they run on a process pool whose workers are all attached to
+        one exported snapshot, so the partitions stay mutually consistent; huge tables
+        are then split into ranges of blocks that are exported as separate units into
+        segments of their own (see _get_scan_ranges).
+        In incremental mode the segments of unchanged tables are reused from the cache.
+        Finished segments are checkpointed in the run manifest, and with resume the
+        units whose segments it already records are skipped.
+        Returns the segment files of every table of each partition and of every shared
+        table, in table order and, within a table, in the order of its ranges.
+        """
+        scan_ranges = {table: self._get_scan_ranges(table) for table in list(tables) + list(shared_tables)}
+        segments = [
+            [[self._get_segment_file(i, table, scan_range) for scan_range in scan_ranges[table]] for table in tables]
+            for i in range(self.num_partitions)
+        ]
+        shared_segments = [
+            [self._get_segment_file(SHARED_PARTITION, table, scan_range) for scan_range in scan_ranges[table]]
+            for table in shared_tables
+        ]
+        os.makedirs(self.segments_dir, exist_ok=True)
+        for i in range(self.num_partitions):
+            os.makedirs(self._get_segment_dir(i), exist_ok=True)
+        if shared_tables:
+            os.makedirs(self._get_segment_dir(SHARED_PARTITION), exist_ok=True)
+        
+        if self.output_format == 'parquet':
+            self._remove_stale_parts(shared_segments + [files for partition in segments for files in partition])
+        
+        # (table, partition_index, segment files, range of blocks); partition_index None means fan-out
+        units = [
+            (table, SHARED_PARTITION, [shared_segments[pos][k]], scan_range)
+            for pos, table in enumerate(shared_tables) for k, scan_range in enumerate(scan_ranges[table])
+        ]
+        for pos, table in enumerate(tables):
+            for k, scan_range in enumerate(scan_ranges[table]):
+                if self.fan_out or self._is_routed_by_key_map(table):
+                    units.append((table, None, [segments[i][pos][k] for i in range(self.num_partitions)], scan_range))
+                else:
+                    units.extend((table, i, [segments[i][pos][k]], scan_range) for i in range(self.num_partitions))
+        
+        if not self.incremental:
+            self._run_segment_units(self._filter_finished_units(manifest, units), manifest)
+            return segments, shared_segments
+        
+        cache = SegmentCache.load(os.path.join(self.segments_dir, CACHE_FILE_NAME))
+        units, changed = self._filter_cached_units(cache, units)
+        self._run_segment_units(self._filter_finished_units(manifest, units), manifest)
+        for table, (fingerprint, segment_files) in changed.items():
+            stats = {}
+            for segment_file in segment_files:
+                key = self._get_manifest_key(segment_file)
+                stats[key] = manifest.get_segment(key)
+            cache.update(table, fingerprint, segment_files, stats)
+        cache.save()
+        # Reused segments belong to this run too; record them so the manifest (and the
+        # balance report and move planning built on it) cover every table
+        for table in cache.entries:
+            if table not in changed:
+                for key, entry in cache.get_stats(table).items():
+                    manifest.record_segment(key, entry['table'], entry['partition'],
+                                            entry['rows'], entry['bytes'], entry['sha256'])
+        manifest.save()
+        return segments, shared_segments
+    
+    def _remove_stale_parts(self, table_segments: List[List[str]]):
+        """
+        Remove the Parquet files of a previous run, split into other ranges, from the
+        dataset directories of the tables, which are read as a whole
+        """
+        for segment_files in table_segments:
+            directory = os.path.dirname(segment_files[0])
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if name.endswith('.parquet') and path not in segment_files:
+                    os.remove(path)
+    
+    def _is_routed_by_key_map(self, table: str) -> bool:
+        """
+        Whether a table is exported from one scan routed by the key→partition maps of its
+        parent tables even without fan-out: linked tables, whose rows binary COPY cannot route
+        """
+        return self._get_table_kind(table) == 'linked' and self.output_format != 'binary-copy'
+    
+    def _filter_cached_units(self, cache: SegmentCache, units: List[Tuple]) -> Tuple[List[Tuple], Dict]:
+        """
+        Drop the units of tables whose cached segments are still valid
+        Returns the remaining units and, for every table that must be exported again,
+        its new fingerprint and segment files
+        """
+        files_by_table = {}
+        for table, _, segment_files, _ in units:
+            files_by_table.setdefault(table, []).extend(segment_files)
+        
+        changed = {}
+        for table, segment_files in files_by_table.items():
+            fingerprint = self._get_table_fingerprint(table)
+            if cache.get_segments(table, fingerprint, segment_files) is not None:
+                logger.info(f"Reusing cached segments of unchanged table {table}")
+            else:
+                cache.invalidate(table)
+                changed[table] = (fingerprint, segment_files)
+        
+        for table in cache.prune(files_by_table):
+            logger.info(f"Removed cached segments of table {table}")
+        # Persist the invalidations before any segment is overwritten
+        cache.save()
+        
+        logger.info(f"{len(changed)} of {len(files_by_table)} tables changed since the last export")
+        return [unit for unit in units if unit[0] in changed], changed
+    
+    def _get_table_fingerprint(self, table: str) -> Dict:
+        """
+        Cheap change fingerprint of the data exported for a table: the change counters of
+        the table (and of the parent tables of linked tables, which they are routed through,
+        and of person for strategies that assign by the person IDs) together with the settings that determine how its rows are split and written
+        """
+        fingerprint = {'num_partitions': self.num_partitions, 'use_copy': self.use_copy, 'strategy': self.strategy,
+                       'distribution': self._get_distribution().get_parameters()}
+        dependencies = [table]
+        kind = self._get_table_kind(table)
+        if kind == 'linked':
+            router = self._get_link_routers()[table]
+            fingerprint['routing'] = router.to_dict()
+            dependencies.extend(p for p in router.parents if p not in dependencies)
+        if (kind in ('person', 'linked') and self.distribution.uses_person_keys
+                and self.person_table not in dependencies):
+            dependencies.append(self.person_table)
+        for dependency in dependencies:
+            info = self.get_catalog().get_table(dependency)
+            fingerprint[dependency] = info.change_fingerprint() if info is not None else None
+        return fingerprint
+    
+    def _filter_finished_units(self, manifest: RunManifest, units: List[Tuple]) -> List[Tuple]:
+        """Drop the units whose segments a resumed run already finished"""
+        if not self.resume or manifest is None:
+            return units
+        
+        remaining = [
+            unit for unit in units
+            if not all(self._is_segment_finished(manifest, f) for f in unit[2])
+        ]
+        logger.info(f"Resuming: {len(units) - len(remaining)} of {len(units)} units already finished")
+        return remaining
+    
+    def _is_segment_finished(self, manifest: RunManifest, segment_file: str) -> bool:
+        """
+        Check that the manifest records a segment and the file on disk still matches it,
+        by size first and then by checksum, so a segment rewritten in place is exported again
+        """
+        entry = manifest.get_segment(self._get_manifest_key(segment_file))
+        return (entry is not None and os.path.exists(segment_file)
+                and os.path.getsize(segment_file) == entry['bytes']
+                and file_checksum(segment_file) == entry['sha256'])
+    
+    def _get_manifest_key(self, segment_file: str) -> str:
+        """Segment path as recorded in the manifest, relative to the output directory"""
+        return os.path.relpath(segment_file, self.output_dir)
+    
+    def _record_segments(self, manifest: RunManifest, table: str, partition_index, stats: List[Dict]):
+        """Checkpoint the finished segments of one unit in the run manifest"""
+        if partition_index is None:
+            partitions = list(range(self.num_partitions))
+        else:
+            partitions = [partition_index]
+        for partition, segment_stats in zip(partitions, stats):
+            manifest.record_segment(self._get_manifest_key(segment_stats.pop('path')),
+                                    table=table, partition=partition, **segment_stats)
+        manifest.save()
+    
+    def _run_segment_units(self, units: List[Tuple], manifest: RunManifest = None):
+        """Export units of work, in process or on a process pool sharing one snapshot"""
+        if not units:
+            return
+        
+        if self.jobs == 1:
+            for table, partition_index, segment_files, scan_range in units:
+                stats = self._export_segment(table, partition_index, segment_files, scan_range)
+                if manifest is not None:
+                    self._record_segments(manifest, table, partition_index, stats)
+            return
+        
+        logger.info(f"Exporting {len(units)} units with {self.jobs} parallel jobs")
+        with self._export_snapshot() as snapshot_id:
+            distribution = self._get_distribution()
+            # Parent keys are read in the snapshot the workers export the child rows from
+            self.snapshot_id = snapshot_id
+            try:
+                key_maps = self._build_key_maps(units)
+            finally:
+                self.snapshot_id = None
+            with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_segment_worker,
+                                     initargs=(self._get_exporter_config(), snapshot_id, self.get_catalog(),
+                                               distribution, self._get_link_routers(), key_maps)) as pool:
+                futures = {pool.submit(_run_segment_unit, *unit): unit[3] for unit in units}
+                for future in as_completed(futures):
+                    table, partition_index, stats = future.result()
+                    if manifest is not None:
+                        self._record_segments(manifest, table, partition_index, stats)
+                    if partition_index is None:
+                        target = "all partitions"
+                    elif partition_index == SHARED_PARTITION:
+                        target = "shared vocabulary"
+                    else:
+                        target = f"partition {partition_index}"
+                    scan_range = futures[future]
+                    if scan_range is not None:
+                        target += f" (blocks {scan_range[0]} to {scan_range[1] or 'end'})"
+                    logger.info(f"Finished {table} for {target}")
+    
+    def _export_segment(self, table: str, partition_index, segment_files: List[str],
+                        scan_range: Tuple = None) -> List[Dict]:
+        """
+        Export one table for one partition, or for all partitions in fan-out mode,
+        optionally only the rows in a range of its blocks
+        
+        Segments are written to temporary files that are renamed into place once
+        complete, so a segment file that exists is never a partial one.
+        Returns the path, row count, size and checksum of every segment
+        """
+        tmp_files = [f"{segment_file}.tmp" for segment_file in segment_files]
+        condition = self._get_scan_condition(scan_range)
+        out_files = []
+        try:
+            if self.output_format == 'binary-copy':
+                out_files.append(CompressedBinaryFile(tmp_files[0], self.compress, self.compress_level,
+                                                      self.compress_threads))
+                rows = [self._export_table_data_binary(out_files[0], table, partition_index, condition)]
+            elif self.output_format == 'parquet':
+                rows = self._export_table_data_parquet(tmp_files, table, partition_index, condition)
+            else:
+                for tmp_file in tmp_files:
+                    out_files.append(self._open_output(tmp_file))
+                if partition_index is None or self.staged_source is not None:
+                    # Staged tables are always read once and routed; shared tables,
+                    # being replicated, are routed in full to their single segment
+                    rows = self._export_table_data_fan_out(out_files, table, condition)
+                elif partition_index == SHARED_PARTITION:
+                    rows = [0 if self._is_table_empty(table)
+                            else self._export_full_table_data(out_files[0], table, condition)]
+                else:
+                    rows = [self._export_table_data(out_files[0], table, partition_index, condition)]
+        finally:
+            for out_f in out_files:
+                out_f.close()
+        
+        return self._finish_segments(tmp_files, segment_files, rows)
+    
+    def _finish_segments(self, tmp_files: List[str], segment_files: List[str], rows: List[int]) -> List[Dict]:
+        """Move completed segments into place and return their stats"""
+        stats = []
+        for tmp_file, segment_file, row_count in zip(tmp_files, segment_files, rows):
+            os.replace(tmp_file, segment_file)
+            stats.append({
+                'path': segment_file,
+                'rows': row_count,
+                'size': os.path.getsize(segment_file),
+                'sha256': file_checksum(segment_file),
+            })
+        return stats
+    
+    def _export_table_data_parquet(self, paths: List[str], table: str, partition_index,
+                                   condition: str = None) -> List[int]:
+        """
+        Export one table as Parquet files, routing the rows of person-dependent tables
+        to the partitions by the same rules as the fan-out export
+        Returns the number of rows written per file
+        """
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        
+        if partition_index == SHARED_PARTITION and self.staged_source is None:
+            rows = self._export_query_data_fan_out(paths, table, self._get_table_query(table, condition))
+        else:
+            rows = self._export_table_data_fan_out(paths, table, condition)
+        
+        # Empty tables still get a file, so every partition holds every table
+        columns, _ = self._get_table_columns(table)
+        for path in paths:
+            if not os.path.exists(path):
+                self._create_table_writer(path, *table.split('.'), columns, []).close()
+        return rows
+    
+    def export_parquet_partitions(self, graph: nx.DiGraph) -> List[str]:
+        """
+        Export every partition as a directory of Parquet datasets, one per table
+        Returns list of partition directories
+        """
+        tables, shared_tables = self._split_shared_tables(self._get_ordered_tables(graph))
+        manifest = self._open_run_manifest(tables + shared_tables)
+        self._export_segments(tables, shared_tables, manifest)
+        if shared_tables:
+            self.vocabulary_file = self._get_segment_dir(SHARED_PARTITION)
+        
+        self._remove_segments()
+        self._complete_run_manifest(manifest)
+        partition_dirs = [self._get_segment_dir(i) for i in range(self.num_partitions)]
+        logger.info(f"Exported {len(partition_dirs)} Parquet partitions to {self.output_dir}")
+        return partition_dirs
+    
+    def _export_table_data_binary(self, binary_f, table: str, partition_index: int, condition: str = None) -> int:
+        """
+        Export one table for one partition (or in full) as a PGCOPY binary file,
+        optionally only the rows matching a condition
+        Returns the number of rows copied, or 0 if the server did not report it
+        """
+        if partition_index == SHARED_PARTITION or self._get_table_kind(table) == 'full':
+            query = self._get_table_query(table, condition)
+        else:
+            query = self._get_partition_query(table, partition_index, condition)
+        
+        with self._connect() as conn:
+            # Same transaction (and snapshot) as the rest of the export, see _copy_query_data
+            cursor = conn.connection.cursor()
+            try:
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT binary)", binary_f)
+                rows_copied = max(cursor.rowcount, 0)
+            finally:
+                cursor.close()
+        
+        logger.info(f"Exported {rows_copied} rows of {table} as binary COPY")
+        return rows_copied
+    
+    def _write_copy_commands(self, out_f, segment_files: List[List[str]], tables: List[str]):
+        """
+        Write psql \\copy commands loading binary COPY segments, with paths relative to the
+        output directory; compressed segments are decompressed by a client-side program
+        """
+        out_f.write("-- Binary COPY data files; run psql from the output directory\n")
+        for table_files, table in zip(segment_files, tables):
+            columns, _ = self._get_table_columns(table)
+            for segment_file in table_files:
+                path = os.path.relpath(segment_file, self.output_dir)
+                if self.compress:
+                    source = f"PROGRAM '{DECOMPRESS_COMMANDS[self.compress]} {path}'"
+                else:
+                    source = f"'{path}'"
+                out_f.write(f"\\copy {table} ({', '.join(columns)}) FROM {source} WITH (FORMAT binary)\n")
+        out_f.write("\n")
+    
+    def _append_segments(self, raw_f, segment_files: List[List[str]], tables: List[str]):
+        """
+        Append the segment files of the tables (those of their ranges of blocks one after
+        the other) to a partition file opened in binary mode, in order
+        Compressed segments are copied as-is since they are complete compressed members.
+        Binary COPY segments stay separate files and are loaded by \\copy commands instead.
+        """
+        if self.output_format == 'binary-copy':
+            with self._open_output_member(raw_f) as out_f:
+                self._write_copy_commands(out_f, segment_files, tables)
+            return
+        
+        for table_files in segment_files:
+            for segment_file in table_files:
+                with open(segment_file, 'rb') as seg_f:
+                    shutil.copyfileobj(seg_f, raw_f, 1024 * 1024)
+    
+    def _remove_segments(self):
+        """
+        Remove the segment files once they have been stitched into partition files
+        Incremental exports keep them as the cache for the next run
+        """
+        if self.incremental:
+            return
+        shutil.rmtree(self.segments_dir, ignore_errors=True)
+    
+    def _write_vocabulary_file(self, schema_file: str, shared_segments: List[List[str]], shared_tables: List[str]) -> str:
+        """
+        Write the shared vocabulary file holding the schema (if given) and the data of
+        all vocabulary and lookup tables, which every partition file relies on
+        Returns the path of the vocabulary file
+        """
+        vocabulary_file = self._get_output_file("vocabulary.sql")
+        logger.info(f"Creating shared vocabulary file {vocabulary_file}")
+        
+        with open(vocabulary_file, 'wb') as raw_f:
+            with self._open_output_member(raw_f) as out_f:
+                out_f.write("-- OMOP Shared Vocabulary Export\n")
                 out_f.write(f"-- Generated from source database: {self.db_name}\n")
-                out_f.write(f"-- Partition: {i} of {self.num_partitions}\n")
-                out_f.write(f"-- This file contains both schema and data\n\n")
-                
-                # Copy schema
-                with open(schema_file, 'r') as schema_f:
-                    out_f.write("-- ============================================\n")
-                    out_f.write("-- SCHEMA DEFINITION\n")
-                    out_f.write("-- ============================================\n\n")
-                    out_f.write(schema_f.read())
-                    out_f.write("\n\n")
-                
-                # Add data
+                out_f.write(f"-- Load this file once before any of the {self.num_partitions} partition files\n\n")
+                if schema_file:
+                    self._write_schema_definition(out_f, schema_file)
                 out_f.write("-- ============================================\n")
-                out_f.write("-- DATA FOR PARTITION\n")
+                out_f.write("-- VOCABULARY DATA\n")
                 out_f.write("-- ============================================\n\n")
-                
-                # Disable foreign key constraints to handle circular dependencies
-                out_f.write("-- Temporarily disable foreign key constraints for data import\n")
                 out_f.write("SET session_replication_role = replica;\n\n")
+            self._append_segments(raw_f, shared_segments, shared_tables)
+            with self._open_output_member(raw_f) as out_f:
+                out_f.write("\nSET session_replication_role = DEFAULT;\n")
+        
+        self.vocabulary_file = vocabulary_file
+        return vocabulary_file
+    
+    def _write_schema_definition(self, out_f, schema_file: str):
+        """Copy the exported schema into an output file"""
+        with open_text_reader(schema_file) as schema_f:
+            out_f.write("-- ============================================\n")
+            out_f.write("-- SCHEMA DEFINITION\n")
+            out_f.write("-- ============================================\n\n")
+            out_f.write(schema_f.read())
+            out_f.write("\n\n")
+    
+    def _write_partition_prologue(self, out_f, partition_index: int, schema_file: str):
+        """
+        Write the header and schema definition that precede the data of a partition file
+        schema_file is None when the schema is part of the shared vocabulary file
+        """
+        # Write header
+        out_f.write(f"-- OMOP Partition {partition_index} Complete Export\n")
+        out_f.write(f"-- Generated from source database: {self.db_name}\n")
+        out_f.write(f"-- Partition: {partition_index} of {self.num_partitions}\n")
+        if schema_file:
+            out_f.write(f"-- This file contains both schema and data\n\n")
+            # Copy schema
+            self._write_schema_definition(out_f, schema_file)
+        else:
+            out_f.write(f"-- This file contains person data only; load the shared vocabulary file first\n\n")
+        
+        # Add data
+        out_f.write("-- ============================================\n")
+        out_f.write("-- DATA FOR PARTITION\n")
+        out_f.write("-- ============================================\n\n")
+        
+        # Disable foreign key constraints to handle circular dependencies
+        out_f.write("-- Temporarily disable foreign key constraints for data import\n")
+        out_f.write("SET session_replication_role = replica;\n\n")
+    
+    def _write_partition_epilogue(self, out_f, post_data_file: str = None):
+        """
+        Write the statements that follow the data of a partition file
+        post_data_file holds the indexes and constraints to build after the data, if split
+        """
+        # Re-enable foreign key constraints
+        out_f.write("\n-- Re-enable foreign key constraints\n")
+        out_f.write("SET session_replication_role = DEFAULT;\n\n")
+        
+        if post_data_file:
+            with open_text_reader(post_data_file) as post_f:
+                out_f.write("-- ============================================\n")
+                out_f.write("-- INDEXES AND CONSTRAINTS\n")
+                out_f.write("-- ============================================\n\n")
+                out_f.write(post_f.read())
+                out_f.write("\n\n")
+
+        # Add validation to ensure data integrity
+        out_f.write("-- ============================================\n")
+        out_f.write("-- DATA VALIDATION\n")
+        out_f.write("-- ============================================\n\n")
+        out_f.write("-- Validate foreign key constraints\n")
+        out_f.write("DO $$\n")
+        out_f.write("DECLARE\n")
+        out_f.write("    constraint_violations INTEGER;\n")
+        out_f.write("BEGIN\n")
+        out_f.write("    -- Check for foreign key violations\n")
+        out_f.write("    SELECT COUNT(*) INTO constraint_violations\n")
+        out_f.write("    FROM (\n")
+        out_f.write("        SELECT 'concept' as table_name, concept_class_id as fk_value\n")
+        out_f.write("        FROM omopcdm.concept c\n")
+        out_f.write("        WHERE c.concept_class_id NOT IN (SELECT concept_class_id FROM omopcdm.concept_class)\n")
+        out_f.write("        UNION ALL\n")
+        out_f.write("        SELECT 'concept' as table_name, vocabulary_id as fk_value\n")
+        out_f.write("        FROM omopcdm.concept c\n")
+        out_f.write("        WHERE c.vocabulary_id NOT IN (SELECT vocabulary_id FROM omopcdm.vocabulary)\n")
+        out_f.write("        UNION ALL\n")
+        out_f.write("        SELECT 'concept' as table_name, domain_id as fk_value\n")
+        out_f.write("        FROM omopcdm.concept c\n")
+        out_f.write("        WHERE c.domain_id NOT IN (SELECT domain_id FROM omopcdm.domain)\n")
+        out_f.write("    ) violations;\n")
+        out_f.write("    \n")
+        out_f.write("    IF constraint_violations > 0 THEN\n")
+        out_f.write("        RAISE EXCEPTION 'Foreign key constraint violations detected: % violations', constraint_violations;\n")
+        out_f.write("    ELSE\n")
+        out_f.write("        RAISE NOTICE 'All foreign key constraints validated successfully';\n")
+        out_f.write("    END IF;\n")
+        out_f.write("END $$;\n\n")
+    
+    def get_manifest_path(self) -> str:
+        """Path of the manifest of the last run in the output directory"""
+        return os.path.join(self.output_dir, MANIFEST_FILE_NAME)
+    
+    def _get_run_settings(self) -> Dict:
+        """Settings that must match for a run to be resumed from another run's segments"""
+        return {
+            'use_copy': self.use_copy,
+            'fan_out': self.fan_out,
+            'compress': self.compress,
+            'shared_vocabulary': self.shared_vocabulary,
+            'output_format': self.output_format,
+            'strategy': self.strategy,
+            'routing_rules': self.routing_rules,
+        }
+    
+    def _open_run_manifest(self, tables: List[str]) -> RunManifest:
+        """
+        Return the manifest of this run: the checkpoint of the interrupted run when
+        resuming, otherwise a new one
+        """
+        manifest_path = self.get_manifest_path()
+        if not self.resume or not os.path.exists(manifest_path):
+            if self.resume:
+                logger.info("No run manifest to resume from, starting a new export")
+            return self._start_run_manifest(tables)
+        
+        manifest = RunManifest.load(manifest_path)
+        if manifest.is_completed or manifest.mode != 'full':
+            logger.info("Previous run completed, starting a new export")
+            return self._start_run_manifest(tables)
+        if manifest.num_partitions != self.num_partitions or manifest.settings != self._get_run_settings():
+            raise ValueError(f"Cannot resume the run in {manifest_path}: it used different export settings")
+        # Assign persons exactly as the interrupted run did
+        self._prepare_distribution(manifest.distribution)
+        
+        logger.info(f"Resuming the export started at {manifest.started_at} "
+                    f"({len(manifest.segments)} segments finished)")
+        return manifest
+    
+    def _start_run_manifest(self, tables: List[str], mode: str = 'full', distribution: Dict = None) -> RunManifest:
+        """
+        Create the manifest of this run, capturing the change watermarks of the
+        person-dependent tables before any of their rows are read, and the parameters
+        of the distribution strategy (those of distribution if given, else computed now)
+        """
+        manifest = RunManifest(self.get_manifest_path(), self.db_name, self.num_partitions, mode)
+        manifest.settings = self._get_run_settings()
+        manifest.distribution = self._prepare_distribution(distribution)
+        if mode == 'full' and self.distribution.get_person_map() is not None:
+            self._save_person_map()
+        
+        if self.staged_source is not None:
+            # The rows come from the staged snapshot, so the next delta starts from it
+            manifest.xmin = self.staged_source.xmin
+            self._record_watermarks(manifest, tables, self.staged_source.get_max_value)
+        else:
+            with self._connect() as conn:
+                # Transactions from this one on may not be visible to the export, so the next
+                # delta starts here; rows seen twice are simply upserted again
+                manifest.xmin = conn.execute(text("SELECT txid_snapshot_xmin(txid_current_snapshot())")).scalar()
+                
+                def get_max_value(table: str, column: str):
+                    schema, table_name = table.split('.')
+                    value = conn.execute(text(f"SELECT MAX({column}) FROM {schema}.{table_name}")).scalar()
+                    return str(value) if value is not None else None
                 
-                # Get tables in dependency order, handling cycles
-                # Use a custom ordering that prioritizes vocabulary tables
-                tables = self._get_ordered_tables(graph)
+                self._record_watermarks(manifest, tables, get_max_value)
+        
+        if mode == 'full':
+            # Checkpoint from the start so an interrupted run can be resumed
+            manifest.save()
+        return manifest
+    
+    def _record_watermarks(self, manifest: RunManifest, tables: List[str], get_max_value):
+        """Record the watermark of every person-dependent table, using get_max_value(table, column) for columns"""
+        for table in tables:
+            if self._get_table_kind(table) not in ('person', 'linked'):
+                continue
+            column = self._get_watermark_column(table)
+            if column == XMIN_WATERMARK:
+                value = manifest.xmin
+            else:
+                value = get_max_value(table, column)
+            manifest.watermarks[table] = {'column': column, 'value': value}
+    
+    def _complete_run_manifest(self, manifest: RunManifest):
+        """Record that the run finished, so later delta exports can start from its watermarks"""
+        manifest.mark_completed()
+        manifest.save()
+        logger.info(f"Run manifest written to {manifest.path}")
+    
+    def _get_watermark_column(self, table: str) -> str:
+        """
+        Resolve the configured watermark to a column of the table, or xmin
+        
+        A column named exactly by the watermark is used as configured; columns matched by
+        a pattern only if they lead an index, since every run reads MAX() of the column
+        and a delta selects the rows past it, which would otherwise scan the whole table
+        """
+        if self.watermark == XMIN_WATERMARK:
+            return XMIN_WATERMARK
+        
+        info = self.get_catalog().get_table(table)
+        if self.watermark == 'id':
+            if info is not None and len(info.primary_key) == 1:
+                return info.primary_key[0]
+        elif info is not None:
+            if self.watermark in info.column_names:
+                return self.watermark
+            matches = [column for column in info.column_names if fnmatch.fnmatch(column, self.watermark)]
+            for column in matches:
+                if column in info.indexed_columns:
+                    return column
+            if matches:
+                logger.info(f"Watermark column {matches[0]} of {table} is not indexed, using xmin")
+                return XMIN_WATERMARK
+        
+        logger.debug(f"No {self.watermark} watermark column in {table}, using xmin")
+        return XMIN_WATERMARK
+    
+    def _get_watermark_condition(self, table: str, previous: RunManifest, current: RunManifest) -> str:
+        """
+        Condition selecting the rows of a table changed since the previous run,
+        or None if the table has to be exported in full
+        """
+        previous_mark = previous.get_watermark(table)
+        current_mark = current.get_watermark(table)
+        
+        if previous_mark is None or previous_mark['value'] is None:
+            logger.info(f"No watermark recorded for {table}, exporting all of its rows")
+            return None
+        if previous_mark['column'] != current_mark['column']:
+            logger.warning(f"Watermark column of {table} changed from {previous_mark['column']} "
+                           f"to {current_mark['column']}, exporting all of its rows")
+            return None
+        
+        if previous_mark['column'] == XMIN_WATERMARK:
+            # xmin holds the low 32 bits of the transaction ID; comparing them is only
+            # meaningful while the epoch (high 32 bits) has not moved on
+            if previous_mark['value'] >> 32 != current.xmin >> 32:
+                logger.warning(f"Transaction ID epoch changed since the previous run, exporting all rows of {table}")
+                return None
+            return f"xmin::text::bigint >= {previous_mark['value'] & 0xFFFFFFFF}"
+        
+        value = previous_mark['value'].replace("'", "''")
+        return f"{previous_mark['column']} >= '{value}'"
+    
+    def export_delta_files(self, graph: nx.DiGraph, previous_manifest_path: str = None) -> List[str]:
+        """
+        Export the rows of person-dependent tables inserted or updated since a previous run
+        
+        Every partition gets a delta file of INSERT ... ON CONFLICT statements that
+        upsert the changed rows into an already loaded partition database. Deleted rows
+        are not detected; use a full export to propagate deletes.
+        Returns list of delta SQL file paths
+        """
+        if self.staged_source is not None:
+            raise ValueError("Delta exports query the source database and cannot be made from a staged cache")
+        if not self.has_partition_predicate:
+            # A changed person set reassigns persons, so deltas could not be applied to the partitions
+            raise ValueError(f"Delta exports need a strategy with a SQL predicate, not {self.strategy}")
+        previous_manifest_path = previous_manifest_path or self.get_manifest_path()
+        previous = RunManifest.load(previous_manifest_path)
+        if not previous.is_completed:
+            raise ValueError(f"Run recorded in {previous_manifest_path} did not complete")
+        if previous.num_partitions != self.num_partitions:
+            raise ValueError(f"Previous run used {previous.num_partitions} partitions, not {self.num_partitions}")
+        if previous.settings.get('strategy', 'uniform') != self.strategy:
+            raise ValueError(f"Previous run used the {previous.settings.get('strategy', 'uniform')} strategy, not {self.strategy}")
+        
+        tables = self._get_person_tables(graph)
+        # Changed rows go to the partitions of the run the deltas are applied on top of
+        current = self._start_run_manifest(tables, mode='delta', distribution=previous.distribution)
+        conditions = {t: self._get_watermark_condition(t, previous, current) for t in tables}
+        logger.info(f"Exporting changes since {previous.started_at} for {len(tables)} tables")
+        
+        delta_files = []
+        for i in range(self.num_partitions):
+            delta_file = self._get_output_file(f"partition_{i}_delta.sql")
+            with self._open_output(delta_file) as out_f:
+                out_f.write(f"-- OMOP Partition {i} Delta Export\n")
+                out_f.write(f"-- Generated from source database: {self.db_name}\n")
+                out_f.write(f"-- Changes since run started at {previous.started_at}\n")
+                out_f.write(f"-- Load after partition_{i}_complete.sql and any earlier delta files\n\n")
+                out_f.write("BEGIN;\n")
                 
-                # Export data for each table
                 for table in tables:
-                    self._export_table_data(out_f, table, i)
+                    if not self.get_catalog().get_table(table).primary_key:
+                        logger.warning(f"{table} has no primary key, changed rows that already exist will be skipped")
+                    query = self._get_partition_query(table, i, conditions[table])
+                    rows = self._export_query_data(out_f, table, query, upsert=True)
+                    logger.info(f"Exported {rows} changed rows of {table} for partition {i}")
                 
-                # Re-enable foreign key constraints
-                out_f.write("\n-- Re-enable foreign key constraints\n")
-                out_f.write("SET session_replication_role = DEFAULT;\n\n")
+                out_f.write("\nCOMMIT;\n")
+            
+            delta_files.append(delta_file)
+            logger.info(f"Created delta file: {delta_file}")
+        
+        self._complete_run_manifest(current)
+        return delta_files
+    
+    def export_move_files(self, graph: nx.DiGraph, previous_manifest_path: str = None) -> List[str]:
+        """
+        Export the rows of the persons whose partition changes when the partition count
+        of a previous run changes to this one
+        
+        Every partition gets a moves file that deletes the persons moving out of it and
+        upserts the rows of the persons moving into it, so loaded partitions can be
+        regrown or shrunk without a full export; with the consistent_hash strategy only
+        about 1/(N+1) of the persons move when a partition is added. The moves files of
+        new partitions also hold the tables copied in full to every partition and the
+        rows of linked tables that belong to no person, so they load into a database
+        holding only the schema. Partitions past the new count only lose persons and can
+        be dropped once theirs are moved.
+        Returns list of moves SQL file paths
+        """
+        if self.staged_source is not None:
+            raise ValueError("Moves exports query the source database and cannot be made from a staged cache")
+        if self.distribution.uses_person_keys:
+            raise ValueError(f"The {self.strategy} strategy depends on the data, so the persons it moves "
+                             f"cannot be computed from their IDs")
+        previous_manifest_path = previous_manifest_path or self.get_manifest_path()
+        previous = RunManifest.load(previous_manifest_path)
+        if not previous.is_completed:
+            raise ValueError(f"Run recorded in {previous_manifest_path} did not complete")
+        if (previous.settings.get('strategy', 'uniform') != self.strategy
+                or previous.distribution != self.distribution.get_parameters()):
+            raise ValueError(f"Previous run did not use the {self.strategy} strategy with the same parameters")
+        
+        tables = self._get_person_tables(graph)
+        seed_tables = [t for t in self._get_ordered_tables(graph) if self._get_table_kind(t) == 'full']
+        seed_tables += [t for t in tables if self._get_table_kind(t) == 'linked']
+        current = self._start_run_manifest(tables, mode='moves')
+        # Rows of persons that stay were exported by the previous run, so later deltas
+        # must still start from its watermarks
+        current.xmin = previous.xmin
+        current.watermarks = previous.watermarks
+        
+        with self._connect() as conn:
+            result = conn.execute(text(f"SELECT person_id FROM {self.person_table}"))
+            person_ids = np.fromiter((row[0] for row in result), dtype=np.int64)
+        old_parts = self.distribution.assign_partitions(person_ids, previous.num_partitions)
+        new_parts = self.distribution.assign_partitions(person_ids, self.num_partitions)
+        moved = old_parts != new_parts
+        logger.info(f"{int(moved.sum())} of {len(person_ids)} persons move going from "
+                    f"{previous.num_partitions} to {self.num_partitions} partitions")
+        
+        move_files = []
+        for i in range(max(previous.num_partitions, self.num_partitions)):
+            moving_out = person_ids[moved & (old_parts == i)].tolist()
+            moving_in = person_ids[moved & (new_parts == i)].tolist()
+            move_file = self._get_output_file(f"partition_{i}_moves.sql")
+            with self._open_output(move_file) as out_f:
+                out_f.write(f"-- OMOP Partition {i} Moves Export\n")
+                out_f.write(f"-- Generated from source database: {self.db_name}\n")
+                out_f.write(f"-- Partitions: {previous.num_partitions} -> {self.num_partitions} "
+                            f"({self.strategy} strategy)\n")
+                out_f.write(f"-- Persons moving out: {len(moving_out)}, moving in: {len(moving_in)}\n\n")
+                out_f.write("BEGIN;\n")
                 
-                # Add validation to ensure data integrity
-                out_f.write("-- ============================================\n")
-                out_f.write("-- DATA VALIDATION\n")
-                out_f.write("-- ============================================\n\n")
-                out_f.write("-- Validate foreign key constraints\n")
-                out_f.write("DO $$\n")
-                out_f.write("DECLARE\n")
-                out_f.write("    constraint_violations INTEGER;\n")
-                out_f.write("BEGIN\n")
-                out_f.write("    -- Check for foreign key violations\n")
-                out_f.write("    SELECT COUNT(*) INTO constraint_violations\n")
-                out_f.write("    FROM (\n")
-                out_f.write("        SELECT 'concept' as table_name, concept_class_id as fk_value\n")
-                out_f.write("        FROM omopcdm.concept c\n")
-                out_f.write("        WHERE c.concept_class_id NOT IN (SELECT concept_class_id FROM omopcdm.concept_class)\n")
-                out_f.write("        UNION ALL\n")
-                out_f.write("        SELECT 'concept' as table_name, vocabulary_id as fk_value\n")
-                out_f.write("        FROM omopcdm.concept c\n")
-                out_f.write("        WHERE c.vocabulary_id NOT IN (SELECT vocabulary_id FROM omopcdm.vocabulary)\n")
-                out_f.write("        UNION ALL\n")
-                out_f.write("        SELECT 'concept' as table_name, domain_id as fk_value\n")
-                out_f.write("        FROM omopcdm.concept c\n")
-                out_f.write("        WHERE c.domain_id NOT IN (SELECT domain_id FROM omopcdm.domain)\n")
-                out_f.write("    ) violations;\n")
-                out_f.write("    \n")
-                out_f.write("    IF constraint_violations > 0 THEN\n")
-                out_f.write("        RAISE EXCEPTION 'Foreign key constraint violations detected: % violations', constraint_violations;\n")
-                out_f.write("    ELSE\n")
-                out_f.write("        RAISE NOTICE 'All foreign key constraints validated successfully';\n")
-                out_f.write("    END IF;\n")
-                out_f.write("END $$;\n\n")
+                # Children before parents, so no foreign key is left dangling
+                for table in reversed(tables):
+                    for start in range(0, len(moving_out), MOVE_BATCH_PERSONS):
+                        out_f.write(self._get_move_delete(table, moving_out[start:start + MOVE_BATCH_PERSONS]))
+                
+                if i >= previous.num_partitions:
+                    self._export_seed_data(out_f, seed_tables)
+                
+                for table in tables:
+                    rows = 0
+                    for start in range(0, len(moving_in), MOVE_BATCH_PERSONS):
+                        query = self._get_move_query(table, moving_in[start:start + MOVE_BATCH_PERSONS])
+                        rows += self._export_query_data(out_f, table, query, upsert=True)
+                    logger.info(f"Exported {rows} rows of {table} moving into partition {i}")
+                
+                out_f.write("\nCOMMIT;\n")
             
-            combined_files.append(combined_file)
-            logger.info(f"Created combined file: {combined_file}")
+            move_files.append(move_file)
+            logger.info(f"Created moves file: {move_file}")
         
-        return combined_files
+        self._complete_run_manifest(current)
+        return move_files
+    
+    def _export_seed_data(self, file_handle, tables: List[str]):
+        """
+        Write the rows a new partition holds before any person moves into it: the tables
+        copied in full to every partition, and the rows of no person of the linked tables
+        """
+        for table in tables:
+            schema, table_name = table.split('.')
+            query = f"SELECT * FROM {schema}.{table_name}"
+            if self._get_table_kind(table) == 'linked':
+                query += f" WHERE ({self._get_link_routers()[table].get_shared_condition()})"
+            rows = self._export_query_data(file_handle, table, query, upsert=True)
+            logger.info(f"Exported {rows} rows of {table} seeding the new partition")
+    
+    def _get_person_tables(self, graph: nx.DiGraph) -> List[str]:
+        """
+        Tables holding rows of persons, in load order: the person-dependent tables, then the
+        linked tables, whose rows are selected through their parents and so must be deleted
+        before them
+        """
+        tables = self._get_ordered_tables(graph)
+        return ([t for t in tables if self._get_table_kind(t) == 'person']
+                + [t for t in tables if self._get_table_kind(t) == 'linked'])
+    
+    def _get_person_array(self, person_ids: List[int]) -> str:
+        """SQL array literal of person IDs"""
+        return f"'{{{','.join(map(str, person_ids))}}}'::bigint[]"
+    
+    def _get_move_query(self, table: str, person_ids: List[int]) -> str:
+        """Query selecting the rows of a person-dependent table that belong to the given persons"""
+        schema, table_name = table.split('.')
+        if self._get_table_kind(table) == 'linked':
+            return f"SELECT * FROM {schema}.{table_name} WHERE ({self._get_linked_person_condition(table, person_ids)})"
+        return f"SELECT * FROM {schema}.{table_name} WHERE person_id = ANY({self._get_person_array(person_ids)})"
+    
+    def _get_move_delete(self, table: str, person_ids: List[int]) -> str:
+        """DELETE statement removing the rows of the given persons from a person-dependent table"""
+        schema, table_name = table.split('.')
+        if self._get_table_kind(table) == 'linked':
+            return f"DELETE FROM {schema}.{table_name} WHERE ({self._get_linked_person_condition(table, person_ids)});\n"
+        return f"DELETE FROM {schema}.{table_name} WHERE person_id = ANY({self._get_person_array(person_ids)});\n"
+    
+    def _get_linked_person_condition(self, table: str, person_ids: List[int]) -> str:
+        """Condition selecting the rows of a linked table whose parent rows belong to the given persons"""
+        person_array = self._get_person_array(person_ids)
+        return self._get_link_routers()[table].get_owner_condition(lambda column: f"{column} = ANY({person_array})")
+    
+    def stage_source(self, cache_dir: str) -> StagedSource:
+        """
+        Stage the source schema into a local cache that partitions can later be made from
+        
+        Every table is read once, all within one exported snapshot together with the
+        schema dump and the transaction watermark, and written to an Arrow IPC file.
+        The cache metadata is written last, so an interrupted run leaves no usable cache.
+        Returns the staged source
+        """
+        staged = StagedSource(cache_dir, self.db_name)
+        os.makedirs(staged.tables_dir, exist_ok=True)
+        staged.foreign_keys = list(self.analyze_schema().edges(data=True))
+        staged.catalog = self.get_catalog()
+        tables = self._get_source_tables()
+        
+        with self._export_snapshot() as snapshot_id:
+            self.snapshot_id = snapshot_id
+            try:
+                for section in (None, 'pre-data', 'post-data'):
+                    staged.write_schema(section, self._run_pg_dump(section))
+                with self._connect() as conn:
+                    staged.xmin = conn.execute(text("SELECT txid_snapshot_xmin(txid_current_snapshot())")).scalar()
+                
+                if self.jobs == 1:
+                    for table in tables:
+                        staged.row_counts[table] = self._stage_table(table, staged.get_table_path(table))
+                else:
+                    logger.info(f"Staging {len(tables)} tables with {self.jobs} parallel jobs")
+                    with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_segment_worker,
+                                             initargs=(self._get_exporter_config(), snapshot_id,
+                                                       self.get_catalog())) as pool:
+                        futures = [pool.submit(_run_stage_unit, table, staged.get_table_path(table))
+                                   for table in tables]
+                        for future in as_completed(futures):
+                            table, rows = future.result()
+                            staged.row_counts[table] = rows
+            finally:
+                self.snapshot_id = None
+        
+        staged.save()
+        logger.info(f"Staged {len(tables)} tables ({sum(staged.row_counts.values()):,} rows) in {cache_dir}")
+        return staged
+    
+    def _stage_table(self, table: str, path: str) -> int:
+        """
+        Copy one source table into an Arrow IPC file of the staging cache
+        Returns the number of rows staged
+        """
+        schema, table_name = table.split('.')
+        info = self.get_catalog().get_table(table)
+        tmp_path = f"{path}.tmp"
+        writer = ArrowTableWriter(tmp_path, info.column_names, get_stage_data_types(info.column_types))
+        
+        with self._connect() as conn:
+            query = f"SELECT * FROM {schema}.{table_name}"
+            result = conn.execution_options(yield_per=self._get_fetch_size(table)).execute(text(query))
+            for batch in result.partitions():
+                writer.write_rows(batch)
+        
+        rows = writer.close()
+        os.replace(tmp_path, path)
+        logger.info(f"Staged {rows} rows of {table}")
+        return rows
     
     def validate_export(self, graph: nx.DiGraph) -> bool:
         """
@@ -549,11 +2205,15 @@ class SQLExporter:
         
         # Get source counts
         source_counts = {}
-        with self.source_engine.connect() as conn:
+        if self.staged_source is not None:
             for table in self.get_related_tables(graph):
-                schema, table_name = table.split('.')
-                result = conn.execute(text(f"SELECT COUNT(*) FROM {schema}.{table_name}"))
-                source_counts[table_name] = result.scalar()
+                source_counts[table.split('.')[1]] = self.staged_source.count_rows(table)
+        else:
+            with self.source_engine.connect() as conn:
+                for table in self.get_related_tables(graph):
+                    schema, table_name = table.split('.')
+                    result = conn.execute(text(f"SELECT COUNT(*) FROM {schema}.{table_name}"))
+                    source_counts[table_name] = result.scalar()
         
         # Validate each partition
         for i in range(self.num_partitions):
@@ -578,16 +2238,19 @@ class SQLExporter:
         logger.info("Export validation completed")
         return validation_passed
     
-    def _verify_schema_components(self, schema_file: str):
+    def _verify_schema_components(self, *schema_files: str):
         """
-        Verify that the schema file contains all expected components
+        Verify that the schema file(s) together contain all expected components
         """
-        if not os.path.exists(schema_file):
-            logger.error(f"Schema file {schema_file} does not exist")
-            return False
-        
-        with open(schema_file, 'r') as f:
-            content = f.read()
+        contents = []
+        for schema_file in schema_files:
+            if not os.path.exists(schema_file):
+                logger.error(f"Schema file {schema_file} does not exist")
+                return False
+            
+            with open_text_reader(schema_file) as f:
+                contents.append(f.read())
+        content = "\n".join(contents)
         
         # Check for essential schema components
         components = {
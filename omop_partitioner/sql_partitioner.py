@@ -13,7 +13,22 @@ import logging
 import networkx as nx
 from dotenv import load_dotenv
 from urllib.parse import urlparse
-from .sql_export import SQLExporter
+from .sql_export import SCAN_RANGE_PAGES, SQLExporter
+from .manifest import RunManifest
+
+# Shell command importing one partition file, per compression method
+IMPORT_COMMANDS = {
+    None: "psql -U postgres -d <database_name> -f partition_X_complete.sql",
+    'gzip': "gunzip -c partition_X_complete.sql.gz | psql -U postgres -d <database_name>",
+    'zstd': "zstd -dc partition_X_complete.sql.zst | psql -U postgres -d <database_name>",
+}
+
+def get_import_command(compress: str = None, output_format: str = 'sql') -> str:
+    """Return the shell command that imports a partition file written with the given compression"""
+    if output_format == 'binary-copy':
+        # The partition file loads the binary data files by paths relative to the output directory
+        return "cd <output_dir> && " + IMPORT_COMMANDS[compress]
+    return IMPORT_COMMANDS[compress]
 
 # Configure logging
 logging.basicConfig(
@@ -25,7 +40,13 @@ logger = logging.getLogger(__name__)
 class OMOPSQLPartitioner:
     """Main class for SQL-based OMOP partitioning"""
     
-    def __init__(self, source_db_url: str, num_partitions: int, output_dir: str = "sql_exports", use_copy: bool = False):
+    def __init__(self, source_db_url: str, num_partitions: int, output_dir: str = "sql_exports", use_copy: bool = False,
+                 fan_out: bool = False, jobs: int = 1, compress: str = None, compress_level: int = None,
+                 compress_threads: int = None, shared_vocabulary: bool = False, split_schema: bool = False,
+                 incremental: bool = False, watermark: str = 'xmin', resume: bool = False,
+                 output_format: str = 'sql', cache_dir: str = None, strategy: str = 'uniform',
+                 range_bounds: str = 'histogram', routing_rules: str = None,
+                 scan_range_pages: int = SCAN_RANGE_PAGES):
         """
         Initialize the SQL partitioner
         
@@ -34,17 +55,44 @@ class OMOPSQLPartitioner:
             num_partitions: Number of partitions to create
             output_dir: Directory to save SQL files
             use_copy: Use COPY statements for faster import
+            fan_out: Scan each source table once and route rows to all partitions
+            jobs: Number of worker processes exporting tables in parallel
+            compress: Compress output files with 'gzip' or 'zstd'
+            compress_level: Compression level
+            compress_threads: Compression threads per file
+            shared_vocabulary: Write vocabulary tables once to vocabulary.sql instead of into every partition
+            split_schema: Build indexes and constraints after the data is loaded
+            incremental: Reuse the cached segments of tables unchanged since the previous export
+            watermark: Change watermark for delta exports ('xmin', 'id' or a column name pattern)
+            resume: Continue an interrupted export from the segments recorded in its manifest
+            output_format: 'sql', 'binary-copy' (PGCOPY data files loaded by the partition files)
+                or 'parquet' (one directory of Parquet datasets per partition)
+            cache_dir: Partition a source staged with stage_source instead of the source database
+            strategy: Distribution strategy assigning persons to partitions ('uniform', 'hash',
+                'consistent_hash', 'range', 'weighted' or 'round_robin')
+            range_bounds: How the range strategy computes its boundaries ('histogram' or 'ntile')
+            routing_rules: JSON file of links routing tables without person_id through their parent rows
+            scan_range_pages: With jobs > 1, scan tables of more pages than this in parallel ranges of blocks (0 disables)
         """
         self.source_db_url = source_db_url
         self.num_partitions = num_partitions
         self.output_dir = output_dir
-        self.sql_exporter = SQLExporter(source_db_url, num_partitions, output_dir, use_copy)
+        self.compress = compress
+        self.output_format = output_format
+        self.sql_exporter = SQLExporter(source_db_url, num_partitions, output_dir, use_copy,
+                                        fan_out=fan_out, jobs=jobs, compress=compress,
+                                        compress_level=compress_level, compress_threads=compress_threads,
+                                        shared_vocabulary=shared_vocabulary, split_schema=split_schema,
+                                        incremental=incremental, watermark=watermark, resume=resume,
+                                        output_format=output_format, cache_dir=cache_dir,
+                                        strategy=strategy, range_bounds=range_bounds,
+                                        routing_rules=routing_rules, scan_range_pages=scan_range_pages)
         
-        # Parse source database URL to get connection details
-        parsed_url = urlparse(source_db_url)
+        # Parse source database URL to get connection details (none when partitioning a staged cache)
+        parsed_url = urlparse(source_db_url or '')
         self.db_host = parsed_url.hostname or 'localhost'
         self.db_port = parsed_url.port or 5432
-        self.db_name = parsed_url.path.lstrip('/')
+        self.db_name = self.sql_exporter.db_name
         self.db_user = parsed_url.username
         self.db_password = parsed_url.password
     
@@ -54,8 +102,12 @@ class OMOPSQLPartitioner:
         """
         try:
             logger.info("Starting OMOP SQL partitioning process...")
-            logger.info(f"Source database: {self.db_name} on {self.db_host}:{self.db_port}")
+            if self.sql_exporter.staged_source is not None:
+                logger.info(f"Staged source: {self.db_name} in {self.sql_exporter.cache_dir}")
+            else:
+                logger.info(f"Source database: {self.db_name} on {self.db_host}:{self.db_port}")
             logger.info(f"Number of partitions: {self.num_partitions}")
+            logger.info(f"Distribution strategy: {self.sql_exporter.strategy}")
             logger.info(f"Output directory: {self.output_dir}")
             
             # Step 1: Analyze schema and create dependency graph
@@ -65,7 +117,10 @@ class OMOPSQLPartitioner:
             
             # Step 2: Export schema and data for all partitions
             logger.info("Step 2: Exporting schema and partition data...")
-            combined_files = self.sql_exporter.create_combined_partition_files(graph)
+            if self.output_format == 'parquet':
+                combined_files = self.sql_exporter.export_parquet_partitions(graph)
+            else:
+                combined_files = self.sql_exporter.create_combined_partition_files(graph)
             
             # Step 3: Validate the export
             logger.info("Step 3: Validating exported data...")
@@ -83,6 +138,93 @@ class OMOPSQLPartitioner:
             logger.error(f"Error during partitioning: {str(e)}")
             raise
     
+    def partition_delta(self, previous_manifest: str = None):
+        """
+        Export the rows changed since a previous run as per-partition delta files
+        """
+        try:
+            logger.info("Starting OMOP SQL delta export...")
+            logger.info(f"Source database: {self.db_name} on {self.db_host}:{self.db_port}")
+            logger.info(f"Previous run manifest: {previous_manifest or self.sql_exporter.get_manifest_path()}")
+            
+            graph = self.sql_exporter.analyze_schema()
+            delta_files = self.sql_exporter.export_delta_files(graph, previous_manifest)
+            
+            logger.info(f"Generated {len(delta_files)} delta files in {self.output_dir}")
+            return delta_files
+            
+        except Exception as e:
+            logger.error(f"Error during delta export: {str(e)}")
+            raise
+    
+    def partition_moves(self, previous_manifest: str = None):
+        """
+        Export the persons that change partition since a previous run with another partition count
+        """
+        try:
+            logger.info("Starting OMOP SQL moves export...")
+            logger.info(f"Source database: {self.db_name} on {self.db_host}:{self.db_port}")
+            logger.info(f"Previous run manifest: {previous_manifest or self.sql_exporter.get_manifest_path()}")
+            
+            graph = self.sql_exporter.analyze_schema()
+            move_files = self.sql_exporter.export_move_files(graph, previous_manifest)
+            
+            logger.info(f"Generated {len(move_files)} moves files in {self.output_dir}")
+            return move_files
+            
+        except Exception as e:
+            logger.error(f"Error during moves export: {str(e)}")
+            raise
+    
+    def stage_source(self, cache_dir: str):
+        """
+        Stage the source database into a local cache for later offline partitioning
+        """
+        try:
+            logger.info("Starting OMOP source staging...")
+            logger.info(f"Source database: {self.db_name} on {self.db_host}:{self.db_port}")
+            logger.info(f"Cache directory: {cache_dir}")
+            
+            return self.sql_exporter.stage_source(cache_dir)
+            
+        except Exception as e:
+            logger.error(f"Error during staging: {str(e)}")
+            raise
+    
+    def _get_output_size(self, path: str) -> int:
+        """Size in bytes of an output file, or of all files in an output directory"""
+        if os.path.isdir(path):
+            return sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(path) for name in names
+            )
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    
+    def _write_partition_balance(self, f):
+        """Write the rows and bytes of every partition, and the spread between the largest and smallest"""
+        manifest_path = self.sql_exporter.get_manifest_path()
+        if not os.path.exists(manifest_path):
+            return
+        manifest = RunManifest.load(manifest_path)
+        rows = [0] * self.num_partitions
+        sizes = [0] * self.num_partitions
+        for segment in manifest.segments.values():
+            if 0 <= segment['partition'] < self.num_partitions:
+                rows[segment['partition']] += segment['rows']
+                sizes[segment['partition']] += segment['bytes']
+        
+        f.write(f"\nPartition Balance (data segments written by this run):\n")
+        f.write("-" * 20 + "\n")
+        for i in range(self.num_partitions):
+            f.write(f"Partition {i}: {rows[i]:,} rows, {sizes[i]:,} bytes\n")
+        for label, values in (("Rows", rows), ("Bytes", sizes)):
+            spread = f" ({max(values) / min(values):.2f}x)" if min(values) else ""
+            f.write(f"{label} per partition: max {max(values):,}, min {min(values):,}{spread}\n")
+        planned = manifest.distribution.get('partition_bytes')
+        if planned:
+            f.write(f"Estimated bytes packed per partition by the {self.sql_exporter.strategy} strategy: "
+                    f"max {max(planned):,}, min {min(planned):,}\n")
+    
     def _generate_summary_report(self, combined_files: list, graph: nx.DiGraph):
         """Generate a summary report of the partitioning process"""
         report_file = os.path.join(self.output_dir, "partitioning_report.txt")
@@ -94,12 +236,22 @@ class OMOPSQLPartitioner:
             f.write(f"Source Database: {self.db_name}\n")
             f.write(f"Host: {self.db_host}:{self.db_port}\n")
             f.write(f"Number of Partitions: {self.num_partitions}\n")
+            f.write(f"Distribution Strategy: {self.sql_exporter.strategy}\n")
+            f.write(f"Compression: {self.compress or 'none'}\n")
+            f.write(f"Data Format: {self.output_format}\n")
             f.write(f"Generated Files: {len(combined_files)}\n\n")
             
             f.write("Generated Files:\n")
             f.write("-" * 20 + "\n")
+            vocabulary_file = self.sql_exporter.vocabulary_file
+            if vocabulary_file:
+                size = self._get_output_size(vocabulary_file)
+                f.write(f"Shared vocabulary: {os.path.basename(vocabulary_file)} ({size:,} bytes)\n")
             for i, file_path in enumerate(combined_files):
-                f.write(f"Partition {i}: {os.path.basename(file_path)}\n")
+                size = self._get_output_size(file_path)
+                f.write(f"Partition {i}: {os.path.basename(file_path)} ({size:,} bytes)\n")
+            
+            self._write_partition_balance(f)
             
             f.write(f"\nSchema Information:\n")
             f.write("-" * 20 + "\n")
@@ -107,25 +259,39 @@ class OMOPSQLPartitioner:
             f.write(f"Total Relationships: {len(graph.edges())}\n")
             
             # Get table information
-            with self.sql_exporter.source_engine.connect() as conn:
-                # get_table_names returns a list directly, not a SQL statement
-                table_names = self.sql_exporter.source_engine.dialect.get_table_names(conn)
-                tables = [name for name in table_names if name.startswith('omopcdm.')]
-                
-                f.write(f"\nTable Details:\n")
+            staged_source = self.sql_exporter.staged_source
+            if staged_source is not None:
+                f.write(f"\nTable Details (staged at {staged_source.staged_at}):\n")
                 f.write("-" * 20 + "\n")
-                for table in sorted(tables):
-                    schema, table_name = table.split('.')
-                    count_result = conn.execute(f"SELECT COUNT(*) FROM {table}")
-                    count = count_result.scalar()
-                    f.write(f"{table_name}: {count:,} rows\n")
+                for table in sorted(staged_source.row_counts):
+                    f.write(f"{table.split('.')[1]}: {staged_source.count_rows(table):,} rows\n")
+            else:
+                with self.sql_exporter.source_engine.connect() as conn:
+                    # get_table_names returns a list directly, not a SQL statement
+                    table_names = self.sql_exporter.source_engine.dialect.get_table_names(conn)
+                    tables = [name for name in table_names if name.startswith('omopcdm.')]
+                    
+                    f.write(f"\nTable Details:\n")
+                    f.write("-" * 20 + "\n")
+                    for table in sorted(tables):
+                        schema, table_name = table.split('.')
+                        count_result = conn.execute(f"SELECT COUNT(*) FROM {table}")
+                        count = count_result.scalar()
+                        f.write(f"{table_name}: {count:,} rows\n")
             
             f.write(f"\nImport Instructions:\n")
             f.write("-" * 20 + "\n")
             f.write("1. Create PostgreSQL containers for each partition\n")
-            f.write("2. Import each partition file using:\n")
-            f.write("   psql -U postgres -d <database_name> -f partition_X_complete.sql\n")
-            f.write("3. Verify data integrity in each partition\n")
+            if vocabulary_file:
+                f.write("2. Import the shared vocabulary file into each container first, or build one\n")
+                f.write("   template volume with: spin_and_import.py --vocabulary <abs path to vocabulary file> ...\n")
+                f.write("3. Import each partition file using:\n")
+                f.write(f"   {get_import_command(self.compress, self.output_format)}\n")
+                f.write("4. Verify data integrity in each partition\n")
+            else:
+                f.write("2. Import each partition file using:\n")
+                f.write(f"   {get_import_command(self.compress, self.output_format)}\n")
+                f.write("3. Verify data integrity in each partition\n")
         
         logger.info(f"Summary report generated: {report_file}")
 
@@ -0,0 +1,166 @@
+"""
+Local staging cache of an OMOP source database
+
+This module stores every table of the source schema once as an Arrow IPC file,
+together with the catalog, the foreign keys, the schema dump and the transaction
+watermark of the snapshot the tables were read from. Partitions can then be
+produced from the cache any number of times, with any partition count, without
+querying the source database again; the files are read through memory maps.
+pyarrow is an optional dependency (pip install omop-partitioner[parquet]).
+
+Author: Narasimha Raghavan
+"""
+
+import os
+import json
+import logging
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Iterator, List, Optional, Tuple
+import numpy as np
+from .catalog import CatalogSnapshot
+from .columnar import get_column_keys, import_pyarrow, read_arrow_batches
+
+logger = logging.getLogger(__name__)
+
+STAGE_FILE_NAME = "stage.json"
+STAGE_VERSION = 1
+
+
+def get_stage_data_types(data_types: List[str]) -> List[Optional[str]]:
+    """
+    Column types as stored in the cache: numeric values keep their exact text and
+    real values are widened to double, so that rows read back from the cache encode
+    to the same literals as the rows read from the source
+    """
+    stage_types = []
+    for data_type in data_types:
+        if data_type == 'numeric':
+            stage_types.append(None)
+        elif data_type == 'real':
+            stage_types.append('double precision')
+        else:
+            stage_types.append(data_type)
+    return stage_types
+
+
+class StagedSource:
+    """A source database staged into a local directory of Arrow IPC files"""
+
+    def __init__(self, cache_dir: str, source_database: str = None):
+        self.cache_dir = cache_dir
+        self.source_database = source_database
+        self.staged_at = datetime.now(timezone.utc).isoformat()
+        # Oldest transaction still running in the snapshot the tables were read from
+        self.xmin = None
+        self.catalog = None
+        # (referenced table, referencing table, {'columns': [(column, referenced column)]})
+        # edges of the exporter's dependency graph; caches of older versions have no columns
+        self.foreign_keys = []
+        self.row_counts = {}
+
+    @classmethod
+    def load(cls, cache_dir: str) -> 'StagedSource':
+        """Load a cache written by a completed stage run"""
+        path = os.path.join(cache_dir, STAGE_FILE_NAME)
+        if not os.path.exists(path):
+            raise ValueError(f"No staged source in {cache_dir}; run with --stage first")
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if data.get('version') != STAGE_VERSION:
+            raise ValueError(f"Unsupported staged source version in {path}: {data.get('version')}")
+
+        staged = cls(cache_dir, data.get('source_database'))
+        staged.staged_at = data.get('staged_at')
+        staged.xmin = data.get('xmin')
+        staged.catalog = CatalogSnapshot.from_dict(data['catalog'])
+        staged.foreign_keys = [tuple(edge) for edge in data.get('foreign_keys', [])]
+        staged.row_counts = data.get('row_counts', {})
+        logger.info(f"Loaded staged source {staged.source_database} ({len(staged.row_counts)} tables, "
+                    f"staged at {staged.staged_at})")
+        return staged
+
+    def save(self):
+        """Write the cache metadata atomically; a cache without it is incomplete"""
+        path = os.path.join(self.cache_dir, STAGE_FILE_NAME)
+        data = {
+            'version': STAGE_VERSION,
+            'source_database': self.source_database,
+            'staged_at': self.staged_at,
+            'xmin': self.xmin,
+            'catalog': self.catalog.to_dict(),
+            'foreign_keys': [list(edge) for edge in self.foreign_keys],
+            'row_counts': self.row_counts,
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    @property
+    def tables_dir(self) -> str:
+        return os.path.join(self.cache_dir, "tables")
+
+    def get_table_path(self, table: str) -> str:
+        """Path of the Arrow IPC file of a table"""
+        return os.path.join(self.tables_dir, f"{table}.arrow")
+
+    def get_schema_path(self, section: str = None) -> str:
+        """Path of the stored pg_dump output, for the whole schema or one section"""
+        return os.path.join(self.cache_dir, f"schema_{section or 'full'}.sql")
+
+    def write_schema(self, section: Optional[str], content: str):
+        with open(self.get_schema_path(section), 'w') as f:
+            f.write(content)
+
+    def read_schema(self, section: str = None) -> str:
+        with open(self.get_schema_path(section), 'r') as f:
+            return f.read()
+
+    def count_rows(self, table: str) -> int:
+        return self.row_counts.get(table, 0)
+
+    def read_batches(self, table: str) -> Iterator:
+        """Yield the Arrow record batches of a table"""
+        return read_arrow_batches(self.get_table_path(table))
+
+    def read_columns(self, table: str, columns: List[str]) -> List[List]:
+        """Read whole columns of a table as lists of values"""
+        pa, _ = import_pyarrow()
+        with pa.memory_map(self.get_table_path(table), 'r') as source:
+            data = pa.ipc.open_file(source).read_all().select(columns)
+            return [data.column(i).to_pylist() for i in range(len(columns))]
+
+    def read_distinct(self, table: str, column: str) -> List:
+        """Read the distinct values of a column of a table"""
+        pa, _ = import_pyarrow()
+        with pa.memory_map(self.get_table_path(table), 'r') as source:
+            return pa.ipc.open_file(source).read_all().column(column).unique().to_pylist()
+
+    def read_keys(self, table: str, column: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Read a whole integer column of a table as keys, see get_column_keys"""
+        pa, _ = import_pyarrow()
+        with pa.memory_map(self.get_table_path(table), 'r') as source:
+            data = pa.ipc.open_file(source).read_all().column(column).combine_chunks()
+            return get_column_keys(data)
+
+    def get_max_value(self, table: str, column: str) -> Optional[str]:
+        """
+        Highest value of a column as text, like SELECT MAX(column) on the source,
+        computed by Arrow on the memory-mapped column
+        """
+        if self.catalog.get_table(table).get_column(column).data_type == 'numeric':
+            # Stored as text (see get_stage_data_types), so compared as Decimal batch by batch
+            highest = None
+            for batch in read_arrow_batches(self.get_table_path(table)):
+                values = [v for v in batch.column(batch.schema.get_field_index(column)).to_pylist() if v is not None]
+                if values:
+                    value = max(values, key=Decimal)
+                    if highest is None or Decimal(value) > Decimal(highest):
+                        highest = value
+            return highest
+        pa, _ = import_pyarrow()
+        import pyarrow.compute as pc
+        with pa.memory_map(self.get_table_path(table), 'r') as source:
+            value = pc.max(pa.ipc.open_file(source).read_all().column(column)).as_py()
+        return str(value) if value is not None else None
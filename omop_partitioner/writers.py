@@ -0,0 +1,178 @@
+"""
+Table writers for OMOP SQL exports
+
+This module provides streaming writers that turn batches of rows into
+pgdump-style INSERT or COPY blocks, so a table never has to be held in
+memory as a whole while it is being exported.
+
+Author: Narasimha Raghavan
+"""
+
+import csv
+import logging
+from bisect import bisect_left
+from itertools import accumulate
+from typing import List, Sequence
+
+from .encoders import compile_batch_encoder
+
+logger = logging.getLogger(__name__)
+
+# Rows per bulk INSERT statement
+INSERT_BATCH_SIZE = 1000
+
+# Size of the values of a bulk INSERT statement (in characters) at which it is
+# closed early, so that statements of wide rows stay bounded
+INSERT_BATCH_BYTES = 4 * 1024 * 1024
+
+
+class TableWriter:
+    """Base class for writers that emit the data block of one table"""
+
+    def __init__(self, file_handle, schema: str, table_name: str, columns: List[str],
+                 nullable_cols: List[str] = None, data_types: List[str] = None):
+        """
+        Initialize the table writer
+
+        Args:
+            file_handle: Open text file the data block is written to
+            schema: Schema of the exported table
+            table_name: Name of the exported table
+            columns: Column names in ordinal order
+            nullable_cols: Columns that accept NULL values
+            data_types: Column types as named by format_type(), in ordinal order
+        """
+        self.file_handle = file_handle
+        self.schema = schema
+        self.table_name = table_name
+        self.columns = columns
+        self.nullable_cols = nullable_cols or []
+        self.data_types = data_types or [None] * len(columns)
+        self.rows_written = 0
+
+    def write_rows(self, rows: Sequence) -> None:
+        """Write a batch of rows, emitting the table header before the first one"""
+        if not rows:
+            return
+        if self.rows_written == 0:
+            self._write_header()
+        self._write_batch(rows)
+        self.rows_written += len(rows)
+
+    def close(self) -> int:
+        """Finish the data block and return the number of rows written"""
+        if self.rows_written:
+            self._write_footer()
+            self.file_handle.write(
+                f"-- {self.rows_written} rows exported for table {self.schema}.{self.table_name}\n\n"
+            )
+        return self.rows_written
+
+    def _write_header(self) -> None:
+        self.file_handle.write(f"\n-- Data for table {self.schema}.{self.table_name}\n")
+        self.file_handle.write(f"SET search_path TO {self.schema}, public;\n\n")
+
+    def _write_batch(self, rows: Sequence) -> None:
+        raise NotImplementedError
+
+    def _write_footer(self) -> None:
+        pass
+
+
+class InsertTableWriter(TableWriter):
+    """
+    Writes rows as bulk INSERT statements of INSERT_BATCH_SIZE rows each, or fewer
+    once the values of a statement reach INSERT_BATCH_BYTES
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.column_list = ', '.join(self.columns)
+        self.encode_batch = compile_batch_encoder(self.data_types)
+        # Value clauses waiting for a full statement; fetch batches rarely
+        # line up with statement boundaries
+        self.pending = []
+        self.pending_size = 0
+        # Clause appended to every statement (see UpsertTableWriter)
+        self.on_conflict = ''
+
+    def _write_batch(self, rows: Sequence) -> None:
+        clauses = self.encode_batch(rows)
+        start = 0
+        while start < len(clauses):
+            chunk = clauses[start:start + INSERT_BATCH_SIZE - len(self.pending)]
+            sizes = list(accumulate(map(len, chunk)))
+            # The clause that reaches the size limit is the last one of the statement
+            last = bisect_left(sizes, INSERT_BATCH_BYTES - self.pending_size)
+            if last < len(chunk):
+                chunk = chunk[:last + 1]
+
+            self.pending.extend(chunk)
+            self.pending_size += sizes[len(chunk) - 1]
+            start += len(chunk)
+            if len(self.pending) >= INSERT_BATCH_SIZE or self.pending_size >= INSERT_BATCH_BYTES:
+                self._flush()
+
+    def _write_footer(self) -> None:
+        self._flush()
+        self.file_handle.write("\n")
+
+    def _flush(self) -> None:
+        if not self.pending:
+            return
+        values_sql = ',\n    '.join(self.pending)
+        self.file_handle.write(
+            f"INSERT INTO {self.schema}.{self.table_name} ({self.column_list}) VALUES\n    {values_sql}{self.on_conflict};\n\n"
+        )
+        self.pending = []
+        self.pending_size = 0
+
+
+class CopyTableWriter(TableWriter):
+    """Writes rows as a COPY ... FROM STDIN block in CSV format"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writer = csv.writer(self.file_handle, quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+
+    def _write_header(self) -> None:
+        super()._write_header()
+
+        # Build FORCE_NULL clause for nullable columns
+        force_null_clause = f", FORCE_NULL ({', '.join(self.nullable_cols)})" if self.nullable_cols else ""
+
+        # Write COPY statement with proper NULL handling
+        self.file_handle.write(
+            f"COPY {self.schema}.{self.table_name} ({', '.join(self.columns)}) "
+            f"FROM STDIN WITH (FORMAT CSV, DELIMITER ',', QUOTE '\"', ESCAPE '\"', HEADER FALSE, NULL ''{force_null_clause});\n"
+        )
+
+    def _write_batch(self, rows: Sequence) -> None:
+        # Convert None to empty string - PostgreSQL will treat empty strings as NULL for nullable columns
+        self.writer.writerows(['' if v is None else v for v in row] for row in rows)
+
+    def _write_footer(self) -> None:
+        self.file_handle.write("\\.\n\n")
+
+
+class UpsertTableWriter(InsertTableWriter):
+    """Writes rows as bulk INSERT ... ON CONFLICT statements that update rows already present"""
+
+    def __init__(self, *args, conflict_columns: List[str] = None, **kwargs):
+        """
+        Initialize the upsert writer
+
+        conflict_columns is the primary key of the table; without one, rows that
+        violate any unique constraint are skipped instead of updated
+        """
+        super().__init__(*args, **kwargs)
+        if not conflict_columns:
+            self.on_conflict = "\nON CONFLICT DO NOTHING"
+            return
+
+        updates = [f"{c} = EXCLUDED.{c}" for c in self.columns if c not in conflict_columns]
+        target = ', '.join(conflict_columns)
+        if updates:
+            self.on_conflict = f"\nON CONFLICT ({target}) DO UPDATE SET\n    " + ',\n    '.join(updates)
+        else:
+            self.on_conflict = f"\nON CONFLICT ({target}) DO NOTHING"